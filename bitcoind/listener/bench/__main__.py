@@ -0,0 +1,51 @@
+"""
+Run listener scenarios against an in process fake bitcoind
+
+    python3 -m bench [scenario ...] [--raw] [--scale N] [--json]
+"""
+from gevent import monkey; monkey.patch_all()
+
+from .scenarios import Bench, scenarios, format_report
+
+import argparse
+import logging
+import json
+
+
+def scaled(f, scale):
+    defaults = f.__defaults__ or ()
+    names = f.__code__.co_varnames[f.__code__.co_argcount - len(defaults):f.__code__.co_argcount]
+    return dict((name, max(1, int(default * scale)) if name not in ('noise', 'drop_every', 'depth') else default)
+                for name, default in zip(names, defaults))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the listener against a fake bitcoind')
+    parser.add_argument('scenario', nargs='*', choices=list(scenarios) + [[]], default=[])
+    parser.add_argument('--raw', action='store_true', help='Subscribe to rawtx/rawblock instead of hashtx/hashblock')
+    parser.add_argument('--scale', type=float, default=1, help='Multiply scenario sizes')
+    parser.add_argument('--json', action='store_true', help='Print reports as JSON')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    reports = {}
+    for name in args.scenario or scenarios:
+        f = scenarios[name]
+        bench = Bench(raw=args.raw)
+        try:
+            ok = f(bench, **scaled(f, args.scale))
+            report = bench.report()
+        finally:
+            bench.stop()
+        reports[name] = report
+        if not args.json:
+            print(format_report(name, ok, report))
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
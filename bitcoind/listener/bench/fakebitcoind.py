@@ -0,0 +1,311 @@
+import zmq.green as zmq
+from gevent.pywsgi import WSGIServer
+
+from btd.bitcoind import BitcoindConf
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint, CBlock, b2lx, lx, COIN
+from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress
+
+from decimal import Decimal
+from time import time, monotonic
+import binascii
+import struct
+import json
+import os
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.error = {'code': code, 'message': message}
+
+
+class FakeTx:
+    def __init__(self, txid, raw, outputs, category):
+        self.txid = txid
+        self.raw = raw
+        # [(address, amount)]
+        self.outputs = outputs
+        self.category = category
+        self.blockhash = None
+        self.time = int(time())
+        self.comment = ''
+
+
+class FakeBitcoind:
+    """
+    In process stand-in for a bitcoind wallet node: serves the JSON-RPC methods BitcoindRPC uses over HTTP
+    and publishes hashtx/hashblock/rawtx/rawblock with sequence numbers on a ZMQ PUB socket
+    """
+    def __init__(self, zmq_endpoint='tcp://127.0.0.1:0'):
+        self.wallet = set()
+        self.txs = {}
+        self.mempool = []
+        self.blocks = {}
+        self.chain = []
+        self.seq = {}
+        self.calls = 0
+        # Monotonic publish time per txid and blockhash, for latency measurements
+        self.published = {}
+
+        self.mine_block([])
+
+        self.http = WSGIServer(('127.0.0.1', 0), self.handle_http, log=None)
+        self.http.start()
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, 0)
+        self.socket.bind(zmq_endpoint)
+        self.zmq_endpoint = self.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+
+    def conf(self, filename='bench.conf', raw=False):
+        conf = {
+            'rpcuser': 'bench',
+            'rpcpassword': 'bench',
+            'rpcbind': '127.0.0.1',
+            'rpcport': str(self.http.server_port),
+            'rpcthreads': '4',
+        }
+        for topic in ('rawtx', 'rawblock') if raw else ('hashtx', 'hashblock'):
+            conf['zmqpub' + topic] = self.zmq_endpoint
+        return BitcoindConf(filename, conf)
+
+    def stop(self):
+        self.http.stop()
+        self.socket.close(linger=0)
+
+    # Chain and wallet model
+
+    @property
+    def tip_height(self):
+        return len(self.chain) - 1
+
+    def confirmations(self, tx):
+        if tx.blockhash is None:
+            return 0
+        height = self.blocks[tx.blockhash][0]
+        if self.chain[height] != tx.blockhash:
+            return -1
+        return self.tip_height - height + 1
+
+    def new_address(self):
+        address = str(P2PKHBitcoinAddress.from_bytes(os.urandom(20)))
+        self.wallet.add(address)
+        return address
+
+    def make_tx(self, outputs, category='receive'):
+        tx = CMutableTransaction(
+            [CMutableTxIn(COutPoint(os.urandom(32), 0))],
+            [CMutableTxOut(int(amount * COIN), CBitcoinAddress(address).to_scriptPubKey()) for address, amount in outputs])
+        return FakeTx(b2lx(tx.GetHash()), tx.serialize(), outputs, category)
+
+    def deposit(self, address, amount, publish=True):
+        """
+        An outside payment of amount to address entering the mempool
+        """
+        tx = self.make_tx([(address, amount)])
+        self.accept(tx, publish)
+        return tx.txid
+
+    def noise(self, publish=True):
+        """
+        A mempool transaction that does not touch the wallet
+        """
+        tx = self.make_tx([(str(P2PKHBitcoinAddress.from_bytes(os.urandom(20))), Decimal('0.01'))])
+        self.mempool.append(tx)
+        if publish:
+            self.publish_tx(tx)
+        else:
+            self.skip('hashtx', 'rawtx')
+        return tx.txid
+
+    def accept(self, tx, publish=True):
+        self.txs[tx.txid] = tx
+        self.mempool.append(tx)
+        if publish:
+            self.publish_tx(tx)
+        else:
+            self.skip('hashtx', 'rawtx')
+
+    def mine_block(self, txs, publish=True):
+        prev = lx(self.chain[-1]) if self.chain else b'\x00' * 32
+        block = CBlock(nVersion=4, hashPrevBlock=prev, nTime=int(time()), nBits=0x207fffff,
+                       nNonce=struct.unpack('<I', os.urandom(4))[0])
+        blockhash = b2lx(block.GetHash())
+        self.blocks[blockhash] = (len(self.chain), block.serialize())
+        self.chain.append(blockhash)
+        for tx in txs:
+            tx.blockhash = blockhash
+            if tx in self.mempool:
+                self.mempool.remove(tx)
+        if publish and len(self.chain) > 1:
+            self.publish_block(blockhash)
+        return blockhash
+
+    def generate(self, numblocks, publish=True):
+        hashes = []
+        for _ in range(numblocks):
+            hashes.append(self.mine_block(list(self.mempool), publish))
+        return hashes
+
+    def reorg(self, depth, include=True):
+        """
+        Replace the top depth blocks, their transactions go back to the mempool unless include
+        """
+        orphaned = self.chain[-depth:]
+        del self.chain[-depth:]
+        returning = [tx for tx in self.txs.values() if tx.blockhash in orphaned]
+        for tx in returning:
+            tx.blockhash = None
+            self.mempool.append(tx)
+        for i in range(depth):
+            self.mine_block(returning if include and i == 0 else [])
+        return returning
+
+    # ZMQ
+
+    def next_seq(self, topic):
+        self.seq[topic] = self.seq.get(topic, -1) + 1
+        return struct.pack('<I', self.seq[topic])
+
+    def skip(self, *topics):
+        # Burn sequence numbers as if the messages were lost
+        for topic in topics:
+            self.next_seq(topic)
+
+    def publish(self, topic, body):
+        self.socket.send_multipart((topic.encode(), body, self.next_seq(topic)))
+
+    def publish_tx(self, tx):
+        self.published[tx.txid] = monotonic()
+        self.publish('hashtx', binascii.a2b_hex(tx.txid))
+        self.publish('rawtx', tx.raw)
+
+    def publish_block(self, blockhash):
+        self.published[blockhash] = monotonic()
+        self.publish('hashblock', binascii.a2b_hex(blockhash))
+        self.publish('rawblock', self.blocks[blockhash][1])
+
+    # JSON-RPC
+
+    def handle_http(self, environ, start_response):
+        request = json.loads(environ['wsgi.input'].read().decode())
+        if isinstance(request, list):
+            response = [self.handle_call(call) for call in request]
+        else:
+            response = self.handle_call(request)
+        body = json.dumps(response, default=float).encode()
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def handle_call(self, call):
+        self.calls += 1
+        try:
+            result = getattr(self, 'rpc_' + call['method'])(*call.get('params', []))
+            return {'id': call.get('id'), 'result': result, 'error': None}
+        except RPCError as e:
+            return {'id': call.get('id'), 'result': None, 'error': e.error}
+        except AttributeError:
+            return {'id': call.get('id'), 'result': None, 'error': {'code': -32601, 'message': 'Method not found'}}
+
+    def entries(self, tx):
+        confirmations = self.confirmations(tx)
+        for vout, (address, amount) in enumerate(tx.outputs):
+            entry = {
+                'account': '',
+                'address': address,
+                'category': tx.category,
+                'amount': -amount if tx.category == 'send' else amount,
+                'vout': vout,
+                'confirmations': confirmations,
+                'txid': tx.txid,
+                'time': tx.time,
+                'timereceived': tx.time,
+            }
+            if tx.comment:
+                entry['comment'] = tx.comment
+            if confirmations > 0:
+                entry['blockhash'] = tx.blockhash
+                entry['blockindex'] = 0
+                entry['blocktime'] = tx.time
+            yield entry
+
+    def rpc_getinfo(self):
+        return {'version': 130200, 'blocks': self.tip_height, 'connections': 0}
+
+    def rpc_getblockcount(self):
+        return self.tip_height
+
+    def rpc_getblockchaininfo(self):
+        return {'chain': 'regtest', 'blocks': self.tip_height, 'bestblockhash': self.chain[-1]}
+
+    def rpc_getblockheader(self, blockhash, verbose=True):
+        if blockhash not in self.blocks:
+            raise RPCError(-5, 'Block not found')
+        height = self.blocks[blockhash][0]
+        on_chain = self.chain[height] == blockhash
+        header = {
+            'hash': blockhash,
+            'height': height,
+            'confirmations': self.tip_height - height + 1 if on_chain else -1,
+        }
+        if height > 0:
+            header['previousblockhash'] = b2lx(CBlock.deserialize(self.blocks[blockhash][1]).hashPrevBlock)
+        return header
+
+    def rpc_getpeerinfo(self):
+        return []
+
+    def rpc_getwalletinfo(self):
+        return {'txcount': len(self.txs), 'keypoolsize': 100}
+
+    def rpc_getnewaddress(self, account=None):
+        return self.new_address()
+
+    def rpc_generate(self, numblocks):
+        return self.generate(numblocks)
+
+    def rpc_gettransaction(self, txid, include_watchonly=False):
+        if txid not in self.txs:
+            raise RPCError(-5, 'Invalid or non-wallet transaction id')
+        tx = self.txs[txid]
+        return {'txid': txid, 'confirmations': self.confirmations(tx), 'details': list(self.entries(tx))}
+
+    def rpc_getreceivedbyaddress(self, address, minconf=1):
+        return sum((amount for tx in self.txs.values() if tx.category == 'receive' and self.confirmations(tx) >= minconf
+                    for a, amount in tx.outputs if a == address), Decimal(0))
+
+    def rpc_listreceivedbyaddress(self, minconf=1, include_empty=False, include_watchonly=False):
+        received = dict((address, Decimal(0)) for address in self.wallet) if include_empty else {}
+        for tx in self.txs.values():
+            if tx.category == 'receive' and self.confirmations(tx) >= minconf:
+                for address, amount in tx.outputs:
+                    received[address] = received.get(address, Decimal(0)) + amount
+        return [{'address': address, 'amount': amount, 'confirmations': minconf} for address, amount in received.items()]
+
+    def rpc_sendtoaddress(self, address, amount, comment='', comment_to='', subtractfeefromamount=False):
+        tx = self.make_tx([(address, Decimal(str(amount)))], 'send')
+        tx.comment = comment
+        self.accept(tx)
+        return tx.txid
+
+    def rpc_sendmany(self, fromaccount, amounts, minconf=1, comment='', subtractfeefrom=()):
+        tx = self.make_tx([(address, Decimal(str(amount))) for address, amount in amounts.items()], 'send')
+        tx.comment = comment
+        self.accept(tx)
+        return tx.txid
+
+    def rpc_listtransactions(self, account='*', count=10, skip=0, include_watchonly=False):
+        entries = [entry for tx in sorted(self.txs.values(), key=lambda tx: tx.time) for entry in self.entries(tx)]
+        return entries[::-1][skip:skip + count][::-1]
+
+    def rpc_listsinceblock(self, blockhash='', target_confirmations=1, include_watchonly=False):
+        depth = self.tip_height + 1 - self.blocks[blockhash][0] if blockhash in self.blocks else -1
+        transactions = [entry for tx in self.txs.values()
+                        if depth == -1 or self.confirmations(tx) < depth
+                        for entry in self.entries(tx)]
+        return {
+            'transactions': transactions,
+            'lastblock': self.chain[max(0, self.tip_height + 1 - target_confirmations)],
+        }
@@ -0,0 +1,296 @@
+"""
+Replay a capture recorded with BTD_CAPTURE_DIR against a listener whose RPC is answered from the capture
+
+    python3 -m bench.replay capture.btdcap [--speed N | --max] [--rpc-latency] [--json]
+"""
+from gevent import monkey; monkey.patch_all()
+
+import zmq.green as zmq
+from gevent import sleep
+from bitcoin.rpc import Proxy, JSONRPCError
+
+from btd.bitcoind import BitcoindRPC, BitcoindConf
+from btd.capture import read_capture, encode_json, STATE, ZMQ, RPC
+from btd.watch import decode_tx, tx_txid
+from .scenarios import Bench, format_report, pace
+
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from copy import deepcopy
+from time import monotonic
+import argparse
+import binascii
+import logging
+import json
+
+from logging import getLogger
+log = getLogger(__name__)
+
+# Answered for calls missing from the capture, batched lookups skip it
+NOT_CAPTURED = {'code': -5, 'message': 'Not in capture'}
+
+
+def params_key(method, params):
+    return method, json.dumps(list(params), default=encode_json)
+
+
+class PublishTimes(dict):
+    """
+    txid -> monotonic time its last message was published, a diff following a block counts from the block
+    """
+    block = None
+
+    def get(self, txid, default=None):
+        published = super().get(txid, default)
+        if published is None or self.block is None:
+            return published
+        return max(published, self.block)
+
+
+class Player:
+    """
+    Stands in for FakeBitcoind: publishes the captured ZMQ messages and answers RPC calls with the captured responses
+
+    A call is answered with the first response captured at or after the last message published, which is what
+    bitcoind answered the recorded listener while it handled that message.
+    """
+    def __init__(self, records, rpc_latency=False):
+        self.rpc_latency = rpc_latency
+        self.state = {}
+        # (seconds, frames, txid)
+        self.messages = []
+        # (method, params) -> ([seconds], [(response, round trip seconds)])
+        self.responses = {}
+        # ([seconds], [(params, response, round trip seconds)]) of every listsinceblock
+        self.since = ([], [])
+        # Wallet addresses seen in the captured responses, for matching rawtx
+        self.addresses = set()
+        self.calls = 0
+        self.misses = Counter()
+        self.published = PublishTimes()
+        self.position = 0
+        self.played = None
+
+        for kind, at, payload in records:
+            if kind == STATE:
+                self.state = dict((key, value) for key, value in payload.items() if value is not None)
+            elif kind == ZMQ:
+                self.messages.append((at, payload, self.message_txid(payload)))
+            elif kind == RPC:
+                timeline = self.responses.setdefault(params_key(payload['method'], payload['params']), ([], []))
+                timeline[0].append(at)
+                timeline[1].append((payload['response'], payload['seconds']))
+                if payload['method'] == 'listsinceblock':
+                    self.since[0].append(at)
+                    self.since[1].append((payload['params'], payload['response'], payload['seconds']))
+                self.addresses.update(self.wallet_addresses(payload['method'], payload['response']['result']))
+
+        topics = set(frames[0].decode() for _, frames, _ in self.messages)
+        self.raw = 'rawtx' in topics or 'rawblock' in topics
+
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, 0)
+        self.socket.bind('tcp://127.0.0.1:0')
+        self.zmq_endpoint = self.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+
+    @staticmethod
+    def wallet_addresses(method, result):
+        if result is None:
+            return []
+        if method == 'listsinceblock':
+            entries = result['transactions'] + result.get('removed', [])
+        elif method == 'gettransaction':
+            entries = result.get('details', [])
+        elif method == 'listtransactions':
+            entries = result
+        else:
+            return []
+        return [entry['address'] for entry in entries if 'address' in entry]
+
+    @staticmethod
+    def message_txid(frames):
+        topic = frames[0]
+        if topic == b'hashtx':
+            return binascii.b2a_hex(frames[1]).decode()
+        if topic == b'rawtx':
+            tx = decode_tx(frames[1])
+            # Replayed all the same, only its latency is not measured
+            return None if tx is None else tx_txid(tx)
+        return None
+
+    def conf(self, filename='replay.conf', raw=False):
+        # Never connected to, the proxies are answered from the capture
+        conf = {
+            'rpcuser': 'replay',
+            'rpcpassword': 'replay',
+            'rpcbind': '127.0.0.1',
+            'rpcport': '1',
+        }
+        for topic in ('rawtx', 'rawblock') if raw else ('hashtx', 'hashblock'):
+            conf['zmqpub' + topic] = self.zmq_endpoint
+        return BitcoindConf(filename, conf)
+
+    def stop(self):
+        self.socket.close(linger=0)
+
+    def respond(self, method, params):
+        """
+        Returns the captured response to a call and how long bitcoind took to send it
+        """
+        if method == 'listsinceblock' and self.since[0]:
+            return self.respond_since(list(params))
+
+        timeline = self.responses.get(params_key(method, params))
+        if timeline is None:
+            self.misses[method] += 1
+            return {'result': None, 'error': NOT_CAPTURED}, 0
+
+        at, answers = timeline
+        response, seconds = answers[min(bisect_left(at, self.position), len(at) - 1)]
+        # The listener may hold on to what it was given, every call gets its own copy
+        return deepcopy(response), seconds
+
+    def respond_since(self, params):
+        """
+        The replayed listener coalesces syncs differently, so it asks from cursors at times the recorded one did not.
+        Answered with the captured answers merged from the last one asked from the same cursor up to now, so nothing
+        bitcoind reported in between is left out.
+        """
+        at, answers = self.since
+        end = min(bisect_left(at, self.position), len(at) - 1)
+        start = 0
+        for i in range(end, -1, -1):
+            if answers[i][0] == params:
+                start = i
+                break
+
+        transactions = OrderedDict()
+        removed = OrderedDict()
+        lastblock = None
+        for _, response, _ in answers[start:end + 1]:
+            result = response['result']
+            if result is None:
+                continue
+            for merged, entries in ((transactions, result['transactions']), (removed, result.get('removed', []))):
+                for entry in entries:
+                    key = (entry.get('txid'), entry.get('category'), entry.get('address'), entry.get('vout'))
+                    merged.pop(key, None)
+                    merged[key] = entry
+            lastblock = result['lastblock']
+
+        if lastblock is None:
+            return deepcopy(answers[end][1]), answers[end][2]
+        result = {'transactions': list(transactions.values()), 'removed': list(removed.values()), 'lastblock': lastblock}
+        return deepcopy({'result': result, 'error': None}), answers[end][2]
+
+    def play(self, speed=1):
+        """
+        Publish the captured messages at speed times their recorded pace, as fast as possible when speed is None
+        """
+        start = monotonic()
+        for i, (at, frames, txid) in enumerate(self.messages):
+            if speed is None:
+                pace(i)
+            else:
+                delay = start + at / speed - monotonic()
+                if delay > 0:
+                    sleep(delay)
+            self.position = at
+            now = monotonic()
+            if txid is not None:
+                self.published[txid] = now
+            elif frames[0] in (b'hashblock', b'rawblock'):
+                self.published.block = now
+            self.socket.send_multipart(frames)
+        self.played = monotonic() - start
+
+    def report(self):
+        captured = self.messages[-1][0] - self.messages[0][0] if self.messages else 0
+        return OrderedDict((
+            ('messages', len(self.messages)),
+            ('captured_seconds', captured),
+            ('played_seconds', self.played),
+            ('messages_per_sec', len(self.messages) / self.played if self.played else 0),
+            ('rpc_misses', dict(self.misses)),
+        ))
+
+
+class ReplayProxy(Proxy):
+    def __init__(self, player, **kwargs):
+        super().__init__(**kwargs)
+        self.player = player
+
+    def _call(self, service_name, *args):
+        self.player.calls += 1
+        response, seconds = self.player.respond(service_name, args)
+        if self.player.rpc_latency:
+            sleep(seconds)
+        if response['error'] is not None:
+            raise JSONRPCError(response['error'])
+        return response['result']
+
+    def _batch(self, rpc_call_list):
+        self.player.calls += 1
+        responses = []
+        latency = 0
+        for call in rpc_call_list:
+            response, seconds = self.player.respond(call['method'], call['params'])
+            response['id'] = call['id']
+            responses.append(response)
+            latency = max(latency, seconds)
+        if self.player.rpc_latency:
+            sleep(latency)
+        return responses
+
+
+class ReplayRPC(BitcoindRPC):
+    def __init__(self, conf, player: Player):
+        self.player = player
+        super().__init__(conf)
+
+    def create_proxy(self):
+        return ReplayProxy(self.player, service_url=self.service_url())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured listener traffic as a benchmark')
+    parser.add_argument('capture', help='A file written under BTD_CAPTURE_DIR')
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument('--speed', type=float, default=1, help='Multiply the recorded pace')
+    speed.add_argument('--max', action='store_true', help='Publish as fast as the listener keeps up')
+    parser.add_argument('--rpc-latency', action='store_true', help='Answer RPC calls after their recorded round trip')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    player = Player(read_capture(args.capture), args.rpc_latency)
+    bench = Bench(raw=player.raw, fake=player, rpc=ReplayRPC(player.conf(raw=player.raw), player))
+    try:
+        # Resume from the captured checkpoint, so the captured cursor and sequence numbers line up
+        bench.storage.set_states(player.state)
+        for address in player.addresses:
+            bench.storage.store_address(address)
+        bench.start()
+        bench.phase('replay', player.play, None if args.max else args.speed)
+        ok = bench.settle()
+        report = bench.report()
+        report['replay'] = player.report()
+    finally:
+        bench.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        replay = report['replay']
+        print(format_report('replay', ok, report))
+        print('  replayed {messages} messages captured over {captured_seconds:.3f}s in {played_seconds:.3f}s,'
+              ' {messages_per_sec:.1f} messages/sec'.format(**replay))
+        if replay['rpc_misses']:
+            print('  rpc calls missing from the capture {}'.format(' '.join(
+                '{}:{}'.format(method, count) for method, count in sorted(replay['rpc_misses'].items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+from gevent import spawn, sleep
+from gevent.timeout import Timeout
+
+from btd import settings
+from btd.bitcoind import BitcoindRPC
+from btd.engine import BtdStorage, BtdListener
+from btd.publisher import BtdPublisher
+from .fakebitcoind import FakeBitcoind
+
+from collections import OrderedDict
+from decimal import Decimal
+from functools import wraps
+from time import monotonic
+import tempfile
+import shutil
+
+from logging import getLogger
+log = getLogger(__name__)
+
+# Methods timed per stage, call_pooled sees every RPC round trip including batches
+RPC_METHODS = ('call_pooled',)
+STORAGE_METHODS = ('load_txs', 'store_tx_dats', 'lookup_context', 'get_state', 'set_state')
+EVENTLOG_METHODS = ('append',)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def format_report(name, ok, report):
+    lines = ['{}{}'.format(name, '' if ok else ' (TIMED OUT)')]
+    lines.append('  {diffs} diffs in {elapsed:.3f}s, {events_per_sec:.1f} events/sec, {rpc_calls} rpc calls'.format(**report))
+    latency = report['latency_ms']
+    if latency[50] is not None:
+        lines.append('  diff latency ms p50:{:.2f} p90:{:.2f} p99:{:.2f} max:{:.2f}'.format(
+            latency[50], latency[90], latency[99], latency[100]))
+    for key, timing in report['timings'].items():
+        share = timing['seconds'] / report['elapsed'] * 100 if report['elapsed'] else 0
+        lines.append('  {:<24} {:>8} calls {:>9.3f}s {:>5.1f}%'.format(key, timing['calls'], timing['seconds'], share))
+    for key, seconds in report['phases'].items():
+        lines.append('  phase {:<18} {:>9.3f}s'.format(key, seconds))
+    lines.append('  listener {}'.format(' '.join('{}:{}'.format(k, v) for k, v in sorted(report['listener'].items()))))
+    return '\n'.join(lines)
+
+
+class Bench:
+    """
+    A listener wired to a FakeBitcoind, or a replayed capture, with its storage in a scratch directory
+
+    Diff latency is measured from the fake's last publish touching a txid to the listener broadcasting its diff.
+    """
+    def __init__(self, raw=False, fake=None, rpc=None):
+        self.directory = tempfile.mkdtemp(prefix='btd-bench-')
+        settings.BTD_SQLITE_DIR = self.directory
+
+        self.fake = fake or FakeBitcoind()
+        self.conf = self.fake.conf(raw=raw)
+        self.rpc = rpc or BitcoindRPC(self.conf)
+        self.storage = BtdStorage(self.conf)
+        self.publisher = BtdPublisher('inproc://btd-bench-{}'.format(id(self)))
+        self.listener = BtdListener(self.conf, self.rpc, self.storage, self.publisher)
+        self.greenlet = None
+
+        self.timings = OrderedDict()
+        self.latencies = []
+        self.diffs = 0
+        self.phases = OrderedDict()
+        self.started = None
+        self.finished = None
+
+        self.instrument('rpc', self.rpc, RPC_METHODS)
+        self.instrument('sqlite', self.storage, STORAGE_METHODS)
+        if self.listener.eventlog is not None:
+            self.instrument('eventlog', self.listener.eventlog, EVENTLOG_METHODS)
+        self.instrument_broadcast()
+
+    def instrument(self, stage, obj, names):
+        for name in names:
+            key = '{}.{}'.format(stage, name)
+            self.timings[key] = [0, 0.0]
+            setattr(obj, name, self.timed(key, getattr(obj, name)))
+
+    def timed(self, key, f):
+        @wraps(f)
+        def timed(*args, **kwargs):
+            start = monotonic()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timing = self.timings[key]
+                timing[0] += 1
+                timing[1] += monotonic() - start
+        return timed
+
+    def instrument_broadcast(self):
+        broadcast_diff = self.listener.broadcast_diff
+
+        @wraps(broadcast_diff)
+        def measured(txinfo):
+            broadcast_diff(txinfo)
+            now = monotonic()
+            self.diffs += 1
+            self.finished = now
+            published = self.fake.published.get(txinfo.txid)
+            if published is not None:
+                self.latencies.append(now - published)
+        self.listener.broadcast_diff = measured
+
+    def wallet_addresses(self, n):
+        addresses = []
+        for i in range(n):
+            address = self.fake.new_address()
+            self.storage.store_address(address, 'bench-{}'.format(i).encode())
+            addresses.append(address)
+        return addresses
+
+    def start(self):
+        self.greenlet = spawn(self.listener.listen_forever)
+        # Give the SUB socket time to connect, messages published before that are lost
+        sleep(0.5)
+        self.reset()
+
+    def reset(self):
+        self.diffs = 0
+        self.latencies = []
+        for timing in self.timings.values():
+            timing[:] = [0, 0.0]
+        self.fake.calls = 0
+        self.started = monotonic()
+        self.finished = None
+
+    def phase(self, name, f, *args, **kwargs):
+        start = monotonic()
+        result = f(*args, **kwargs)
+        self.phases[name] = monotonic() - start
+        return result
+
+    def wait(self, diffs, timeout=60):
+        """
+        Block until the listener has broadcast at least diffs diffs
+        """
+        try:
+            with Timeout(timeout):
+                while self.diffs < diffs:
+                    sleep(0.01)
+        except Timeout:
+            log.warning("Timed out with {} of {} diffs".format(self.diffs, diffs))
+            return False
+        return True
+
+    def settle(self, idle=1, timeout=600):
+        """
+        Block until the listener has been idle for idle seconds, for runs whose number of diffs is not known up front
+        """
+        try:
+            with Timeout(timeout):
+                diffs = self.diffs
+                quiet = monotonic()
+                while monotonic() - quiet < idle:
+                    sleep(0.05)
+                    if self.diffs != diffs or self.listener.queue_depth():
+                        diffs = self.diffs
+                        quiet = monotonic()
+        except Timeout:
+            log.warning("Timed out with the listener still busy after {} diffs".format(self.diffs))
+            return False
+        return True
+
+    def report(self):
+        elapsed = (self.finished or monotonic()) - self.started
+        latencies = [latency * 1000 for latency in self.latencies]
+        return OrderedDict((
+            ('diffs', self.diffs),
+            ('elapsed', elapsed),
+            ('events_per_sec', self.diffs / elapsed if elapsed else 0),
+            ('latency_ms', OrderedDict((p, percentile(latencies, p)) for p in (50, 90, 99, 100))),
+            ('rpc_calls', self.fake.calls),
+            ('listener', dict(self.listener.stats)),
+            ('timings', OrderedDict((key, {'calls': calls, 'seconds': seconds})
+                                    for key, (calls, seconds) in self.timings.items())),
+            ('phases', self.phases),
+        ))
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.publisher.close()
+        if self.listener.eventlog is not None:
+            self.listener.eventlog.close()
+        self.rpc.pool.clear()
+        self.storage.close()
+        self.fake.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def pace(i, every=50):
+    # Yield to the listener so a burst is not dropped at the SUB socket's high water mark
+    if i % every == every - 1:
+        sleep(0)
+
+
+def deposit_burst(bench: Bench, deposits=1000, addresses=100, noise=0):
+    """
+    A burst of deposits to wallet addresses, optionally mixed with unrelated mempool traffic, confirmed by one block
+    """
+    wallet = bench.wallet_addresses(addresses)
+    bench.start()
+    for i in range(deposits):
+        bench.fake.deposit(wallet[i % addresses], Decimal('0.001'))
+        for _ in range(noise):
+            bench.fake.noise()
+        pace(i)
+    bench.wait(deposits)
+    bench.fake.generate(1)
+    return bench.wait(2 * deposits)
+
+
+def reorg(bench: Bench, deposits=200, depth=3):
+    """
+    Deposits are confirmed depth deep, reorged back into the mempool and mined again
+    """
+    wallet = bench.wallet_addresses(deposits)
+    bench.start()
+    for i, address in enumerate(wallet):
+        bench.fake.deposit(address, Decimal('0.001'))
+        pace(i)
+    expected = deposits
+    bench.wait(expected)
+
+    # Mining is a modification, later blocks only announce milestones
+    for confirmations in range(1, depth + 1):
+        bench.fake.generate(1)
+        if confirmations == 1 or confirmations in settings.BTD_CONFIRMATION_MILESTONES:
+            expected += deposits
+        bench.wait(expected)
+
+    returning = bench.fake.reorg(depth, include=False)
+    now = monotonic()
+    for tx in returning:
+        bench.fake.published[tx.txid] = now
+    expected += deposits
+    bench.wait(expected)
+
+    bench.fake.generate(1)
+    expected += deposits
+    return bench.wait(expected)
+
+
+def sequence_gap(bench: Bench, deposits=500, drop_every=10):
+    """
+    Every drop_every-th notification is lost, only the sequence gap tells the listener to sync
+    """
+    wallet = bench.wallet_addresses(deposits)
+    bench.start()
+    for i, address in enumerate(wallet):
+        dropped = i % drop_every == drop_every - 1 and i != deposits - 1
+        bench.fake.deposit(address, Decimal('0.001'), publish=not dropped)
+        pace(i)
+    return bench.wait(deposits)
+
+
+def large_wallet(bench: Bench, addresses=10000, history=20000, deposits=200):
+    """
+    Initial sync of a wallet with a long confirmed history, then a burst against the large addr and tx tables
+    """
+    wallet = bench.phase('store_addresses', bench.wallet_addresses, addresses)
+    for i in range(history):
+        bench.fake.deposit(wallet[i % addresses], Decimal('0.001'), publish=False)
+    bench.fake.generate(6, publish=False)
+
+    bench.phase('initial_sync', bench.listener.rebuild_tx)
+    bench.start()
+    for i in range(deposits):
+        bench.fake.deposit(wallet[i % addresses], Decimal('0.001'))
+        pace(i)
+    return bench.wait(deposits)
+
+
+scenarios = OrderedDict((
+    ('deposit_burst', deposit_burst),
+    ('reorg', reorg),
+    ('sequence_gap', sequence_gap),
+    ('large_wallet', large_wallet),
+))
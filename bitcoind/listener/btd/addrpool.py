@@ -0,0 +1,63 @@
+from . import settings
+
+from gevent import spawn
+from gevent.event import Event
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class AddressPool:
+    """
+    Keeps pre-generated wallet addresses in storage so allocating one is a local claim instead of an RPC
+    """
+    def __init__(self, rpc, storage, low=None, high=None):
+        self.rpc = rpc
+        self.storage = storage
+        self.low = settings.BTD_ADDRESS_POOL_LOW if low is None else low
+        self.high = settings.BTD_ADDRESS_POOL_HIGH if high is None else high
+        self.available = None
+        self.wake = Event()
+        self.greenlet = None
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.refill_forever)
+        return self.greenlet
+
+    def claim(self, context):
+        address = self.storage.claim_pool_address(context)
+
+        if address is None:
+            self.available = 0
+        elif self.available is not None:
+            self.available -= 1
+
+        if self.available is not None and self.available < self.low:
+            self.wake.set()
+
+        return address
+
+    def refill(self):
+        self.available = self.storage.count_pool_addresses()
+        if self.available >= self.low and not self.wake.is_set():
+            return
+
+        needed = self.high - self.available
+        if needed <= 0:
+            return
+
+        log.info("Refilling address pool for conf:{} with {} addresses".format(self.storage.conf.filename, needed))
+        addresses = self.rpc.create_addresses(needed)
+        self.storage.store_pool_addresses(addresses)
+        self.available += len(addresses)
+
+    def refill_forever(self):
+        while True:
+            # Cleared first so claims made while refilling wake the next round
+            self.wake.clear()
+            try:
+                self.refill()
+            except Exception as e:
+                log.exception("Error refilling address pool", exc_info=e)
+            self.wake.wait(timeout=settings.BTD_ADDRESS_POOL_INTERVAL)
@@ -0,0 +1,658 @@
+"""
+asyncio edition of BitcoindRPC and BtdListener, for running the listener inside an asyncio service
+
+Needs Python 3.5+ and is not imported by the gevent engine. Diffing, checkpointing and storage are shared with
+BtdListener: the storage connection still lives on its own thread, and the listener steps that read or write storage
+run there as one group committed operation each, while ZMQ, RPC and broadcasting stay on the event loop.
+
+    listener = AsyncBtdListener(conf)
+    loop.run_until_complete(listener.listen_forever())
+"""
+import zmq
+import zmq.asyncio
+from bitcoin.rpc import JSONRPCError, InWarmupError, InvalidAddressOrKeyError
+from bitcoin.core import CBlockHeader, b2lx
+
+from . import settings
+from .bitcoind import BatchResult, rpc_seconds, rpc_errors, rpc_reconnects, rpc_warmup_retries
+from .engine import BtdStorage, BtdListener, listener_seconds, listener_lag
+from .executor import StorageExecutor, group_ops, get_ident
+from .publisher import BtdPublisher
+from .eventlog import EventLog
+
+import asyncio
+import binascii
+import json
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import wraps
+from time import monotonic
+
+from logging import getLogger
+log = getLogger(__name__)
+
+# A keep-alive connection closed by bitcoind fails like this on its next request
+BROKEN = (ConnectionError, asyncio.IncompleteReadError, EOFError)
+
+
+def timed(histogram, name, errors=None):
+    """
+    metrics.timed for coroutine methods
+    """
+    def decorator(f):
+        @wraps(f)
+        async def timed(self, *args, **kwargs):
+            if settings.BTD_METRICS_PORT is None:
+                return await f(self, *args, **kwargs)
+            labels = (self.conf.filename, name)
+            start = monotonic()
+            try:
+                return await f(self, *args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(labels)
+                raise
+            finally:
+                histogram.observe(monotonic() - start, labels)
+        return timed
+    return decorator
+
+
+def try_robustly(f):
+    """
+    bitcoind.try_robustly for coroutine methods: reconnects once after a dropped connection and waits out the warmup
+    A second dropped connection raises instead of returning None
+    """
+    @timed(rpc_seconds, f.__name__, rpc_errors)
+    @wraps(f)
+    async def attempt(self, *args, **kwargs):
+        try:
+            try:
+                return await f(self, *args, **kwargs)
+            except BROKEN:
+                # Handle reconnection if a service restarts, the broken connection was discarded
+                rpc_reconnects.inc((self.conf.filename,))
+                self.connect()
+                return await f(self, *args, **kwargs)
+        except InWarmupError:
+            delay = settings.BTD_STARTUP_POLL_MIN
+            while True:
+                log.info("Bitcoin still warming up, retrying...")
+                rpc_warmup_retries.inc((self.conf.filename,))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.BTD_STARTUP_POLL_MAX)
+                try:
+                    return await f(self, *args, **kwargs)
+                except InWarmupError:
+                    continue
+
+    return attempt
+
+
+def encode_json(o):
+    if isinstance(o, Decimal):
+        # As python-bitcoinlib sends amounts
+        return float(o)
+    raise TypeError(repr(o))
+
+
+class RPCConnection:
+    """
+    One keep-alive HTTP/1.1 connection to bitcoind's JSON-RPC server
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closing = False
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def idle(self):
+        # An idle connection has nothing to read, otherwise bitcoind closed it
+        return not self.closing and not self.reader.at_eof() and not self.writer.transport.is_closing()
+
+    def close(self):
+        self.closing = True
+        self.writer.close()
+
+    async def post(self, host, auth, body):
+        """
+        Returns the response's status and body
+        """
+        self.writer.write(b''.join((
+            'POST / HTTP/1.1\r\n'
+            'Host: {}\r\n'
+            'Authorization: {}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            '\r\n'.format(host, auth, len(body)).encode(),
+            body)))
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("bitcoind closed the connection")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b''.join(chunks)
+        else:
+            body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, body
+
+
+class AsyncBitcoindRPC:
+    """
+    BitcoindRPC for asyncio, JSON-RPC over pooled keep-alive asyncio streams
+
+    Results are bitcoind's JSON with amounts as Decimal, where BitcoindRPC sometimes returns python-bitcoinlib objects.
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.host = self.conf.conf['rpcbind']
+        self.port = int(self.conf.conf['rpcport'])
+        self.auth = 'Basic ' + b64encode('{}:{}'.format(
+            self.conf.conf['rpcuser'], self.conf.conf['rpcpassword']).encode()).decode()
+        # (connection, last used), checked out LIFO like ConnectionPool
+        self.idle = deque()
+        # Created in the running loop
+        self.slots = None
+        self.ids = 0
+
+    def pool_size(self):
+        # bitcoind only serves rpcthreads requests at once, default 4
+        return settings.BTD_RPC_POOL_SIZE or int(self.conf.conf.get('rpcthreads', 4))
+
+    def connect(self):
+        # Idle connections to a restarted service are stale as well
+        while self.idle:
+            self.idle.pop()[0].close()
+
+    def checkout_idle(self):
+        now = monotonic()
+        while self.idle:
+            conn, used = self.idle.pop()
+            if (settings.BTD_RPC_POOL_IDLE is None or now - used <= settings.BTD_RPC_POOL_IDLE) and conn.idle():
+                return conn
+            conn.close()
+        return None
+
+    async def request(self, payload):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pool_size())
+        body = json.dumps(payload, default=encode_json).encode()
+
+        async with self.slots:
+            conn = self.checkout_idle() or await RPCConnection.open(self.host, self.port)
+            try:
+                status, response = await conn.post(self.host, self.auth, body)
+            except BaseException:
+                conn.close()
+                raise
+            if conn.idle():
+                self.idle.append((conn, monotonic()))
+
+        try:
+            return json.loads(response.decode('utf8'), parse_float=Decimal)
+        except ValueError:
+            raise JSONRPCError({'code': -342, 'message': 'non-JSON HTTP response with status {} from server'.format(status)})
+
+    async def call(self, method, *params):
+        self.ids += 1
+        response = await self.request({'version': '1.1', 'method': method, 'params': list(params), 'id': self.ids})
+        if response.get('error') is not None:
+            raise JSONRPCError(response['error'])
+        if 'result' not in response:
+            raise JSONRPCError({'code': -343, 'message': 'missing JSON-RPC result'})
+        return response['result']
+
+    async def batch(self, calls):
+        """
+        Send (method, params) calls as JSON-RPC batch arrays, returns a BatchResult per call
+        """
+        calls = list(calls)
+        results = [BatchResult() for _ in calls]
+        for i in range(0, len(calls), settings.BTD_RPC_BATCH_SIZE):
+            responses = await self.send_batch(calls[i:i + settings.BTD_RPC_BATCH_SIZE])
+            for result, response in zip(results[i:], responses):
+                result.set(response)
+        return results
+
+    @try_robustly
+    async def send_batch(self, calls):
+        responses = await self.request([
+            {'version': '1.1', 'method': method, 'params': list(params), 'id': i}
+            for i, (method, params) in enumerate(calls)])
+
+        if isinstance(responses, dict):
+            # The whole batch was rejected
+            raise JSONRPCError(responses['error'])
+
+        responses = sorted(responses, key=lambda r: r['id'])
+        for response in responses:
+            error = response.get('error')
+            if error is not None and error['code'] == InWarmupError.RPC_ERROR_CODE:
+                # Let try_robustly retry the whole batch
+                raise JSONRPCError(error)
+
+        return responses
+
+    async def batch_skipping_unknown(self, method, keys):
+        """
+        key -> result of method(key) for every key bitcoind knows
+        """
+        keys = list(keys)
+        found = {}
+        for key, result in zip(keys, await self.batch((method, (key,)) for key in keys)):
+            if isinstance(result.error, InvalidAddressOrKeyError):
+                continue
+            found[key] = result.get()
+        return found
+
+    @try_robustly
+    async def get_info(self):
+        return await self.call('getinfo')
+
+    @try_robustly
+    async def create_address(self):
+        return await self.call('getnewaddress')
+
+    async def create_addresses(self, n):
+        return [result.get() for result in await self.batch(('getnewaddress', ()) for _ in range(n))]
+
+    @try_robustly
+    async def get_address_balance(self, addr, minconf=0):
+        return await self.call('getreceivedbyaddress', addr, minconf)
+
+    @try_robustly
+    async def list_address_amounts(self, minconf=0, include_empty=True):
+        addresses = await self.call('listreceivedbyaddress', minconf, include_empty)
+        return dict((a['address'], a['amount']) for a in addresses if a['confirmations'] >= minconf)
+
+    @try_robustly
+    async def send(self, addr, amount):
+        return await self.call('sendtoaddress', addr, amount)
+
+    @timed(rpc_seconds, 'send_many', rpc_errors)
+    async def send_many(self, amounts, comment=''):
+        """
+        Pay amounts (address -> amount) in one transaction
+        Not retried after a dropped connection, the wallet may have sent it already
+        """
+        return await self.call('sendmany', '', amounts, 1, comment)
+
+    @try_robustly
+    async def get_transaction(self, txid):
+        return await self.call('gettransaction', txid)
+
+    async def get_transactions(self, txids):
+        """
+        Fetch many wallet transactions in one round trip, skipping non wallet txids
+        """
+        return await self.batch_skipping_unknown('gettransaction', txids)
+
+    @try_robustly
+    async def get_block(self, blockid):
+        return await self.call('getblock', blockid)
+
+    @try_robustly
+    async def get_blockchain_info(self):
+        return await self.call('getblockchaininfo')
+
+    @try_robustly
+    async def get_block_header(self, blockhash):
+        return await self.call('getblockheader', blockhash)
+
+    async def get_block_headers(self, blockhashes):
+        """
+        Fetch many block headers in one round trip, skipping unknown blocks
+        """
+        return await self.batch_skipping_unknown('getblockheader', blockhashes)
+
+    @try_robustly
+    async def generate(self, numblocks):
+        return await self.call('generate', numblocks)
+
+    @try_robustly
+    async def list_transactions(self, count=10, skip=0):
+        return await self.call('listtransactions', '*', count, skip)
+
+    async def list_since_block(self, blockhash=None, target_confirmations=1):
+        """
+        See BitcoindRPC.list_since_block, a reorged out or unknown cursor is listed again from its fork point
+        """
+        calls = [('getblockheader', (blockhash,))] if blockhash else []
+        results = await self.batch(calls + [('listsinceblock', (blockhash or '', target_confirmations))])
+        if blockhash and (results[0].error is not None or results[0].get()['confirmations'] < 0):
+            return await self.list_since_block(await self.fork_point(blockhash), target_confirmations)
+        return results[-1].get()
+
+    async def fork_point(self, blockhash):
+        """
+        The closest main chain ancestor of blockhash, None when bitcoind does not know it
+        """
+        while blockhash is not None:
+            try:
+                header = await self.get_block_header(blockhash)
+            except InvalidAddressOrKeyError:
+                return None
+            if header['confirmations'] >= 0:
+                return blockhash
+            blockhash = header.get('previousblockhash')
+        return None
+
+    @try_robustly
+    async def get_peer_info(self):
+        return await self.call('getpeerinfo')
+
+    @try_robustly
+    async def get_wallet_info(self):
+        return await self.call('getwalletinfo')
+
+
+class AsyncStorageExecutor(StorageExecutor):
+    """
+    StorageExecutor for asyncio, coroutines queue operations through submit and the storage thread is a
+    ThreadPoolExecutor's
+    """
+    def __init__(self, db, name, group=None):
+        self.db = db
+        self.name = name
+        self.group = group or settings.BTD_SQLITE_GROUP_COMMIT
+        self.pool = ThreadPoolExecutor(1)
+        # (f, args, kwargs, write, Future) waiting for the next group
+        self.pending = []
+        self.wake = None
+        self.thread = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.wake = asyncio.Event()
+            self.task = asyncio.ensure_future(self.commit_forever())
+        return self.task
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.pool.shutdown(wait=False)
+
+    def run(self, f, args=(), kwargs=None, write=True):
+        if self.thread is not None and get_ident() == self.thread:
+            return f(*args, **(kwargs or {}))
+        raise RuntimeError("Storage is used from the event loop through AsyncBtdStorage.run")
+
+    async def submit(self, f, args=(), kwargs=None, write=True):
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((f, args, kwargs or {}, write, future))
+        self.wake.set()
+        return await future
+
+    async def commit_forever(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.pending:
+                ops, self.pending = self.pending[:self.group], self.pending[self.group:]
+                try:
+                    outcomes = await loop.run_in_executor(self.pool, self.run_group, ops)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.exception("Error running storage operations", exc_info=e)
+                    outcomes = [(None, e)] * len(ops)
+                group_ops.observe(len(ops), (self.name,))
+                for (_, _, _, _, future), (value, exception) in zip(ops, outcomes):
+                    if future.cancelled():
+                        continue
+                    if exception is None:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(exception)
+
+
+class AsyncBtdStorage(BtdStorage):
+    """
+    BtdStorage for asyncio, operations are awaited through run: await storage.run(storage.load_txs, txids)
+    Its methods are only called directly by code already running on the storage thread
+    """
+    Executor = AsyncStorageExecutor
+
+    async def run(self, f, *args, write=None, **kwargs):
+        """
+        Run f on the storage thread as one operation, write defaults to whether f is a writing storage_op
+        """
+        return await self.executor.submit(f, args, kwargs, getattr(f, 'write', True) if write is None else write)
+
+    async def close(self):
+        await self.run(self.db.close, write=False)
+        self.executor.close()
+
+
+class AsyncBtdPublisher(BtdPublisher):
+    """
+    BtdPublisher on a plain ZMQ socket whose batching timer runs on the event loop, sending on PUB never blocks
+    """
+    def __init__(self, endpoint=None, hwm=None, window=None, bind=True):
+        super().__init__(endpoint, hwm, window, bind, context=zmq.Context.instance())
+
+    def later(self, seconds, f):
+        return asyncio.get_event_loop().call_later(seconds, f)
+
+
+class AsyncEventLog(EventLog):
+    def later(self, seconds, f):
+        return asyncio.get_event_loop().call_later(seconds, f)
+
+
+class AsyncBtdListener(BtdListener):
+    """
+    BtdListener on zmq.asyncio and AsyncBitcoindRPC
+
+    Each step mirrors its BtdListener counterpart, awaiting RPC on the loop and running the shared synchronous parts
+    that touch storage on the storage thread.
+    """
+    def __init__(self, conf, rpc: AsyncBitcoindRPC=None, storage: AsyncBtdStorage=None,
+                 publisher: AsyncBtdPublisher=None, eventlog: AsyncEventLog=None):
+        if eventlog is None and settings.BTD_EVENTLOG:
+            eventlog = AsyncEventLog(conf)
+        super().__init__(conf, rpc or AsyncBitcoindRPC(conf), storage or AsyncBtdStorage(conf), publisher, eventlog)
+        self.queue = asyncio.Queue(settings.BTD_LISTEN_QUEUE_SIZE)
+        if self.webhooks is not None:
+            # WebhookDispatcher runs on gevent
+            log.warning("Webhooks are not delivered by AsyncBtdListener")
+            self.webhooks = None
+
+    async def listen_forever(self):
+        topics = self.topics()
+        if topics is None:
+            return
+
+        if self.publisher is None:
+            self.publisher = AsyncBtdPublisher()
+
+        await self.resume(raw=topics[0] == 'rawtx')
+
+        zmqSubSocket = self.subscribe(zmq.asyncio.Context.instance(), topics)
+
+        processor = asyncio.ensure_future(self.process_forever())
+        try:
+            await self.receive_forever(zmqSubSocket)
+        finally:
+            processor.cancel()
+
+    async def resume(self, raw=False):
+        if await self.storage.run(self.storage.get_state, self.tracker.TIP_HEIGHT) is None:
+            # Loading the tracker on the storage thread would ask bitcoind for the tip from there
+            info = await self.rpc.get_blockchain_info()
+            await self.storage.run(self.tracker.set_tip, info['bestblockhash'], info['blocks'])
+        await self.storage.run(self.restore, raw, write=False)
+        await self.broadcast_diffs(await self.storage.run(self.inflight_diffs, write=False))
+
+    async def receive_forever(self, zmqSubSocket):
+        while True:
+            try:
+                msg = await zmqSubSocket.recv_multipart()
+                self.stats['received'] += 1
+                try:
+                    self.queue.put_nowait((monotonic(), msg))
+                except asyncio.QueueFull:
+                    # Whatever was dropped is recovered by the next sync
+                    self.stats['dropped'] += 1
+                    self.missed = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("Uncaught exception during bitcoin ZMQ listen", exc_info=e)
+
+    async def process_forever(self):
+        while True:
+            received, msg = await self.queue.get()
+            listener_lag.observe(monotonic() - received, (self.conf.filename,))
+            msgs = [msg]
+            while True:
+                try:
+                    msgs.append(self.queue.get_nowait()[1])
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                await self.process(msgs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("Uncaught exception processing bitcoin ZMQ messages", exc_info=e)
+                # Their sequence numbers were consumed, make sure the next batch syncs
+                self.missed = True
+
+            # Let triggers accumulate so a burst costs one sync per interval
+            await asyncio.sleep(settings.BTD_PROCESS_INTERVAL)
+
+    @timed(listener_seconds, 'process')
+    async def process(self, msgs):
+        sync = self.missed
+        self.missed = False
+        txids = []
+
+        for msg in msgs:
+            topic = msg[0].decode()
+            log.debug("GOT MSG: {}".format(topic))
+
+            sync = self.sequence_gap(msg, topic) or sync
+
+            if topic == "hashtx":
+                txids.append(binascii.b2a_hex(msg[1]).decode())
+            elif topic == "hashblock":
+                sync = await self.handle_blockid(binascii.b2a_hex(msg[1]).decode()) or sync
+            elif topic == "rawtx":
+                sync = sync or await self.handle_rawtx(msg[1])
+            elif topic == "rawblock":
+                sync = await self.handle_rawblock(msg[1]) or sync
+
+        if txids and not sync:
+            sync = await self.handle_txids(txids)
+
+        self.stats['processed'] += len(msgs)
+        if sync:
+            self.stats['syncs'] += 1
+            self.stats['coalesced'] += len(msgs) - 1
+            await self.rebuild_tx()
+
+        # After the sync so transactions it moved between blocks are followed at their new height
+        await self.broadcast_milestones()
+
+        if self.seq != self.checkpointed_seq:
+            await self.storage.run(self.storage.set_states, self.checkpoint())
+
+    async def health(self):
+        health = dict(self.stats)
+        health['queue_depth'] = self.queue_depth()
+        health['sync_cursor'] = await self.storage.run(self.storage.get_state, self.SYNC_CURSOR)
+        health['tip_height'] = self.tracker.tip_height
+        return health
+
+    async def handle_txids(self, txids):
+        # Non wallet txids are left out by bitcoind
+        return bool(await self.rpc.get_transactions(txids))
+
+    async def handle_blockid(self, blockid, prev=None):
+        log.info("Got new block:{}".format(blockid))
+        height = None if prev is None else self.tracker.next_height(prev)
+        if height is None:
+            header = await self.rpc.get_block_header(blockid)
+            height, prev = header['height'], header.get('previousblockhash')
+
+        extends = await self.storage.run(self.tracker.advance, blockid, height, prev)
+        # Only bitcoind knows what a reorg changed and which mempool transactions the block mined
+        return not extends or bool(self.tracker.unconfirmed)
+
+    async def handle_rawtx(self, raw):
+        if self.watch.stale() or self.watch.bloom is not None:
+            # Loading addresses and confirming bloom filter hits read storage
+            return await self.storage.run(super().handle_rawtx, raw, write=False)
+        return super().handle_rawtx(raw)
+
+    async def handle_rawblock(self, raw):
+        # Only the header is needed to follow the tip
+        header = CBlockHeader.deserialize(raw[:80])
+        await self.storage.run(self.watch.load, write=False)
+        return await self.handle_blockid(b2lx(header.GetHash()), b2lx(header.hashPrevBlock))
+
+    @timed(listener_seconds, 'rebuild')
+    async def rebuild_tx(self):
+        cursor = await self.storage.run(self.storage.get_state, self.SYNC_CURSOR)
+        since = await self.rpc.list_since_block(cursor, settings.BTD_SYNC_CONFIRMATIONS)
+
+        log.info("Syncing {} transactions since block:{}".format(len(since['transactions']), cursor))
+
+        diffs = await self.storage.run(self.diff_since, since, write=False)
+        heights = await self.block_heights(diff.orig['blockhash'] for diff in diffs if 'blockhash' in diff.orig)
+        await self.storage.run(self.store_diffs, diffs, heights, since['lastblock'])
+
+        await self.broadcast_diffs(diffs)
+
+    async def block_heights(self, blockhashes):
+        """
+        ConfirmationTracker.block_heights with the missing headers fetched from the loop
+        """
+        blockhashes = set(blockhashes)
+        missing = [blockhash for blockhash in blockhashes if blockhash not in self.tracker.heights]
+        for blockhash, header in (await self.rpc.get_block_headers(missing)).items():
+            self.tracker.remember(blockhash, header['height'])
+        return dict((blockhash, self.tracker.heights.get(blockhash)) for blockhash in blockhashes)
+
+    @timed(listener_seconds, 'milestones')
+    async def broadcast_milestones(self):
+        reached = self.tracker.reached()
+        if reached:
+            await self.broadcast_diffs(await self.storage.run(self.milestone_diffs, reached))
+
+    async def broadcast_diffs(self, diffs):
+        for diff in diffs:
+            self.broadcast_diff(diff)
+        if diffs:
+            await self.storage.run(self.storage.set_state, self.INFLIGHT, None)
@@ -0,0 +1,89 @@
+from . import settings
+from . import bit2int
+from . import metrics
+
+from gevent import spawn, sleep
+from decimal import Decimal
+
+from logging import getLogger
+log = getLogger(__name__)
+
+balance_rebuilds = metrics.Counter('btd_balance_rebuilds_total',
+                                   'Balance aggregates rebuilt after drifting from the tx table', ('conf',))
+balance_mismatches = metrics.Counter('btd_balance_mismatches_total',
+                                     'Addresses whose received total differed from bitcoind at a reconciliation', ('conf',))
+
+
+def balance_contribution(amount, category, confirmations, blockheight):
+    """
+    (confirmed, unconfirmed) satoshis a tx row of amount satoshis adds to its address' received balance
+    """
+    if category != 'receive' or amount is None:
+        return 0, 0
+    if blockheight is not None:
+        return amount, 0
+    if confirmations == 0:
+        return 0, amount
+    # Conflicted
+    return 0, 0
+
+
+def sum_balances(rows):
+    """
+    Per addr_id [confirmed, unconfirmed] from (addr_id, amount, category, confirmations, blockheight) rows
+    """
+    balances = {}
+    for addr_id, amount, category, confirmations, blockheight in rows:
+        confirmed, unconfirmed = balance_contribution(amount, category, confirmations, blockheight)
+        if confirmed or unconfirmed:
+            balance = balances.setdefault(addr_id, [0, 0])
+            balance[0] += confirmed
+            balance[1] += unconfirmed
+    return balances
+
+
+class BalanceReconciler:
+    """
+    Periodically checks the balance aggregates against the tx table they are derived from, and the tx table against
+    bitcoind's received totals
+    """
+    def __init__(self, rpc, storage, interval=None):
+        self.rpc = rpc
+        self.storage = storage
+        self.interval = settings.BTD_BALANCE_RECONCILE_INTERVAL if interval is None else interval
+        self.greenlet = None
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.reconcile_forever)
+        return self.greenlet
+
+    def reconcile_forever(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                log.exception("Error reconciling balances", exc_info=e)
+
+    def reconcile(self):
+        """
+        Returns the addresses whose received total differs from bitcoind
+        """
+        filename = self.storage.conf.filename
+        drifted = self.storage.check_balances()
+        if drifted:
+            log.error("Balance aggregates of {} addresses drifted, rebuilding".format(len(drifted)))
+            balance_rebuilds.inc((filename,))
+            self.storage.rebuild_balances()
+
+        # Expected to differ briefly while the listener catches up with the wallet
+        received = self.rpc.list_address_amounts(0)
+        mismatched = []
+        for address, balance in self.storage.iter_address_balances():
+            if address in received and bit2int(Decimal(received[address])) != bit2int(balance.confirmed + balance.unconfirmed):
+                mismatched.append(address)
+        if mismatched:
+            log.warning("Received totals of {} addresses differ from bitcoind".format(len(mismatched)))
+            balance_mismatches.inc((filename,), len(mismatched))
+        return mismatched
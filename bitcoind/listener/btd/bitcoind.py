@@ -1,14 +1,22 @@
 from . import settings
 from . import int2bit, bit2int
 
-from bitcoin.rpc import Proxy, InWarmupError
+from bitcoin.rpc import Proxy, JSONRPCError, InWarmupError, InvalidAddressOrKeyError
 from bitcoin.core import b2lx, lx
-from http.client import CannotSendRequest, BadStatusLine
-from gevent import sleep
+from .pool import ConnectionPool
+from . import metrics
+from http.client import CannotSendRequest, BadStatusLine, HTTPException
+from gevent import sleep, spawn, joinall
+from gevent import subprocess as gsubprocess
+from gevent.event import Event
+from socket import create_connection
+from collections import OrderedDict
+from time import monotonic
+from functools import wraps
+from select import select
 
 import os
 from os import listdir, path, makedirs
-import subprocess
 import re
 import shutil
 
@@ -79,29 +87,118 @@ class BitcoindConf:
             shutil.rmtree(rtd)
 
 
-def start_bitcoind(conf: BitcoindConf):
-    log.info("Starting: {}".format(conf.filename))
-    # Create conf
-    # Check conf
-    # Check ports
-    # Write conf
-    # Connect to rpc
-    rpc = connect_rpc(conf)
+class NodeStartup:
+    """
+    Starts one bitcoind and times each phase: spawn, rpc_up, warmup_done and zmq_up
+
+    Readiness is re-probed with backoff, and straight away whenever bitcoind prints startup progress.
+    """
+    progress = re.compile(r'init message|Bound to|Binding RPC|[Zz][Mm][Qq]|Done loading')
+
+    def __init__(self, conf: BitcoindConf):
+        self.conf = conf
+        self.rpc = connect_rpc(conf)
+        self.process = None
+        self.started = None
+        self.timings = OrderedDict()
+        self.progressed = Event()
+
+    def mark(self, phase):
+        self.timings[phase] = monotonic() - self.started
+        log.info("bitcoind:{} {} after {:.3f}s".format(self.conf.filename, phase, self.timings[phase]))
+
+    def run(self):
+        log.info("Starting: {}".format(self.conf.filename))
+        self.started = monotonic()
+
+        log.info("Testing RPC connection: http://{}:{}".format(self.conf.conf['rpcbind'], self.conf.conf['rpcport']))
+        if not self.rpc_up():
+            log.info("Connection failed, starting bitcoind...")
+            self.process = gsubprocess.Popen(
+                ['bitcoind', '-conf={}'.format(self.conf.path()), "-datadir={}".format(self.conf.datadir())],
+                stdout=gsubprocess.PIPE, stderr=gsubprocess.STDOUT, preexec_fn=os.setsid)
+            spawn(self.follow_output)
+            self.mark('spawn')
+            self.wait_until(self.rpc_up)
+        self.mark('rpc_up')
+
+        self.wait_until(self.warmed_up)
+        self.mark('warmup_done')
+
+        endpoints = set(v for k, v in self.conf.conf.items() if k.startswith('zmqpub'))
+        if endpoints:
+            self.wait_until(lambda: all(zmq_endpoint_up(endpoint) for endpoint in endpoints))
+            self.mark('zmq_up')
+
+        log.info("Connection successful, bitcoind:{} is running".format(self.conf.filename))
+        return self.timings
+
+    def follow_output(self):
+        """
+        Relay bitcoind's console output, which also has to be drained for as long as it runs
+        """
+        for line in self.process.stdout:
+            line = line.decode(errors='replace').rstrip()
+            log.debug("bitcoind:{} {}".format(self.conf.filename, line))
+            if self.progress.search(line):
+                self.progressed.set()
+
+    def wait_until(self, ready):
+        delay = settings.BTD_STARTUP_POLL_MIN
+        while not ready():
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError("bitcoind:{} exited with:{}".format(self.conf.filename, self.process.returncode))
+            self.progressed.clear()
+            self.progressed.wait(delay)
+            delay = min(delay * 2, settings.BTD_STARTUP_POLL_MAX)
+
+    def probe(self):
+        # Bypasses try_robustly, which would sit out the warmup itself
+        return self.rpc.call_pooled(lambda rpc, p: p._call('getblockcount'))
+
+    def rpc_up(self):
+        try:
+            self.probe()
+        except (OSError, HTTPException):
+            return False
+        except InWarmupError:
+            pass
+        return True
+
+    def warmed_up(self):
+        try:
+            self.probe()
+        except (InWarmupError, OSError, HTTPException):
+            return False
+        return True
+
+
+def zmq_endpoint_up(endpoint):
+    scheme, _, address = endpoint.partition('://')
+    if scheme == 'ipc':
+        return path.exists(address)
+    host, _, port = address.rpartition(':')
     try:
-        log.info("Testing RPC connection: http://{}:{}".format(conf.conf['rpcbind'], conf.conf['rpcport']))
-        rpc.get_info()
-    except ConnectionRefusedError:
-        log.info("Connection failed, starting bitcoind...")
-        subprocess.Popen(['bitcoind', '-conf={}'.format(conf.path()), "-datadir={}".format(conf.datadir())], preexec_fn=os.setsid)
-        while True:
-            try:
-                rpc.get_info()
-                break
-            except ConnectionRefusedError:
-                log.info("Retrying...")
-                sleep(1)
+        create_connection((host, int(port)), timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+def start_bitcoind(conf: BitcoindConf):
+    return NodeStartup(conf).run()
 
-    log.info("Connection successful, bitcoind:{} is running".format(conf.filename))
+
+def start_nodes(confs):
+    """
+    Start every conf's bitcoind in parallel, returns phase timings per conf filename
+    """
+    startups = dict((filename, NodeStartup(conf)) for filename, conf in confs.items())
+    joinall([spawn(startup.run) for startup in startups.values()], raise_error=True)
+    for filename, startup in sorted(startups.items()):
+        log.info("bitcoind:{} started in {}".format(filename, ', '.join(
+            '{}={:.3f}s'.format(phase, t) for phase, t in startup.timings.items())))
+    return dict((filename, startup.timings) for filename, startup in startups.items())
 
 
 conn = {}
@@ -117,91 +214,296 @@ def connect_rpc(conf: BitcoindConf):
     return conn[conf.filename]
 
 
+rpc_seconds = metrics.Histogram('btd_rpc_seconds', 'bitcoind RPC latency including retries', ('conf', 'method'))
+rpc_errors = metrics.Counter('btd_rpc_errors_total', 'bitcoind RPC calls that raised', ('conf', 'method'))
+rpc_reconnects = metrics.Counter('btd_rpc_reconnects_total', 'Reconnections after a dropped bitcoind connection', ('conf',))
+rpc_warmup_retries = metrics.Counter('btd_rpc_warmup_retries_total', 'RPC retries while bitcoind was warming up', ('conf',))
+
+
 def try_robustly(f):
+    """
+    Runs f(self, p, ...) with a pooled proxy checked out for the duration of the call
+    """
+    @metrics.timed(rpc_seconds, f.__name__, rpc_errors)
+    @wraps(f)
     def attempt(self, *args, **kwargs):
         try:
             try:
-                return f(self, *args, **kwargs)
+                return self.call_pooled(f, *args, **kwargs)
             except (CannotSendRequest, BadStatusLine):
-                # Handle reconnection if a service restarts
+                # Handle reconnection if a service restarts, the broken connection was discarded
+                rpc_reconnects.inc((self.conf.filename,))
                 self.connect()
                 try:
-                    return f(self, *args, **kwargs)
+                    return self.call_pooled(f, *args, **kwargs)
                 except (CannotSendRequest, BadStatusLine):
                     log.error("Error sending request for {}, {}".format(args, kwargs))
         except InWarmupError:
+            delay = settings.BTD_STARTUP_POLL_MIN
             while True:
                 log.info("Bitcoin still warming up, retrying...")
-                sleep(5)
+                rpc_warmup_retries.inc((self.conf.filename,))
+                sleep(delay)
+                delay = min(delay * 2, settings.BTD_STARTUP_POLL_MAX)
                 try:
-                    return f(self, *args, **kwargs)
+                    return self.call_pooled(f, *args, **kwargs)
                 except InWarmupError:
                     continue
 
     return attempt
 
 
+def proxy_is_idle(p):
+    """
+    A pooled keep-alive connection should have nothing to read, otherwise bitcoind closed it
+    """
+    sock = p._BaseProxy__conn.sock
+    if sock is None:
+        # Not connected yet, connects on the next request
+        return True
+    readable, _, _ = select([sock], [], [], 0)
+    return not readable
+
+
+def close_proxy(p):
+    p._BaseProxy__conn.close()
+
+
+class BatchResult(object):
+    """
+    Placeholder for the result of a call queued in an RPCBatch
+    """
+    def __init__(self, convert=None):
+        self.convert = convert
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def set(self, response):
+        self.done = True
+        if response.get('error') is not None:
+            self.error = JSONRPCError(response['error'])
+        elif self.convert is not None:
+            self.result = self.convert(response['result'])
+        else:
+            self.result = response['result']
+
+    def get(self):
+        if not self.done:
+            raise RuntimeError("Batch has not been sent")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RPCBatch(object):
+    """
+    Collects calls and sends them to bitcoind as JSON-RPC batch arrays when the context exits
+    """
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.calls = []
+
+    def call(self, method, *params, convert=None):
+        result = BatchResult(convert)
+        self.calls.append((method, params, result))
+        return result
+
+    def send(self):
+        calls, self.calls = self.calls, []
+        for i in range(0, len(calls), settings.BTD_RPC_BATCH_SIZE):
+            chunk = calls[i:i + settings.BTD_RPC_BATCH_SIZE]
+            responses = self.rpc.send_batch([(method, params) for method, params, _ in chunk])
+            for (_, _, result), response in zip(chunk, responses):
+                result.set(response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.send()
+
+
 class BitcoindRPC(object):
-    p = None
+    pool = None
 
     def __init__(self, conf):
         self.conf = conf
-        self.connect()
-
-    def connect(self):
-        self.p = Proxy(service_url=('{}://{}:{}@{}:{}'.format(
+        self.pool = ConnectionPool(
+            self.create_proxy,
+            self.pool_size(),
+            max_idle=settings.BTD_RPC_POOL_IDLE,
+            check=proxy_is_idle,
+            close=close_proxy)
+
+    def pool_size(self):
+        # bitcoind only serves rpcthreads requests at once, default 4
+        return settings.BTD_RPC_POOL_SIZE or int(self.conf.conf.get('rpcthreads', 4))
+
+    def service_url(self):
+        return '{}://{}:{}@{}:{}'.format(
             'http',
             self.conf.conf['rpcuser'],
             self.conf.conf['rpcpassword'],
             self.conf.conf['rpcbind'],
-            self.conf.conf['rpcport'])))
+            self.conf.conf['rpcport'])
+
+    def create_proxy(self):
+        return Proxy(service_url=self.service_url())
+
+    def connect(self):
+        # Idle connections to a restarted service are stale as well
+        self.pool.clear()
+
+    def call_pooled(self, f, *args, **kwargs):
+        with self.pool.connection() as p:
+            return f(self, p, *args, **kwargs)
+
+    def batch(self):
+        """
+        :rtype: RPCBatch
+        """
+        return RPCBatch(self)
 
     @try_robustly
-    def get_info(self):
-        return self.p.getinfo()
+    def send_batch(self, p, calls):
+        responses = p._batch(
+            {'version': '1.1', 'method': method, 'params': list(params), 'id': i}
+            for i, (method, params) in enumerate(calls))
+
+        if isinstance(responses, dict):
+            # The whole batch was rejected
+            raise JSONRPCError(responses['error'])
+
+        responses = sorted(responses, key=lambda r: r['id'])
+        for response in responses:
+            error = response.get('error')
+            if error is not None and error['code'] == InWarmupError.RPC_ERROR_CODE:
+                # Let try_robustly retry the whole batch
+                raise JSONRPCError(error)
+
+        return responses
 
     @try_robustly
-    def create_address(self):
-        return str(self.p.getnewaddress())
+    def get_info(self, p):
+        return p.getinfo()
 
     @try_robustly
-    def get_address_balance(self, addr, minconf=0):
-        return int2bit(self.p.getreceivedbyaddress(addr, minconf=minconf))
+    def create_address(self, p):
+        return str(p.getnewaddress())
+
+    def create_addresses(self, n):
+        with self.batch() as b:
+            results = [b.call('getnewaddress') for _ in range(n)]
+        return [r.get() for r in results]
+
+    @try_robustly
+    def get_address_balance(self, p, addr, minconf=0):
+        return int2bit(p.getreceivedbyaddress(addr, minconf=minconf))
 
     @try_robustly
-    def list_address_amounts(self, minconf=0, include_empty=True):
+    def list_address_amounts(self, p, minconf=0, include_empty=True):
         # TODO: PR
-        addresses = self.p._call('listreceivedbyaddress', minconf, include_empty)
+        addresses = p._call('listreceivedbyaddress', minconf, include_empty)
         return dict((a['address'], a['amount']) for a in addresses if a['confirmations'] >= minconf)
 
     @try_robustly
-    def send(self, addr, amount):
-        return b2lx(self.p.sendtoaddress(addr, bit2int(amount)))
+    def send(self, p, addr, amount):
+        return b2lx(p.sendtoaddress(addr, bit2int(amount)))
+
+    @metrics.timed(rpc_seconds, 'send_many', rpc_errors)
+    def send_many(self, amounts, comment=''):
+        """
+        Pay amounts (address -> amount) in one transaction
+        Not retried after a dropped connection, the wallet may have sent it already
+        """
+        return self.call_pooled(lambda rpc, p: b2lx(p.sendmany(
+            '', dict((addr, bit2int(amount)) for addr, amount in amounts.items()), comment=comment)))
 
     @try_robustly
-    def get_transaction(self, txid):
-        return self.p.gettransaction(lx(txid))
+    def get_transaction(self, p, txid):
+        return p.gettransaction(lx(txid))
+
+    def get_transactions(self, txids):
+        """
+        Fetch many wallet transactions in one round trip, skipping non wallet txids
+        """
+        with self.batch() as b:
+            results = [(txid, b.call('gettransaction', txid)) for txid in txids]
+
+        txs = {}
+        for txid, result in results:
+            if isinstance(result.error, InvalidAddressOrKeyError):
+                continue
+            txs[txid] = result.get()
+        return txs
 
     @try_robustly
-    def get_block(self, blockid):
-        return self.p.getblock(lx(blockid))
+    def get_block(self, p, blockid):
+        return p.getblock(lx(blockid))
 
     @try_robustly
-    def get_blockchain_info(self):
-        return self.p._call('getblockchaininfo')
+    def get_blockchain_info(self, p):
+        return p._call('getblockchaininfo')
 
     @try_robustly
-    def generate(self, numblocks):
-        return self.p.generate(numblocks)
+    def get_block_header(self, p, blockhash):
+        return p._call('getblockheader', blockhash)
+
+    def get_block_headers(self, blockhashes):
+        """
+        Fetch many block headers in one round trip, skipping unknown blocks
+        """
+        with self.batch() as b:
+            results = [(blockhash, b.call('getblockheader', blockhash)) for blockhash in blockhashes]
+
+        headers = {}
+        for blockhash, result in results:
+            if isinstance(result.error, InvalidAddressOrKeyError):
+                continue
+            headers[blockhash] = result.get()
+        return headers
 
     @try_robustly
-    def list_transactions(self, count=10, skip=0):
-        return self.p._call('listtransactions', '*', count, skip)
+    def generate(self, p, numblocks):
+        return p.generate(numblocks)
+
+    @try_robustly
+    def list_transactions(self, p, count=10, skip=0):
+        return p._call('listtransactions', '*', count, skip)
+
+    def list_since_block(self, blockhash=None, target_confirmations=1):
+        """
+        listsinceblock from where blockhash forks off the main chain, every wallet transaction when it is None or unknown
+        bitcoind before 0.17 counts a reorged out block's depth from its own height and newer ones reject unknown blocks,
+        so the cursor's header (bitcoind 0.12+) comes in the same round trip and the listing is redone when it is off chain
+        """
+        with self.batch() as b:
+            header = b.call('getblockheader', blockhash) if blockhash else None
+            since = b.call('listsinceblock', blockhash or '', target_confirmations)
+        if header is not None and (header.error is not None or header.get()['confirmations'] < 0):
+            return self.list_since_block(self.fork_point(blockhash), target_confirmations)
+        return since.get()
+
+    def fork_point(self, blockhash):
+        """
+        The closest main chain ancestor of blockhash, None when bitcoind does not know it
+        """
+        while blockhash is not None:
+            try:
+                header = self.get_block_header(blockhash)
+            except InvalidAddressOrKeyError:
+                return None
+            if header['confirmations'] >= 0:
+                return blockhash
+            blockhash = header.get('previousblockhash')
+        return None
 
     @try_robustly
-    def get_peer_info(self):
-        return self.p._call('getpeerinfo')
+    def get_peer_info(self, p):
+        return p._call('getpeerinfo')
 
     @try_robustly
-    def get_wallet_info(self):
-        return self.p._call('getwalletinfo')
+    def get_wallet_info(self, p):
+        return p._call('getwalletinfo')
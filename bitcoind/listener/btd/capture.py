@@ -0,0 +1,197 @@
+"""
+Recording of the traffic a listener sees, replayed offline by bench.replay
+
+A capture is a gzip stream of records: kind B, seconds since the capture started d, payload length I, payload.
+ZMQ payloads are the multipart frames each prefixed with its length I. RPC payloads are JSON
+{method, params, response, seconds} per call, calls sent in one batch being recorded one by one. A STATE record holds
+the checkpoint the listener resumed from, so a replay starts at the same cursor, tip and sequence numbers.
+"""
+from gevent import spawn_later
+from bitcoin.rpc import Proxy, JSONRPCError
+
+from . import settings
+from .bitcoind import BitcoindRPC
+
+import gzip
+import json
+import os
+import struct
+from decimal import Decimal
+from os import path
+from time import monotonic, time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+MAGIC = b'BTDCAP1\n'
+STATE, ZMQ, RPC = 1, 2, 3
+
+record_header = struct.Struct('<BdI')
+frame_length = struct.Struct('<I')
+
+
+def encode_json(o):
+    if isinstance(o, Decimal):
+        # Amounts are read back exactly, not as floats
+        return {'__decimal__': str(o)}
+    raise TypeError(repr(o))
+
+
+def decode_json(o):
+    if len(o) == 1 and '__decimal__' in o:
+        return Decimal(o['__decimal__'])
+    return o
+
+
+def encode_frames(frames):
+    return b''.join(frame_length.pack(len(frame)) + frame for frame in frames)
+
+
+def decode_frames(payload):
+    frames = []
+    offset = 0
+    while offset < len(payload):
+        length, = frame_length.unpack_from(payload, offset)
+        offset += frame_length.size
+        frames.append(payload[offset:offset + length])
+        offset += length
+    return frames
+
+
+def decode_payload(kind, payload):
+    if kind == ZMQ:
+        return decode_frames(payload)
+    return json.loads(payload.decode(), object_hook=decode_json)
+
+
+def read_capture(filename):
+    """
+    Yields (kind, seconds since the capture started, payload) of every record
+    A capture cut off by a crash is read up to its last flush
+    """
+    with gzip.open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a btd capture".format(filename))
+        try:
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    break
+                kind, at, length = record_header.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield kind, at, decode_payload(kind, payload)
+        except EOFError:
+            log.warning("Capture {} is truncated, replaying what was flushed".format(filename))
+
+
+class Capture:
+    """
+    Appends records to a capture file, for BTD_CAPTURE_SECONDS after it was opened
+    """
+    def __init__(self, filename, seconds=None):
+        self.filename = filename
+        self.seconds = settings.BTD_CAPTURE_SECONDS if seconds is None else seconds
+        self.started = monotonic()
+        self.records = 0
+        self.flusher = None
+        # Fast compression, a capture is written from the hub
+        self.file = gzip.open(filename, 'wb', compresslevel=1)
+        self.file.write(MAGIC)
+
+    @classmethod
+    def create(cls, conf):
+        os.makedirs(settings.BTD_CAPTURE_DIR, exist_ok=True)
+        filename = path.join(settings.BTD_CAPTURE_DIR, '{}-{}.btdcap'.format(conf.filename, int(time())))
+        log.info("Capturing listener traffic of conf:{} to {}".format(conf.filename, filename))
+        return cls(filename)
+
+    def record(self, kind, payload, at=None):
+        if self.file is None:
+            return
+        at = monotonic() - self.started if at is None else at
+        if self.seconds is not None and at > self.seconds:
+            log.info("Captured {} records in {}s to {}, stopping".format(self.records, self.seconds, self.filename))
+            self.close()
+            return
+
+        self.file.write(record_header.pack(kind, at, len(payload)))
+        self.file.write(payload)
+        self.records += 1
+        if self.flusher is None:
+            self.flusher = self.later(settings.BTD_CAPTURE_FLUSH_INTERVAL, self.flush_later)
+
+    def state(self, state):
+        self.record(STATE, json.dumps(state).encode())
+
+    def zmq(self, msg):
+        self.record(ZMQ, encode_frames(msg))
+
+    def rpc(self, started, method, params, response):
+        """
+        Recorded at the time the call was made, with the seconds bitcoind took to answer
+        """
+        self.record(RPC, json.dumps({
+            'method': method,
+            'params': list(params),
+            'response': {'result': response.get('result'), 'error': response.get('error')},
+            'seconds': monotonic() - started,
+        }, default=encode_json).encode(), started - self.started)
+
+    def later(self, seconds, f):
+        return spawn_later(seconds, f)
+
+    def flush_later(self):
+        self.flusher = None
+        self.flush()
+
+    def flush(self):
+        if self.file is not None:
+            # A sync flush, everything written so far can be read even if the process dies
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RecordingProxy(Proxy):
+    """
+    Proxy recording the JSON-RPC responses behind every call, before python-bitcoinlib converts them
+    """
+    def __init__(self, capture, **kwargs):
+        super().__init__(**kwargs)
+        self.capture = capture
+
+    def _call(self, service_name, *args):
+        started = monotonic()
+        try:
+            result = super()._call(service_name, *args)
+        except JSONRPCError as e:
+            self.capture.rpc(started, service_name, args, {'error': e.error})
+            raise
+        self.capture.rpc(started, service_name, args, {'result': result})
+        return result
+
+    def _batch(self, rpc_call_list):
+        calls = list(rpc_call_list)
+        started = monotonic()
+        responses = super()._batch(calls)
+        if isinstance(responses, list):
+            responses_by_id = dict((response.get('id'), response) for response in responses)
+            for call in calls:
+                response = responses_by_id.get(call['id'])
+                if response is not None:
+                    self.capture.rpc(started, call['method'], call['params'], response)
+        return responses
+
+
+class RecordingRPC(BitcoindRPC):
+    def __init__(self, conf, capture: Capture):
+        self.capture = capture
+        super().__init__(conf)
+
+    def create_proxy(self):
+        return RecordingProxy(self.capture, service_url=self.service_url())
@@ -0,0 +1,148 @@
+from . import settings
+
+from collections import OrderedDict
+import heapq
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class ConfirmationTracker:
+    """
+    Follows the chain tip and computes confirmations locally as tip - blockheight + 1
+
+    Mined wallet transactions are pushed on a heap keyed by the height each milestone is reached at, so a block only
+    costs the milestones it reaches. Blocks that do not extend the tracked tip (reorgs, missed blocks) and blocks that
+    may have mined a wallet transaction from the mempool still need a sync from bitcoind.
+    """
+    TIP_HASH = 'tip_hash'
+    TIP_HEIGHT = 'tip_height'
+
+    def __init__(self, rpc, storage, milestones=None):
+        self.rpc = rpc
+        self.storage = storage
+        self.milestones = sorted(settings.BTD_CONFIRMATION_MILESTONES if milestones is None else milestones)
+        self.tip_hash = None
+        self.tip_height = None
+        # blockhash -> height of recently seen blocks
+        self.heights = OrderedDict()
+        # (target height, txid, blockhash, confirmations)
+        self.heap = []
+        # txid -> (blockhash, blockheight) of transactions with milestones left
+        self.tracked = {}
+        # Wallet txids still in the mempool, a block may have mined them
+        self.unconfirmed = set()
+        self.loaded = False
+
+    def load(self, txs=None):
+        """
+        Resume from the persisted tip, txs being (txid, blockhash, blockheight, confirmations) of every transaction
+        """
+        self.tip_hash = self.storage.get_state(self.TIP_HASH)
+        tip_height = self.storage.get_state(self.TIP_HEIGHT)
+        self.tip_height = None if tip_height is None else int(tip_height)
+        if self.tip_height is None:
+            self.load_tip()
+
+        self.unconfirmed = set()
+        self.heap = []
+        self.tracked = {}
+        # No milestones, nothing to track, mempool transactions are still followed to trigger syncs
+        min_height = self.tip_height - self.milestones[-1] + 1 if self.milestones else None
+        for txid, blockhash, blockheight, confirmations in self.storage.iter_tx_states() if txs is None else txs:
+            if blockheight is None:
+                if blockhash is None and confirmations == 0:
+                    self.unconfirmed.add(txid)
+            elif min_height is not None and blockheight >= min_height:
+                self.track(txid, blockhash, blockheight)
+        self.loaded = True
+
+    def load_tip(self):
+        info = self.rpc.get_blockchain_info()
+        self.set_tip(info['bestblockhash'], info['blocks'])
+
+    def set_tip(self, blockhash, height):
+        self.tip_hash = blockhash
+        self.tip_height = height
+        self.remember(blockhash, height)
+        self.storage.set_states({self.TIP_HASH: blockhash, self.TIP_HEIGHT: height})
+
+    def remember(self, blockhash, height):
+        self.heights[blockhash] = height
+        while len(self.heights) > settings.BTD_CONFIRMATION_HEIGHT_CACHE:
+            self.heights.popitem(last=False)
+
+    def next_height(self, prev):
+        """
+        Height of a block whose parent is prev, None when that is not known locally
+        """
+        if self.tip_hash is not None and prev == self.tip_hash:
+            return self.tip_height + 1
+        return self.heights[prev] + 1 if prev in self.heights else None
+
+    def advance(self, blockhash, height, prev):
+        """
+        Move the tip to a new block, returns whether it extends the previous tip
+        """
+        if not self.loaded:
+            self.load()
+        extends = self.tip_hash is not None and prev == self.tip_hash and height == self.tip_height + 1
+        self.set_tip(blockhash, height)
+        return extends
+
+    def block_heights(self, blockhashes):
+        """
+        Heights of blockhashes, asking bitcoind for the blocks not seen recently
+        """
+        blockhashes = set(blockhashes)
+        missing = [blockhash for blockhash in blockhashes if blockhash not in self.heights]
+        for blockhash, header in self.rpc.get_block_headers(missing).items():
+            self.remember(blockhash, header['height'])
+        return dict((blockhash, self.heights.get(blockhash)) for blockhash in blockhashes)
+
+    def update(self, tx_dats, heights):
+        """
+        Follow the block each stored transaction is in now
+        """
+        if not self.loaded:
+            self.load()
+        for tx_dat in tx_dats:
+            txid = tx_dat['txid']
+            blockhash = tx_dat.get('blockhash')
+            if blockhash is None:
+                self.tracked.pop(txid, None)
+                if tx_dat['confirmations'] == 0:
+                    self.unconfirmed.add(txid)
+                else:
+                    # Conflicted, no block will confirm it
+                    self.unconfirmed.discard(txid)
+            else:
+                self.unconfirmed.discard(txid)
+                self.track(txid, blockhash, heights[blockhash])
+
+    def track(self, txid, blockhash, blockheight):
+        if blockheight is None or self.tracked.get(txid) == (blockhash, blockheight):
+            return
+        self.tracked.pop(txid, None)
+        for confirmations in self.milestones:
+            target = blockheight + confirmations - 1
+            if target > self.tip_height:
+                heapq.heappush(self.heap, (target, txid, blockhash, confirmations))
+                self.tracked[txid] = (blockhash, blockheight)
+
+    def reached(self):
+        """
+        Pop the milestones reached at the current tip, (txid, confirmations) in height order
+        """
+        reached = OrderedDict()
+        while self.heap and self.heap[0][0] <= self.tip_height:
+            target, txid, blockhash, confirmations = heapq.heappop(self.heap)
+            tracked = self.tracked.get(txid)
+            if tracked is None or tracked[0] != blockhash:
+                # Reorged out or moved to another block since it was pushed
+                continue
+            # Milestones passed together, after missed blocks, are reported once
+            reached[txid] = self.tip_height - tracked[1] + 1
+            if confirmations == self.milestones[-1]:
+                del self.tracked[txid]
+        return list(reached.items())
@@ -1,7 +1,24 @@
 import zmq.green as zmq
+from gevent import spawn, sleep
+from gevent.queue import Queue, Full, Empty
+from bitcoin.core import CBlockHeader, b2lx
 
-from .bitcoind import BitcoindRPC, BitcoindConf
+from .bitcoind import BitcoindRPC, BitcoindConf, connect_rpc
+from .migrations import migrate, query_plan_scans, compacted
+from .addrpool import AddressPool
+from .payout import PayoutQueue
+from .balance import BalanceReconciler, balance_contribution, sum_balances
+from .watch import WatchIndex, decode_tx, tx_txid
+from .publisher import BtdPublisher, connect_publisher, encode_txinfo, decode_record
+from .eventlog import EventLog
+from .confirmations import ConfirmationTracker
+from .capture import Capture, RecordingRPC
+from .webhook import WebhookDispatcher
+from .cache import LRUCache
+from .executor import StorageExecutor, GroupedConnection, storage_op
+from . import metrics
 from . import settings
+from . import int2bit, bit2int
 
 import struct
 from hashlib import md5
@@ -12,120 +29,617 @@ log = getLogger(__name__)
 
 import binascii
 import sqlite3
+import zlib
 from datetime import datetime
-from dateutil.parser import parse as dateutil_parse
-from collections import namedtuple
+from collections import namedtuple, Counter, OrderedDict
 from os import path
 import json
 
 from uuid import uuid4
+from time import monotonic, time
+
+sqlite_seconds = metrics.Histogram('btd_sqlite_seconds', 'SQLite query latency including commits', ('conf', 'query'))
+listener_seconds = metrics.Histogram('btd_listener_seconds', 'Listener stage latency', ('conf', 'stage'))
+listener_lag = metrics.Histogram('btd_listener_lag_seconds',
+                                 'Time the oldest message of a batch waited between ZMQ receive and processing', ('conf',))
+
+
+def tx_key(tx_dat):
+    """
+    A transaction is stored and diffed per output and category, listsinceblock reports a tx paying two wallet
+    addresses, or sending to the wallet itself, as several entries
+    """
+    return tx_dat['txid'], tx_dat.get('vout'), tx_dat['category']
 
 
 class BtdStorage:
     AddrRow = namedtuple('addr', 'rowid address context contexthash created modified')
-    TxRow = namedtuple('tx', 'rowid uuid txid addr_id amount confirmations orig silenced created modified')
+    # Amounts in satoshis, timestamps in epoch seconds
+    TxRow = namedtuple('tx', 'rowid uuid txid addr_id amount confirmations orig silenced created modified'
+                             ' blockhash blockheight category vout')
+    Balance = namedtuple('balance', 'confirmed unconfirmed')
+    ConfirmingRow = namedtuple('confirming', 'txid amount orig blockheight address context')
+    Executor = StorageExecutor
+
+    SQL_TX_AMOUNT = compacted('tx', 'amount_sat')
+    SQL_TX_COLUMNS = ('rowid', 'uuid', 'txid', 'addr_id', SQL_TX_AMOUNT, 'confirmations', 'orig', 'silenced',
+                      compacted('tx', 'created_ts'), compacted('tx', 'modified_ts'), 'blockhash', 'blockheight', 'category',
+                      'vout')
+
+    SQL_UNUSED_ADDRESS = ('SELECT address FROM addr'
+                          ' LEFT JOIN tx ON tx.addr_id = addr.rowid'
+                          ' WHERE addr.contexthash=? AND tx.addr_id IS NULL'
+                          ' LIMIT 1')
+    SQL_CONTEXTHASH = 'SELECT contexthash FROM addr WHERE address=?'
+    SQL_CTX = 'SELECT data, compressed FROM ctx WHERE hash=?'
+    SQL_ADDRESS_ROWID = 'SELECT rowid FROM addr WHERE address=?'
+    SQL_POOL_ADDRESS = 'SELECT rowid, address FROM addr WHERE pooled=1 LIMIT 1'
+    SQL_LOAD_TXS = 'SELECT {} FROM tx WHERE txid IN ({{}})'.format(', '.join(SQL_TX_COLUMNS))
+    # The legacy columns are cleared so a row converted by btd.migrate and then rewritten reads the new values
+    SQL_UPDATE_TX = ('UPDATE tx SET'
+                     ' addr_id=?, amount_sat=?, amount=NULL, confirmations=?, orig=?, silenced=?, modified_ts=?,'
+                     ' modified=NULL, blockhash=?, blockheight=?, category=?'
+                     ' WHERE txid=? AND vout IS ? AND category=?')
+    SQL_INSERT_TX = ('INSERT INTO tx (uuid, txid, vout, category, addr_id, amount_sat, confirmations, orig, silenced,'
+                     ' created_ts, modified_ts, blockhash, blockheight)'
+                     ' SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?'
+                     ' WHERE NOT EXISTS (SELECT 1 FROM tx WHERE txid=? AND vout IS ? AND category=?)')
+    SQL_BALANCE_ROWS = ('SELECT txid, vout, category, addr_id, ' + SQL_TX_AMOUNT + ', confirmations, blockheight FROM tx'
+                        ' WHERE txid IN ({})')
+    SQL_ADDRESS_BALANCE = ('SELECT b.confirmed, b.unconfirmed FROM addr'
+                           ' JOIN addr_balance b ON b.addr_id = addr.rowid WHERE addr.address=?')
+    SQL_CONTEXT_BALANCE = 'SELECT confirmed, unconfirmed FROM ctx_balance WHERE contexthash=?'
+    SQL_LOAD_CONFIRMING = ('SELECT tx.txid, ' + SQL_TX_AMOUNT + ', tx.orig, tx.blockheight, addr.address, addr.contexthash FROM tx'
+                           ' JOIN addr ON addr.rowid = tx.addr_id'
+                           ' WHERE tx.txid IN ({})')
 
     def __init__(self, conf: BitcoindConf):
         self.conf = conf
-        self.db = sqlite3.connect(path.join(settings.BTD_SQLITE_DIR, conf.filename + '.sqlite'), detect_types=sqlite3.PARSE_DECLTYPES)
-        self.db.execute('CREATE TABLE IF NOT EXISTS addr ('
-                        'id INTEGER PRIMARY KEY,'
-                        'address VARCHAR(34) UNIQUE,'
-                        'context BLOB NULL,'
-                        'contexthash VARCHAR(32) NULL,'
-                        'created DATETIME,'
-                        'modified DATETIME)')
-        self.db.execute('CREATE TABLE IF NOT EXISTS tx ('
-                        'id INTEGER PRIMARY KEY,'
-                        'uuid VARCHAR(36),'
-                        'txid VARCHAR(64),'
-                        'addr_id INTEGER,'
-                        'amount DECIMAL,'
-                        'confirmations INTEGER,'
-                        'orig BLOB,'
-                        'silenced BOOL,'
-                        'created DATETIME,'
-                        'modified DATETIME,'
-                        'FOREIGN KEY (addr_id) REFERENCES addr(id))')
+        # address -> contexthash, contexthash -> context, context -> contexthash
+        # Only this process' writes invalidate them, an address is not expected to change context once handed out
+        self.address_contexts = LRUCache(settings.BTD_CONTEXT_CACHE_SIZE)
+        self.contexts = LRUCache(settings.BTD_CONTEXT_CACHE_SIZE)
+        self.context_hashes = LRUCache(settings.BTD_CONTEXT_CACHE_SIZE)
+        # Columns hold plain integers and strings, rows are decoded without declared type converters
+        # Transactions are managed by the executor, whose thread uses the connection once it is set up
+        db = sqlite3.connect(path.join(settings.BTD_SQLITE_DIR, conf.filename + '.sqlite'),
+                             isolation_level=None, check_same_thread=False)
+        # WAL with synchronous=NORMAL only fsyncs on checkpoint, not on every commit
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(settings.BTD_SQLITE_SYNCHRONOUS))
+        db.execute('PRAGMA cache_size=-{}'.format(settings.BTD_SQLITE_CACHE_KB))
+        migrate(db)
+
+        for name, detail in query_plan_scans(db, self.hot_queries()):
+            log.warning("Query {} regressed to a table scan: {}".format(name, detail))
+
+        self.db = GroupedConnection(db)
+        self.executor = self.Executor(db, conf.filename)
+
+    @classmethod
+    def hot_queries(cls):
+        return (
+            ('unused_address', cls.SQL_UNUSED_ADDRESS, ('',)),
+            ('contexthash', cls.SQL_CONTEXTHASH, ('',)),
+            ('ctx', cls.SQL_CTX, ('',)),
+            ('address_rowid', cls.SQL_ADDRESS_ROWID, ('',)),
+            ('pool_address', cls.SQL_POOL_ADDRESS, ()),
+            ('load_txs', cls.SQL_LOAD_TXS.format('?'), ('',)),
+            ('update_tx', cls.SQL_UPDATE_TX, (0, 0, 0, '', False, '', '', 0, '', '', 0, '')),
+            ('insert_tx', cls.SQL_INSERT_TX, ('', '', 0, '', 0, 0, 0, '', False, '', '', '', 0, '', 0, '')),
+            ('balance_rows', cls.SQL_BALANCE_ROWS.format('?'), ('',)),
+            ('address_balance', cls.SQL_ADDRESS_BALANCE, ('',)),
+            ('context_balance', cls.SQL_CONTEXT_BALANCE, ('',)),
+            ('load_confirming', cls.SQL_LOAD_CONFIRMING.format('?'), ('',)),
+        )
 
+    @metrics.timed(sqlite_seconds, 'get_state')
+    @storage_op(write=False)
+    def get_state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    @metrics.timed(sqlite_seconds, 'set_state')
+    @storage_op()
+    def set_state(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+        self.db.commit()
+
+    @storage_op()
+    def set_states(self, state):
+        with self.db:
+            self.write_states(state)
+
+    def write_states(self, state):
+        # Does not commit
+        self.db.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', state.items())
+
+    @metrics.timed(sqlite_seconds, 'lookup_unused_address')
+    @storage_op(write=False)
     def lookup_unused_address(self, context):
-        contexthash = self.hash_context(context)
+        contexthash = self.context_hash(context)
 
-        return self.db.execute(
-            'SELECT address FROM addr'
-            ' LEFT JOIN tx ON tx.addr_id = addr.rowid'
-            ' WHERE addr.contexthash=? AND tx.addr_id IS NULL'
-            ' LIMIT 1', contexthash).fetchone()
+        row = self.db.execute(self.SQL_UNUSED_ADDRESS, (contexthash,)).fetchone()
+        return None if row is None else row[0]
 
+    @metrics.timed(sqlite_seconds, 'lookup_context')
+    @storage_op(write=False)
     def lookup_context(self, address):
-        return self.db.execute(
-            'SELECT context FROM addr WHERE address=?', address).fetchone()
+        contexthash = self.address_contexts.get(address)
+        if contexthash is None:
+            row = self.db.execute(self.SQL_CONTEXTHASH, (address,)).fetchone()
+            if row is None or row[0] is None:
+                # Not cached, another process may give the address a context
+                return None
+            contexthash = row[0]
+            self.address_contexts.put(address, contexthash)
+        return self.get_context(contexthash)
+
+    def get_context(self, contexthash):
+        if contexthash is None:
+            return None
+        context = self.contexts.get(contexthash)
+        if context is None:
+            row = self.db.execute(self.SQL_CTX, (contexthash,)).fetchone()
+            if row is None:
+                return None
+            data, compressed = row
+            context = zlib.decompress(data) if compressed else bytes(data)
+            self.contexts.put(contexthash, context)
+        return context
+
+    def store_context(self, context):
+        """
+        Insert context into ctx unless already there, returns its hash
+        Does not commit
+        """
+        contexthash = self.context_hash(context)
+        if contexthash not in self.contexts:
+            data, compressed = self.compress_context(context)
+            self.db.execute('INSERT OR IGNORE INTO ctx (hash, data, compressed) VALUES (?, ?, ?)',
+                            (contexthash, data, compressed))
+            self.contexts.put(contexthash, context)
+        return contexthash
+
+    @staticmethod
+    def compress_context(context):
+        threshold = settings.BTD_CONTEXT_COMPRESS_BYTES
+        if threshold is not None and len(context) >= threshold:
+            compressed = zlib.compress(context)
+            if len(compressed) < len(context):
+                return compressed, True
+        return context, False
 
+    def context_hash(self, context):
+        """
+        Memoized hash_context, contexts handed out by the caches are found again without hashing their bytes
+        """
+        contexthash = self.context_hashes.get(context)
+        if contexthash is None:
+            contexthash = self.hash_context(context)
+            self.context_hashes.put(context, contexthash)
+        return contexthash
+
+    @storage_op()
     def get_address_rowid(self, address):
-        rowid = self.db.execute('SELECT rowid FROM addr WHERE address=?', address).fetchone()
-        if rowid is None:
+        row = self.db.execute(self.SQL_ADDRESS_ROWID, (address,)).fetchone()
+        if row is None:
             self.store_address(address)
-            rowid = self.db.execute('SELECT rowid FROM addr WHERE address=?', address).fetchone()
-        return rowid
+            row = self.db.execute(self.SQL_ADDRESS_ROWID, (address,)).fetchone()
+        return row[0]
 
+    @metrics.timed(sqlite_seconds, 'store_address')
+    @storage_op()
     def store_address(self, address, context=None):
+        contexthash = self.store_context(context) if context is not None else None
+        self.write_address(address, contexthash, int(time()))
+        self.db.commit()
+        return address
+
+    def write_address(self, address, contexthash, now):
+        # Does not commit
         c = self.db.cursor()
-        contexthash = self.hash_context(context) if context is not None else None
-        now = datetime.now()
+        row = c.execute('SELECT rowid, contexthash FROM addr WHERE address=?', (address,)).fetchone()
+        if row is not None and row[1] != contexthash:
+            self.move_context_balance(row[0], row[1], contexthash)
         c.execute('UPDATE addr SET'
-                  ' context=?, contexthash=?, modified=? WHERE addr=?',
-                  (context, contexthash, now, address))
-        c.execute('INSERT INTO addr (addr, context, contexthash, created, modified)'
-                  ' SELECT ?, ?, ?, ?, ? WHERE (SELECT Changes() = 0)',
-                  (address, context, contexthash, now, now))
-        self.db.commit()
+                  ' contexthash=?, pooled=0, modified_ts=?, modified=NULL WHERE address=?',
+                  (contexthash, now, address))
+        c.execute('INSERT INTO addr (address, contexthash, created_ts, modified_ts)'
+                  ' SELECT ?, ?, ?, ? WHERE (SELECT Changes() = 0)',
+                  (address, contexthash, now, now))
         c.close()
-        return address
+        self.address_contexts.invalidate(address)
+
+    @metrics.timed(sqlite_seconds, 'queue_payout')
+    @storage_op()
+    def queue_payout(self, uuid, address, amount, context):
+        now = int(time())
+        with self.db:
+            contexthash = self.store_context(context) if context is not None else None
+            self.db.execute('INSERT INTO payout (uuid, address, amount_sat, contexthash, state, created_ts, modified_ts)'
+                            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (uuid, address, bit2int(amount), contexthash, 'queued', now, now))
+
+    @metrics.timed(sqlite_seconds, 'start_payout_batch')
+    @storage_op()
+    def start_payout_batch(self, batch, uuids):
+        """
+        Mark queued payouts as sending under batch and store their addresses' contexts, in one transaction
+        """
+        now = int(time())
+        with self.db:
+            self.db.executemany('UPDATE payout SET state=?, batch=?, modified_ts=?, modified=NULL WHERE uuid=?',
+                                (('sending', batch, now, uuid) for uuid in uuids))
+            for address, contexthash in self.db.execute('SELECT address, contexthash FROM payout WHERE batch=?',
+                                                        (batch,)).fetchall():
+                self.write_address(address, contexthash, now)
+
+    @storage_op()
+    def finish_payout_batch(self, batch, txid=None, error=None):
+        with self.db:
+            self.db.execute('UPDATE payout SET state=?, txid=?, error=?, modified_ts=?, modified=NULL WHERE batch=?',
+                            ('sent' if txid else 'failed', txid, error, int(time()), batch))
+
+    @storage_op()
+    def requeue_payout_batch(self, batch):
+        with self.db:
+            self.db.execute('UPDATE payout SET state=?, batch=NULL, modified_ts=?, modified=NULL WHERE batch=?',
+                            ('queued', int(time()), batch))
+
+    @storage_op(write=False)
+    def iter_payouts(self, state):
+        """
+        (uuid, address, amount, batch, modified) of payouts in state, oldest first
+        """
+        return [(uuid, address, int2bit(amount), batch, modified)
+                for uuid, address, amount, batch, modified in self.db.execute(
+                    'SELECT uuid, address, {}, batch, {} FROM payout WHERE state=? ORDER BY id'.format(
+                        compacted('payout', 'amount_sat'), compacted('payout', 'modified_ts')), (state,))]
 
+    @metrics.timed(sqlite_seconds, 'store_pool_addresses')
+    @storage_op()
+    def store_pool_addresses(self, addresses):
+        now = int(time())
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO addr (address, pooled, created_ts, modified_ts) VALUES (?, 1, ?, ?)',
+                                ((address, now, now) for address in addresses))
+
+    @storage_op(write=False)
+    def count_pool_addresses(self):
+        return self.db.execute('SELECT COUNT(*) FROM addr WHERE pooled=1').fetchone()[0]
+
+    @metrics.timed(sqlite_seconds, 'claim_pool_address')
+    @storage_op()
+    def claim_pool_address(self, context):
+        while True:
+            row = self.db.execute(self.SQL_POOL_ADDRESS).fetchone()
+            if row is None:
+                return None
+
+            rowid, address = row
+            with self.db:
+                contexthash = self.store_context(context)
+                claimed = self.db.execute('UPDATE addr SET'
+                                          ' contexthash=?, pooled=0, modified_ts=?, modified=NULL'
+                                          ' WHERE rowid=? AND pooled=1',
+                                          (contexthash, int(time()), rowid)).rowcount
+                if claimed:
+                    self.move_context_balance(rowid, None, contexthash)
+            if claimed:
+                self.address_contexts.invalidate(address)
+                return address
+            # Claimed by another process in between
+
+    @storage_op(write=False)
+    def iter_addresses(self, since_rowid=0):
+        return self.db.execute('SELECT rowid, address FROM addr WHERE rowid>? ORDER BY rowid', (since_rowid,))
+
+    @storage_op(write=False)
+    def has_address(self, address):
+        return self.db.execute(self.SQL_ADDRESS_ROWID, (address,)).fetchone() is not None
+
+    @storage_op(write=False)
+    def iter_txids(self):
+        return (row[0] for row in self.db.execute('SELECT txid FROM tx'))
+
+    @metrics.timed(sqlite_seconds, 'load_txs')
+    @storage_op(write=False)
     def load_txs(self, txids):
+        """
+        Rows of every output of txids by tx_key
+        """
+        txids = list(txids)
         tx_rows = {}
         c = self.db.cursor()
-        c.execute('SELECT ? FROM tx WHERE txid IN ?',
-                  (','.join(self.TxRow._fields), txids))
-        for row in c:
-            tx = self.TxRow._make(row)
-            tx_rows[tx.txid] = tx
+        # Stay under SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(txids), 500):
+            chunk = txids[i:i + 500]
+            c.execute(self.SQL_LOAD_TXS.format(','.join('?' * len(chunk))), chunk)
+            for row in c:
+                tx = self.TxRow._make(row)
+                tx_rows[tx.txid, tx.vout, tx.category] = tx
+        c.close()
 
         return tx_rows
 
-    def store_tx_dat(self, tx_dat):
-        addrid = self.get_address_rowid(tx_dat['address'])
-        amount = Decimal(tx_dat['amount'])
+    @storage_op(write=False)
+    def iter_tx_states(self):
+        """
+        (txid, blockhash, blockheight, confirmations) of every transaction, for warming caches in one pass
+        """
+        return self.db.execute('SELECT txid, blockhash, blockheight, confirmations FROM tx')
 
-        c = self.db.cursor()
-        now = datetime.now()
-        c.execute('UPDATE tx SET'
-                  ' addr_id=?, amount=?, confirmations=?, orig=?, silenced=?, modified=? WHERE txid=?',
-                  (addrid, amount, tx_dat['confirmations'], json.dumps(tx_dat), False, now, tx_dat['txid']))
-        c.execute('INSERT INTO tx (uuid, txid, addr_id,  amount, confirmations, orig, silenced, created, modified)'
-                  ' SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE (SELECT Changes() = 0)',
-                  (uuid4(), tx_dat['txid'], addrid, amount, tx_dat['confirmations'], json.dumps(tx_dat), False, now, now))
-        self.db.commit()
-        c.close()
+    @metrics.timed(sqlite_seconds, 'load_confirming')
+    @storage_op(write=False)
+    def load_confirming(self, txids):
+        """
+        txid -> the rows of its outputs
+        """
+        txids = list(txids)
+        rows = {}
+        for i in range(0, len(txids), 500):
+            chunk = txids[i:i + 500]
+            for txid, amount, orig, blockheight, address, contexthash in self.db.execute(
+                    self.SQL_LOAD_CONFIRMING.format(','.join('?' * len(chunk))), chunk):
+                rows.setdefault(txid, []).append(
+                    self.ConfirmingRow(txid, amount, orig, blockheight, address, self.get_context(contexthash)))
+        return rows
+
+    @metrics.timed(sqlite_seconds, 'set_confirmations')
+    @storage_op()
+    def set_confirmations(self, confirmations, state=None):
+        """
+        Record locally computed confirmations, (txid, confirmations) pairs, and state in the same transaction
+        """
+        now = int(time())
+        with self.db:
+            self.db.executemany('UPDATE tx SET confirmations=?, modified_ts=?, modified=NULL WHERE txid=?',
+                                ((count, now, txid) for txid, count in confirmations))
+            if state:
+                self.write_states(state)
+
+    def get_address_rowids(self, addresses):
+        """
+        Resolve many addresses to addr rowids, creating the missing rows
+        Does not commit
+        """
+        addresses = list(set(addresses))
+        rowids = {}
+        for i in range(0, len(addresses), 500):
+            chunk = addresses[i:i + 500]
+            rowids.update(self.db.execute('SELECT address, rowid FROM addr WHERE address IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk))
+
+        missing = [address for address in addresses if address not in rowids]
+        if missing:
+            now = int(time())
+            c = self.db.cursor()
+            for address in missing:
+                c.execute('INSERT INTO addr (address, created_ts, modified_ts) VALUES (?, ?, ?)', (address, now, now))
+                rowids[address] = c.lastrowid
+            c.close()
+
+        return rowids
+
+    def store_tx_dat(self, tx_dat, heights=None):
+        self.store_tx_dats((tx_dat,), heights)
+
+    @metrics.timed(sqlite_seconds, 'store_tx_dats')
+    @storage_op()
+    def store_tx_dats(self, tx_dats, heights=None, state=None):
+        """
+        Upsert many transactions and state in a single database transaction
+        heights maps the transactions' blockhashes to block heights
+        """
+        heights = heights or {}
+        # Last write wins for repeated outputs
+        tx_dats = OrderedDict((tx_key(tx_dat), tx_dat) for tx_dat in tx_dats)
+        if not tx_dats and not state:
+            return
+
+        now = int(time())
+        with self.db:
+            if state:
+                self.write_states(state)
+            if not tx_dats:
+                return
+            addrids = self.get_address_rowids(tx_dat['address'] for tx_dat in tx_dats.values())
+            rows = [(addrids[tx_dat['address']],
+                     bit2int(Decimal(tx_dat['amount'])),
+                     tx_dat['confirmations'],
+                     json.dumps(tx_dat, default=str),
+                     False,
+                     tx_dat.get('blockhash'),
+                     heights.get(tx_dat.get('blockhash')),
+                     key) for key, tx_dat in tx_dats.items()]
+
+            # Take out what the rows being replaced added to the balances, then add the new rows
+            deltas = {}
+            for key, addrid, amount, confirmations, blockheight in self.iter_balance_rows(tx_dats):
+                self.add_balance_delta(deltas, addrid, balance_contribution(amount, key[2], confirmations, blockheight), -1)
+            for addrid, amount, confirmations, _, _, _, blockheight, key in rows:
+                self.add_balance_delta(deltas, addrid, balance_contribution(amount, key[2], confirmations, blockheight))
+
+            self.db.executemany(self.SQL_UPDATE_TX,
+                                ((addrid, amount, confirmations, orig, silenced, now, blockhash, blockheight, key[2]) + key
+                                 for addrid, amount, confirmations, orig, silenced, blockhash, blockheight, key in rows))
+            self.db.executemany(self.SQL_INSERT_TX,
+                                ((str(uuid4()),) + key + (addrid, amount, confirmations, orig, silenced, now, now,
+                                                          blockhash, blockheight) + key
+                                 for addrid, amount, confirmations, orig, silenced, blockhash, blockheight, key in rows))
+            self.write_balance_deltas(deltas)
+
+    def iter_balance_rows(self, keys):
+        """
+        (tx_key, addr_id, amount, confirmations, blockheight) of the stored rows of keys
+        """
+        txids = list(set(txid for txid, _, _ in keys))
+        for i in range(0, len(txids), 500):
+            chunk = txids[i:i + 500]
+            for txid, vout, category, addrid, amount, confirmations, blockheight in self.db.execute(
+                    self.SQL_BALANCE_ROWS.format(','.join('?' * len(chunk))), chunk).fetchall():
+                # Other outputs of the same transactions are left as they are
+                if (txid, vout, category) in keys:
+                    yield (txid, vout, category), addrid, amount, confirmations, blockheight
+
+    @staticmethod
+    def add_balance_delta(deltas, addrid, contribution, sign=1):
+        confirmed, unconfirmed = contribution
+        if confirmed or unconfirmed:
+            delta = deltas.setdefault(addrid, [0, 0])
+            delta[0] += sign * confirmed
+            delta[1] += sign * unconfirmed
+
+    def write_balance_deltas(self, deltas):
+        """
+        Add per addr_id [confirmed, unconfirmed] satoshis to the address and context balances
+        Does not commit
+        """
+        deltas = dict((addrid, delta) for addrid, delta in deltas.items() if delta[0] or delta[1])
+        if not deltas:
+            return
+        self.db.executemany('INSERT OR IGNORE INTO addr_balance (addr_id) VALUES (?)', ((addrid,) for addrid in deltas))
+        self.db.executemany('UPDATE addr_balance SET confirmed=confirmed+?, unconfirmed=unconfirmed+? WHERE addr_id=?',
+                            ((confirmed, unconfirmed, addrid) for addrid, (confirmed, unconfirmed) in deltas.items()))
+
+        context_deltas = {}
+        addrids = list(deltas)
+        for i in range(0, len(addrids), 500):
+            chunk = addrids[i:i + 500]
+            for addrid, contexthash in self.db.execute('SELECT rowid, contexthash FROM addr WHERE rowid IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk).fetchall():
+                if contexthash is not None:
+                    self.add_balance_delta(context_deltas, contexthash, deltas[addrid])
+        self.write_context_balance_deltas(context_deltas)
+
+    def write_context_balance_deltas(self, deltas):
+        # Does not commit
+        self.db.executemany('INSERT OR IGNORE INTO ctx_balance (contexthash) VALUES (?)',
+                            ((contexthash,) for contexthash in deltas))
+        self.db.executemany('UPDATE ctx_balance SET confirmed=confirmed+?, unconfirmed=unconfirmed+? WHERE contexthash=?',
+                            ((confirmed, unconfirmed, contexthash) for contexthash, (confirmed, unconfirmed) in deltas.items()))
+
+    def move_context_balance(self, addrid, old_contexthash, new_contexthash):
+        """
+        Carry an address' balance over when its context changes
+        Does not commit
+        """
+        row = self.db.execute('SELECT confirmed, unconfirmed FROM addr_balance WHERE addr_id=?', (addrid,)).fetchone()
+        if row is None or not any(row):
+            return
+        deltas = {}
+        if old_contexthash is not None:
+            self.add_balance_delta(deltas, old_contexthash, row, -1)
+        if new_contexthash is not None:
+            self.add_balance_delta(deltas, new_contexthash, row)
+        self.write_context_balance_deltas(deltas)
+
+    @metrics.timed(sqlite_seconds, 'get_address_balance')
+    @storage_op(write=False)
+    def get_address_balance(self, address):
+        row = self.db.execute(self.SQL_ADDRESS_BALANCE, (address,)).fetchone()
+        return self.Balance(*(int2bit(amount) for amount in row or (0, 0)))
+
+    @metrics.timed(sqlite_seconds, 'get_context_balance')
+    @storage_op(write=False)
+    def get_context_balance(self, context):
+        row = self.db.execute(self.SQL_CONTEXT_BALANCE, (self.context_hash(context),)).fetchone()
+        return self.Balance(*(int2bit(amount) for amount in row or (0, 0)))
+
+    @storage_op(write=False)
+    def iter_address_balances(self):
+        for address, confirmed, unconfirmed in self.db.execute(
+                'SELECT addr.address, b.confirmed, b.unconfirmed FROM addr_balance b JOIN addr ON addr.rowid = b.addr_id'):
+            yield address, self.Balance(int2bit(confirmed), int2bit(unconfirmed))
+
+    def compute_balances(self):
+        """
+        Address and context balances summed from the tx table
+        """
+        balances = sum_balances(self.db.execute(
+            'SELECT addr_id, {}, category, confirmations, blockheight FROM tx'.format(self.SQL_TX_AMOUNT)))
+        context_balances = {}
+        for addrid, contexthash in self.db.execute('SELECT rowid, contexthash FROM addr WHERE contexthash IS NOT NULL'):
+            if addrid in balances:
+                self.add_balance_delta(context_balances, contexthash, balances[addrid])
+        return balances, context_balances
+
+    @storage_op(write=False)
+    def check_balances(self):
+        """
+        addr_ids whose aggregate differs from the tx table, or None for every address when only contexts differ
+        """
+        balances, context_balances = self.compute_balances()
+        stored = dict((addrid, [confirmed, unconfirmed]) for addrid, confirmed, unconfirmed in self.db.execute(
+            'SELECT addr_id, confirmed, unconfirmed FROM addr_balance WHERE confirmed!=0 OR unconfirmed!=0'))
+        drifted = [addrid for addrid in set(balances) | set(stored) if balances.get(addrid) != stored.get(addrid)]
+        if drifted:
+            return drifted
+        stored_contexts = dict((contexthash, [confirmed, unconfirmed]) for contexthash, confirmed, unconfirmed in self.db.execute(
+            'SELECT contexthash, confirmed, unconfirmed FROM ctx_balance WHERE confirmed!=0 OR unconfirmed!=0'))
+        return [None] if stored_contexts != context_balances else []
+
+    @storage_op()
+    def rebuild_balances(self):
+        with self.db:
+            balances, context_balances = self.compute_balances()
+            self.db.execute('DELETE FROM addr_balance')
+            self.db.execute('DELETE FROM ctx_balance')
+            self.db.executemany('INSERT INTO addr_balance (addr_id, confirmed, unconfirmed) VALUES (?, ?, ?)',
+                                ((addrid, confirmed, unconfirmed) for addrid, (confirmed, unconfirmed) in balances.items()))
+            self.db.executemany('INSERT INTO ctx_balance (contexthash, confirmed, unconfirmed) VALUES (?, ?, ?)',
+                                ((contexthash, confirmed, unconfirmed)
+                                 for contexthash, (confirmed, unconfirmed) in context_balances.items()))
+
+    def close(self):
+        self.executor.run(self.db.close, write=False)
+        self.executor.close()
 
     @staticmethod
     def hash_context(context):
         return md5(context).hexdigest()
 
 sqlite3.register_adapter(Decimal, lambda d: str(d))
-sqlite3.register_converter("DECIMAL", lambda s: Decimal(s))
-sqlite3.register_adapter(datetime, lambda dt: dt.isoformat(dt))
-sqlite3.register_converter("DATETIME", lambda s: dateutil_parse(s))
+sqlite3.register_adapter(datetime, lambda dt: dt.isoformat())
 
 
 class BtdListener:
     TxInfo = namedtuple('TxInfo', 'uuid change category txid addr context amount confirmations orig')
+    SYNC_CURSOR = 'sync_cursor'
+    # Checkpointed with every storage write, see checkpoint
+    SEQ = 'zmq_seq'
+    INFLIGHT = 'inflight_diffs'
+    INFLIGHT_FROM = 'inflight_eventlog_seq'
 
-    def __init__(self, conf: BitcoindConf, rpc: BitcoindRPC=None, storage: BtdStorage=None):
+    def __init__(self, conf: BitcoindConf, rpc: BitcoindRPC=None, storage: BtdStorage=None, publisher: BtdPublisher=None,
+                 eventlog: EventLog=None, capture: Capture=None, webhooks: WebhookDispatcher=None):
         self.conf = conf
-        self.rpc = rpc or BitcoindRPC(conf)
+        if capture is None and rpc is None and settings.BTD_CAPTURE_DIR:
+            # Only the listener's own RPC client can be recorded
+            capture = Capture.create(conf)
+        self.capture = capture
+        self.rpc = rpc or (connect_rpc(conf) if capture is None else RecordingRPC(conf, capture))
         self.storage = storage or BtdStorage(conf)
+        self.publisher = publisher
+        self.eventlog = eventlog
+        if self.eventlog is None and settings.BTD_EVENTLOG:
+            self.eventlog = EventLog(conf)
+        # What close releases, whatever was passed in belongs to the caller
+        self.owned = [owned for owned, given in ((self.capture, capture), (self.storage, storage),
+                                                 (self.eventlog, eventlog)) if owned is not None and given is None]
+        self.webhooks = webhooks
+        if self.webhooks is None and settings.BTD_WEBHOOKS and self.eventlog is not None:
+            # Delivered from the event log, which keeps what could not be delivered yet
+            self.webhooks = WebhookDispatcher(conf, self.eventlog)
         self.seq = {}
+        self.checkpointed_seq = {}
+        self.watch = WatchIndex(self.storage)
+        self.tracker = ConfirmationTracker(self.rpc, self.storage)
+        self.queue = Queue(settings.BTD_LISTEN_QUEUE_SIZE)
+        self.missed = False
+        self.stats = Counter()
+        metrics.collectors[('listener', conf.filename)] = self.collect
 
     def sequence_increments(self, new_seq, topic):
         old = self.seq[topic] if topic in self.seq else 0
@@ -133,77 +647,314 @@ class BtdListener:
         self.seq[topic] = new_seq
         return increments
 
-    def listen_forever(self):
+    def topics(self):
+        """
+        The ZMQ topics to subscribe to, None when the conf publishes neither pair
+        """
         confd = self.conf.conf
-        if 'zmqpubhashtx' not in confd or 'zmqpubhashblock' not in confd:
-            log.info("Did not detect zmqpubhashtx and zmqpubhashblock in conf:{}, not listening".format(self.conf.filename))
+        if 'zmqpubrawtx' in confd and 'zmqpubrawblock' in confd:
+            # Decode locally and only sync when a transaction touches the wallet
+            return 'rawtx', 'rawblock'
+        if 'zmqpubhashtx' in confd and 'zmqpubhashblock' in confd:
+            return 'hashtx', 'hashblock'
+        log.info("Did not detect zmqpubhashtx and zmqpubhashblock in conf:{}, not listening".format(self.conf.filename))
+        return None
+
+    def subscribe(self, zmqContext, topics):
+        zmqSubSocket = zmqContext.socket(zmq.SUB)
+        for topic in topics:
+            zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        for endpoint in set(self.conf.conf['zmqpub' + topic] for topic in topics):
+            zmqSubSocket.connect(endpoint)
+        return zmqSubSocket
+
+    def listen_forever(self):
+        topics = self.topics()
+        if topics is None:
             return
 
+        if self.publisher is None:
+            self.publisher = connect_publisher()
+
+        self.resume(raw=topics[0] == 'rawtx')
+
         zmqContext = zmq.Context()
-        zmqSubSocket = zmqContext.socket(zmq.SUB)
-        zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "hashblock")
-        zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "hashtx")
-        # zmqSubSocket.setsockopt(zmq.SUBSCRIBE, "rawblock")
-        # zmqSubSocket.setsockopt(zmq.SUBSCRIBE, "rawtx")
-        zmqSubSocket.connect(confd['zmqpubhashtx'])
+        zmqSubSocket = self.subscribe(zmqContext, topics)
+
+        if self.webhooks is not None:
+            self.webhooks.start()
+        processor = spawn(self.process_forever)
+        try:
+            self.receive_forever(zmqSubSocket)
+        finally:
+            processor.kill()
+            if self.webhooks is not None:
+                self.webhooks.stop()
+            zmqSubSocket.close(linger=0)
+            zmqContext.term()
+
+    def close(self):
+        """
+        Release the storage, event log and capture the listener opened itself
+        """
+        for owned in self.owned:
+            owned.close()
+        self.owned = []
+
+    def resume(self, raw=False):
+        """
+        Continue from the last checkpoint instead of treating everything since the previous run as missed
+        """
+        self.restore(raw)
+        self.resume_inflight()
+
+    def restore(self, raw=False):
+        """
+        Reload the checkpointed sequence numbers and warm the in memory indexes
+        """
+        seq = self.storage.get_state(self.SEQ)
+        self.seq = json.loads(seq) if seq else {}
+        self.checkpointed_seq = dict(self.seq)
+
+        # One pass over tx warms both the raw transaction matcher and the confirmation tracker
+        txs = self.storage.iter_tx_states()
+        if raw:
+            self.watch.load()
+            txs = self.watch.warm_txids(txs)
+        self.tracker.load(txs)
 
+        if self.capture is not None:
+            # Replays resume from the same point
+            self.capture.state(dict((key, self.storage.get_state(key)) for key in (
+                self.SYNC_CURSOR, self.SEQ, self.tracker.TIP_HASH, self.tracker.TIP_HEIGHT)))
+
+    def resume_inflight(self):
+        """
+        Broadcast the diffs that were stored but possibly not broadcast before the last shutdown
+        """
+        self.broadcast_diffs(self.inflight_diffs())
+
+    def inflight_diffs(self):
+        inflight = self.storage.get_state(self.INFLIGHT)
+        if not inflight:
+            return []
+
+        from_seq = self.storage.get_state(self.INFLIGHT_FROM)
+        logged = set()
+        if self.eventlog is not None and from_seq is not None:
+            logged = set(decode_record(record)[0].uuid for _, _, record in self.eventlog.read(from_seq))
+
+        diffs = []
+        offset = 0
+        while offset < len(inflight):
+            event, offset = decode_record(inflight, offset)
+            if event.uuid not in logged:
+                diffs.append(self.TxInfo(uuid=event.uuid, change=event.change, category=event.category,
+                                         txid=event.txid, addr=event.addr, context=event.context,
+                                         amount=event.amount, confirmations=event.confirmations, orig=None))
+        log.info("Broadcasting {} diffs in flight at the last checkpoint".format(len(diffs)))
+        return diffs
+
+    def checkpoint(self, diffs=(), **state):
+        """
+        State to commit along with a storage write: the ZMQ sequence processed so far and the diffs about to be broadcast
+        """
+        state[self.SEQ] = json.dumps(self.seq)
+        state[self.INFLIGHT] = b''.join(encode_txinfo(0, diff) for diff in diffs) or None
+        state[self.INFLIGHT_FROM] = None if self.eventlog is None else self.eventlog.next_seq
+        self.checkpointed_seq = dict(self.seq)
+        return state
+
+    def receive_forever(self, zmqSubSocket):
+        """
+        Only drains the socket so bursts queue here instead of overflowing the SUB socket
+        """
         while True:
             try:
                 msg = zmqSubSocket.recv_multipart()
-                topic = str(msg[0])
-                if topic != "hashtx" and topic != "hashblock":
-                    continue
+                self.stats['received'] += 1
+                if self.capture is not None:
+                    self.capture.zmq(msg)
+                try:
+                    self.queue.put_nowait((monotonic(), msg))
+                except Full:
+                    # Whatever was dropped is recovered by the next sync
+                    self.stats['dropped'] += 1
+                    self.missed = True
+            except Exception as e:
+                log.exception("Uncaught exception during bitcoin ZMQ listen", exc_info=e)
 
-                log.info("GOT MSG: {}".format(topic))
+    def process_forever(self):
+        while True:
+            received, msg = self.queue.get()
+            listener_lag.observe(monotonic() - received, (self.conf.filename,))
+            msgs = [msg]
+            while True:
+                try:
+                    msgs.append(self.queue.get_nowait()[1])
+                except Empty:
+                    break
 
-                # Sequence checking
-                if len(msg[-1]) == 4:
-                    new_seq = struct.unpack('<I', msg[-1])[-1]
+            try:
+                self.process(msgs)
+            except Exception as e:
+                log.exception("Uncaught exception processing bitcoin ZMQ messages", exc_info=e)
+                # Their sequence numbers were consumed, make sure the next batch syncs
+                self.missed = True
 
-                    if not self.sequence_increments(new_seq, topic):
-                        # Missed something
-                        self.rebuild_tx()
+            # Let triggers accumulate so a burst costs one sync per interval
+            sleep(settings.BTD_PROCESS_INTERVAL)
 
-                if topic == "hashtx":
-                    txid = binascii.b2a_hex(msg[1])
-                    self.handle_txid(txid)
-                if topic == "hashblock":
-                    self.rebuild_tx()
+    @metrics.timed(listener_seconds, 'process')
+    def process(self, msgs):
+        """
+        Coalesce queued ZMQ messages into at most one sync
+        """
+        sync = self.missed
+        self.missed = False
+        txids = []
 
-            except Exception as e:
-                log.exception("Uncaught exception during bitcoin ZMQ listen", exc_info=e)
+        for msg in msgs:
+            topic = msg[0].decode()
+            log.debug("GOT MSG: {}".format(topic))
 
-    def handle_txid(self, txid):
-        try:
-            tx_dat = self.rpc.get_transaction(txid)
-        except IndexError:
-            # Not our problem (non wallet)
-            return
+            sync = self.sequence_gap(msg, topic) or sync
+
+            if topic == "hashtx":
+                txids.append(binascii.b2a_hex(msg[1]).decode())
+            elif topic == "hashblock":
+                sync = self.handle_blockid(binascii.b2a_hex(msg[1]).decode()) or sync
+            elif topic == "rawtx":
+                sync = sync or self.handle_rawtx(msg[1])
+            elif topic == "rawblock":
+                sync = self.handle_rawblock(msg[1]) or sync
+
+        if txids and not sync:
+            sync = self.handle_txids(txids)
+
+        self.stats['processed'] += len(msgs)
+        if sync:
+            self.stats['syncs'] += 1
+            self.stats['coalesced'] += len(msgs) - 1
+            self.rebuild_tx()
+
+        # After the sync so transactions it moved between blocks are followed at their new height
+        self.broadcast_milestones()
+
+        if self.seq != self.checkpointed_seq:
+            self.storage.set_states(self.checkpoint())
+
+    def sequence_gap(self, msg, topic):
+        if len(msg[-1]) == 4:
+            new_seq = struct.unpack('<I', msg[-1])[-1]
+
+            if not self.sequence_increments(new_seq, topic):
+                # Missed something
+                self.stats['sequence_gaps'] += 1
+                return True
+        return False
 
-        self.rebuild_tx()
+    def queue_depth(self):
+        return self.queue.qsize()
 
-    def handle_blockid(self, blockid):
+    def health(self):
+        health = dict(self.stats)
+        health['queue_depth'] = self.queue_depth()
+        health['sync_cursor'] = self.storage.get_state(self.SYNC_CURSOR)
+        health['tip_height'] = self.tracker.tip_height
+        return health
+
+    def collect(self):
+        """
+        Metrics snapshot entries for the stats counted anyway, read only when scraped
+        """
+        filename = self.conf.filename
+        return [
+            ('btd_listener_events_total', 'counter', 'Listener ZMQ message and sync counts', ('conf', 'event'), None,
+             dict(((filename, event), count) for event, count in self.stats.items())),
+            ('btd_listener_queue_depth', 'gauge', 'ZMQ messages waiting to be processed', ('conf',), None,
+             {(filename,): self.queue_depth()}),
+            ('btd_context_cache_total', 'counter', 'Storage context cache lookups', ('conf', 'cache', 'result'), None,
+             dict(((filename, name, result), getattr(cache, result))
+                  for name, cache in (('address', self.storage.address_contexts), ('context', self.storage.contexts))
+                  for result in ('hits', 'misses'))),
+        ]
+
+    def handle_txids(self, txids):
+        # Non wallet txids are left out by bitcoind
+        return bool(self.rpc.get_transactions(txids))
+
+    def handle_blockid(self, blockid, prev=None):
         log.info("Got new block:{}".format(blockid))
-        self.rebuild_tx()
+        height = None if prev is None else self.tracker.next_height(prev)
+        if height is None:
+            header = self.rpc.get_block_header(blockid)
+            height, prev = header['height'], header.get('previousblockhash')
+
+        extends = self.tracker.advance(blockid, height, prev)
+        # Only bitcoind knows what a reorg changed and which mempool transactions the block mined
+        return not extends or bool(self.tracker.unconfirmed)
 
+    def handle_rawtx(self, raw):
+        tx = decode_tx(raw)
+        if tx is None:
+            # May touch the wallet, a sync finds out without dropping the rest of the batch
+            self.stats['undecodable'] += 1
+            return True
+        self.watch.refresh()
+        if self.watch.matches(tx):
+            log.info("Matched wallet tx:{}".format(tx_txid(tx)))
+            return True
+        return False
+
+    def handle_rawblock(self, raw):
+        # Only the header is needed to follow the tip
+        header = CBlockHeader.deserialize(raw[:80])
+        self.watch.load()
+        return self.handle_blockid(b2lx(header.GetHash()), b2lx(header.hashPrevBlock))
+
+    @metrics.timed(listener_seconds, 'rebuild')
     def rebuild_tx(self):
-        # TODO: count?
-        txs = set(self.rpc.list_transactions(count=100))
-        low_conf_txs = set(filter(txs, lambda tx_dat: 'confirmations' in tx_dat and tx_dat['confirmations'] < 10))
+        """
+        Diff what the wallet reports since the persisted block cursor
+        A cursor reorged out of the main chain is listed from its fork point, see BitcoindRPC.list_since_block
+        """
+        cursor = self.storage.get_state(self.SYNC_CURSOR)
+        since = self.rpc.list_since_block(cursor, settings.BTD_SYNC_CONFIRMATIONS)
+
+        log.info("Syncing {} transactions since block:{}".format(len(since['transactions']), cursor))
 
-        db_txaddr = self.storage.load_txs(tx_dat['txid'] for tx_dat in low_conf_txs)
+        diffs = self.diff_since(since)
+        heights = self.tracker.block_heights(diff.orig['blockhash'] for diff in diffs if 'blockhash' in diff.orig)
+        self.store_diffs(diffs, heights, since['lastblock'])
 
-        log.info("Using {}% of rpc'd transactions".format((len(low_conf_txs)/len(txs))*100))
+        self.broadcast_diffs(diffs)
 
-        for tx_dat in low_conf_txs:
-            diff = self.diff_tx(tx_dat, db_txaddr)
-            if diff:
-                self.broadcast_diff(diff)
+    def diff_since(self, since):
+        """
+        Diffs of a listsinceblock result against storage
+        """
+        tx_dats = OrderedDict()
+        for tx_dat in since['transactions']:
+            if 'txid' in tx_dat and 'category' in tx_dat:
+                tx_dats[tx_key(tx_dat)] = tx_dat
+        for tx_dat in since.get('removed', []):
+            # Reorged out transactions mined again are only reported as they are now
+            if 'txid' in tx_dat and 'category' in tx_dat:
+                tx_dats.setdefault(tx_key(tx_dat), tx_dat)
+        db_txs = self.storage.load_txs(set(txid for txid, _, _ in tx_dats))
+        return [diff for diff in (self.diff_tx(tx_dat, db_txs) for tx_dat in tx_dats.values()) if diff]
 
-        # TODO: mark disappeared transactions
+    def store_diffs(self, diffs, heights, lastblock):
+        # The cursor only moves together with the diffs it produced
+        self.storage.store_tx_dats((diff.orig for diff in diffs), heights,
+                                   self.checkpoint(diffs, **{self.SYNC_CURSOR: lastblock}))
+        self.tracker.update((diff.orig for diff in diffs), heights)
+        self.watch.txids.update(diff.txid for diff in diffs)
 
-    def diff_tx(self, tx_dat, db_txaddr):
-        # Modifies db_txaddr
+    @metrics.timed(listener_seconds, 'diff')
+    def diff_tx(self, tx_dat, db_txs):
+        # Modifies db_txs
 
         if 'txid' not in tx_dat or \
                 'category' not in tx_dat or \
@@ -213,25 +964,24 @@ class BtdListener:
             log.error("tx:{} malformed".format(tx_dat['txid']))
             return
 
-        txid = tx_dat['txid']
+        key = tx_key(tx_dat)
 
-        if txid not in db_txaddr:
+        if key not in db_txs:
             change = 'new'
-            self.storage.store_tx_dat(tx_dat)
-            context = self.storage.lookup_context(tx_dat['address'])
         else:
-            tx, addr = db_txaddr[txid]
-            del db_txaddr[txid]
-            context = addr.context
+            tx = db_txs.pop(key)
 
-            amount = Decimal(tx_dat['amount'])
-            confirmations = tx_dat['confirmations']
+            amount = bit2int(Decimal(tx_dat['amount']))
+            blockhash = tx_dat.get('blockhash')
 
-            if amount == tx.amount and confirmations == tx.confirmations:
+            # Confirmations of mined transactions are followed locally, only moving between blocks is a change
+            if amount == tx.amount and blockhash == tx.blockhash and \
+                    (blockhash is not None or tx_dat['confirmations'] == tx.confirmations):
                 return None
 
             change = 'modified'
-            self.storage.store_tx_dat(tx_dat)
+
+        context = self.storage.lookup_context(tx_dat['address'])
 
         return self.TxInfo(
             uuid=uuid4(),
@@ -244,22 +994,104 @@ class BtdListener:
             confirmations=tx_dat['confirmations'],
             orig=tx_dat)
 
+    @metrics.timed(listener_seconds, 'milestones')
+    def broadcast_milestones(self):
+        """
+        Announce the confirmation milestones reached at the tracked tip, without RPC
+        """
+        reached = self.tracker.reached()
+        if reached:
+            self.broadcast_diffs(self.milestone_diffs(reached))
+
+    def milestone_diffs(self, reached):
+        """
+        Diffs for reached (txid, confirmations), stored along with the confirmations
+        """
+        rows = self.storage.load_confirming(txid for txid, _ in reached)
+        diffs = []
+        for txid, confirmations in reached:
+            for row in rows.get(txid, ()):
+                orig = json.loads(row.orig)
+                diffs.append(self.TxInfo(
+                    uuid=uuid4(),
+                    change='confirmations',
+                    category=orig['category'],
+                    txid=txid,
+                    addr=row.address,
+                    context=row.context,
+                    amount=int2bit(row.amount),
+                    confirmations=confirmations,
+                    orig=orig))
+
+        self.storage.set_confirmations(reached, self.checkpoint(diffs))
+        return diffs
+
+    def broadcast_diffs(self, diffs):
+        for diff in diffs:
+            self.broadcast_diff(diff)
+        if diffs:
+            self.storage.set_state(self.INFLIGHT, None)
+
+    @metrics.timed(listener_seconds, 'broadcast')
     def broadcast_diff(self, txinfo: TxInfo):
         log.info(txinfo)
+        topic = b'' if txinfo.context is None else self.storage.context_hash(txinfo.context).encode()
+        if self.eventlog is not None:
+            # The log assigns the sequence so consumers can resume from it after a restart
+            seq, record = self.eventlog.append(topic, txinfo)
+            if self.publisher is not None:
+                self.publisher.publish_record(topic, self.conf.filename, seq, record)
+            if self.webhooks is not None:
+                self.webhooks.notify()
+        elif self.publisher is not None:
+            self.publisher.publish(topic, self.conf.filename, txinfo)
 
 
 class BtdRPC:
-    def __init__(self, conf: BitcoindConf, rpc: BitcoindRPC=None, storage: BtdStorage=None):
+    def __init__(self, conf: BitcoindConf, rpc: BitcoindRPC=None, storage: BtdStorage=None, address_pool: AddressPool=None,
+                 payout_queue: PayoutQueue=None):
         self.conf = conf
-        self.rpc = rpc or BitcoindRPC(conf)
+        self.rpc = rpc or connect_rpc(conf)
         self.storage = storage or BtdStorage(conf)
+        self.address_pool = address_pool
+        if self.address_pool is None and settings.BTD_ADDRESS_POOL_HIGH:
+            self.address_pool = AddressPool(self.rpc, self.storage)
+        self.payout_queue = payout_queue
+        if self.payout_queue is None and settings.BTD_PAYOUT_WINDOW is not None:
+            self.payout_queue = PayoutQueue(self.rpc, self.storage)
+        self.balance_reconciler = None
+        if settings.BTD_BALANCE_RECONCILE_INTERVAL is not None:
+            self.balance_reconciler = BalanceReconciler(self.rpc, self.storage)
+
+    def start(self):
+        """
+        Start the background work that calls bitcoind, constructing a BtdRPC does not
+        """
+        if self.address_pool is not None:
+            self.address_pool.start()
+        if self.payout_queue is not None:
+            self.payout_queue.start()
+        if self.balance_reconciler is not None:
+            self.balance_reconciler.start()
 
     def get_address(self, context):
-        return self.storage.lookup_unused_address(context) or self.storage.store_address(self.rpc.create_address(), context)
+        return self.storage.lookup_unused_address(context) or \
+            (self.address_pool and self.address_pool.claim(context)) or \
+            self.storage.store_address(self.rpc.create_address(), context)
 
     def send(self, address, amount, context):
+        if self.payout_queue is not None:
+            return self.payout_queue.send(address, amount, context).get()
         self.storage.store_address(address, context)
-        self.rpc.send(address, amount)
+        return self.rpc.send(address, amount)
+
+    def get_balance(self, context=None, address=None):
+        """
+        Received balance of an address or of every address handed out for a context
+        """
+        if address is not None:
+            return self.storage.get_address_balance(address)
+        return self.storage.get_context_balance(context)
 
 
 
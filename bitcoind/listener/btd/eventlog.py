@@ -0,0 +1,263 @@
+"""
+Segments are pairs of files named after the first sequence number they hold:
+    <first seq>.log  records of seq Q, topic length H, payload length I, topic, payload
+    <first seq>.idx  one offset Q per record, the entry for seq lives at (seq - first seq) * 8
+Sequence numbers are contiguous so a lookup never searches inside a segment.
+"""
+from gevent import spawn_later
+
+from . import settings
+from .publisher import encode_txinfo, decode_record
+
+from bisect import bisect_right
+from os import path, makedirs
+import os
+import mmap
+import json
+import struct
+import time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+record_header = struct.Struct('<QHI')
+index_entry = struct.Struct('<Q')
+
+
+def segment_name(first_seq, ext):
+    return '{:020d}.{}'.format(first_seq, ext)
+
+
+class EventLog:
+    """
+    Append only, segmented log of published diffs that consumers can replay from their last acknowledged seq
+    """
+    def __init__(self, conf, directory=None):
+        self.conf = conf
+        self.directory = directory or path.join(settings.BTD_SQLITE_DIR, conf.filename + '.events')
+        makedirs(self.directory, mode=0o700, exist_ok=True)
+
+        self.segments = sorted(int(f[:-4]) for f in os.listdir(self.directory) if f.endswith('.log'))
+        self.consumers = self.load_consumers()
+        self.acked = False
+        self.saver = None
+        self.log_file = None
+        self.idx_file = None
+        self.size = 0
+        self.unsynced = 0
+        self.syncer = None
+
+        if self.segments:
+            self.next_seq = self.recover(self.segments[-1])
+        else:
+            self.next_seq = 1
+        self.open_segment(self.segments[-1] if self.segments else self.next_seq)
+
+    def segment_path(self, first_seq, ext):
+        return path.join(self.directory, segment_name(first_seq, ext))
+
+    def recover(self, first_seq):
+        """
+        Drop a partially written record from the last segment, returns the next seq
+        """
+        log_path = self.segment_path(first_seq, 'log')
+        idx_path = self.segment_path(first_seq, 'idx')
+        with open(idx_path, 'ab+') as idx, open(log_path, 'ab+') as f:
+            idx.seek(0)
+            offsets = idx.read()
+            count = len(offsets) // index_entry.size
+            log_size = f.seek(0, os.SEEK_END)
+
+            # Walk back to the last record that was completely written
+            while count:
+                offset, = index_entry.unpack_from(offsets, (count - 1) * index_entry.size)
+                f.seek(offset)
+                header = f.read(record_header.size)
+                if len(header) == record_header.size:
+                    _, topic_len, payload_len = record_header.unpack(header)
+                    end = offset + record_header.size + topic_len + payload_len
+                    if end <= log_size:
+                        break
+                count -= 1
+
+            end = 0 if count == 0 else end
+            if end != log_size or count * index_entry.size != len(offsets):
+                log.warning("Truncating event log segment:{} to {} records".format(log_path, count))
+                f.truncate(end)
+                idx.truncate(count * index_entry.size)
+
+        return first_seq + count
+
+    def open_segment(self, first_seq):
+        if first_seq not in self.segments:
+            self.segments.append(first_seq)
+        self.log_file = open(self.segment_path(first_seq, 'log'), 'ab')
+        self.idx_file = open(self.segment_path(first_seq, 'idx'), 'ab')
+        self.size = self.log_file.tell()
+
+    def append(self, topic, txinfo):
+        """
+        Returns the seq assigned to txinfo and its encoded record
+        """
+        if self.size >= settings.BTD_EVENTLOG_SEGMENT_BYTES:
+            self.roll()
+
+        seq = self.next_seq
+        self.next_seq += 1
+        record = encode_txinfo(seq, txinfo)
+
+        self.idx_file.write(index_entry.pack(self.size))
+        self.log_file.write(record_header.pack(seq, len(topic), len(record)))
+        self.log_file.write(topic)
+        self.log_file.write(record)
+        self.size += record_header.size + len(topic) + len(record)
+
+        self.unsynced += 1
+        if self.unsynced >= settings.BTD_EVENTLOG_FSYNC_RECORDS:
+            self.sync()
+        elif self.syncer is None:
+            self.syncer = self.later(settings.BTD_EVENTLOG_FSYNC_INTERVAL, self.sync_later)
+
+        return seq, record
+
+    def sync(self):
+        if not self.unsynced:
+            return
+        for f in (self.log_file, self.idx_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+
+    def later(self, seconds, f):
+        return spawn_later(seconds, f)
+
+    def sync_later(self):
+        self.syncer = None
+        self.sync()
+
+    def roll(self):
+        self.sync()
+        # Segments are only removed for acks that survive a crash
+        self.save_consumers()
+        self.log_file.close()
+        self.idx_file.close()
+        self.open_segment(self.next_seq)
+        self.compact()
+
+    def read(self, from_seq, limit=None):
+        """
+        Yields (seq, topic, record) from from_seq onwards, sequentially through memory maps
+        """
+        from_seq = max(from_seq, self.segments[0] if self.segments else from_seq)
+        self.log_file.flush()
+        self.idx_file.flush()
+
+        i = max(0, bisect_right(self.segments, from_seq) - 1)
+        for first_seq in list(self.segments[i:]):
+            try:
+                with open(self.segment_path(first_seq, 'idx'), 'rb') as idx, \
+                        open(self.segment_path(first_seq, 'log'), 'rb') as f:
+                    idx_size = os.fstat(idx.fileno()).st_size
+                    position = (from_seq - first_seq) * index_entry.size
+                    if position >= idx_size:
+                        continue
+
+                    with mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ) as offsets:
+                        offset, = index_entry.unpack_from(offsets, position)
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        end = len(data)
+                        while offset < end:
+                            seq, topic_len, payload_len = record_header.unpack_from(data, offset)
+                            offset += record_header.size
+                            topic = data[offset:offset + topic_len]
+                            offset += topic_len
+                            record = data[offset:offset + payload_len]
+                            offset += payload_len
+
+                            yield seq, topic, record
+                            from_seq = seq + 1
+                            if limit is not None:
+                                limit -= 1
+                                if limit <= 0:
+                                    return
+            except FileNotFoundError:
+                # Compacted away while reading
+                continue
+
+    def load_consumers(self):
+        try:
+            with open(path.join(self.directory, 'consumers.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def ack(self, consumer, seq):
+        """
+        Record that consumer has processed everything up to and including seq, written out within
+        BTD_EVENTLOG_ACK_INTERVAL seconds
+        """
+        self.consumers[consumer] = max(seq, self.consumers.get(consumer, 0))
+        self.acked = True
+        if self.saver is None:
+            self.saver = self.later(settings.BTD_EVENTLOG_ACK_INTERVAL, self.save_consumers_later)
+
+    def remove_consumer(self, consumer):
+        """
+        Forget consumer so compaction no longer keeps segments for it
+        """
+        if consumer in self.consumers:
+            del self.consumers[consumer]
+            self.acked = True
+            self.save_consumers()
+
+    def save_consumers_later(self):
+        self.saver = None
+        self.save_consumers()
+
+    def save_consumers(self):
+        if not self.acked:
+            return
+        self.acked = False
+        consumers_path = path.join(self.directory, 'consumers.json')
+        with open(consumers_path + '.tmp', 'w') as f:
+            json.dump(self.consumers, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(consumers_path + '.tmp', consumers_path)
+
+    def replay(self, consumer, limit=None):
+        """
+        Yields the decoded Events consumer has not acknowledged yet
+        """
+        for seq, topic, record in self.read(self.consumers.get(consumer, 0) + 1, limit):
+            yield decode_record(record)[0]
+
+    def compact(self):
+        """
+        Delete closed segments that every consumer has acknowledged or that fall outside retention
+        """
+        acked = min(self.consumers.values()) if self.consumers else None
+        total = sum(os.path.getsize(self.segment_path(s, 'log')) for s in self.segments)
+        now = time.time()
+
+        # Never the active segment
+        for first_seq, next_first in list(zip(self.segments, self.segments[1:])):
+            log_path = self.segment_path(first_seq, 'log')
+            size = os.path.getsize(log_path)
+            consumed = acked is not None and next_first - 1 <= acked
+            expired = now - os.path.getmtime(log_path) > settings.BTD_EVENTLOG_RETENTION_SECONDS
+            oversized = total > settings.BTD_EVENTLOG_RETENTION_BYTES
+            if not (consumed or expired or oversized):
+                break
+
+            log.info("Removing event log segment:{}".format(log_path))
+            os.remove(log_path)
+            os.remove(self.segment_path(first_seq, 'idx'))
+            self.segments.remove(first_seq)
+            total -= size
+
+    def close(self):
+        self.sync()
+        self.save_consumers()
+        self.log_file.close()
+        self.idx_file.close()
@@ -0,0 +1,156 @@
+from gevent import spawn
+from gevent.event import Event, AsyncResult
+from gevent.threadpool import ThreadPool
+from gevent.monkey import get_original
+
+from . import settings
+from . import metrics
+
+from functools import wraps
+from types import GeneratorType
+import sqlite3
+
+from logging import getLogger
+log = getLogger(__name__)
+
+# The storage thread is a native thread even when threading is monkey patched
+get_ident = get_original('_thread', 'get_ident')
+
+group_ops = metrics.Histogram('btd_sqlite_group_ops', 'Storage operations committed in one transaction', ('conf',),
+                              buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+def storage_op(write=True):
+    """
+    Decorate a method of an object with an executor to run on the executor's thread
+    Operations that only read are left out of group transactions
+    """
+    def decorator(f):
+        @wraps(f)
+        def op(self, *args, **kwargs):
+            return self.executor.run(f, (self,) + args, kwargs, write)
+        op.write = write
+        return op
+    return decorator
+
+
+class GroupedConnection:
+    """
+    The connection as operations see it, the executor opens and commits the transactions so commit is a no-op
+    and a failing operation is rolled back to its savepoint by the executor
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class StorageExecutor:
+    """
+    Runs storage operations on a native thread owning the connection, so queries and fsyncs do not block the hub
+
+    Greenlets queue operations and wait for their results. Operations queued while a group is committing are committed
+    together in the next one, each inside its own savepoint so a failing operation only loses its own writes.
+    """
+    def __init__(self, db, name, group=None):
+        # Opened with check_same_thread=False and isolation_level=None, only used from the storage thread from here on
+        self.db = db
+        self.name = name
+        self.group = group or settings.BTD_SQLITE_GROUP_COMMIT
+        self.pool = ThreadPool(1)
+        # (f, args, kwargs, write, AsyncResult) waiting for the next group
+        self.pending = []
+        self.wake = Event()
+        self.thread = None
+        self.greenlet = None
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = spawn(self.commit_forever)
+        return self.greenlet
+
+    def close(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.pool.kill()
+
+    def run(self, f, args=(), kwargs=None, write=True):
+        """
+        Run f(*args, **kwargs) on the storage thread and wait for its result, directly when already on it
+        """
+        kwargs = kwargs or {}
+        if self.thread is not None and get_ident() == self.thread:
+            return f(*args, **kwargs)
+        self.start()
+        result = AsyncResult()
+        self.pending.append((f, args, kwargs, write, result))
+        self.wake.set()
+        return result.get()
+
+    def commit_forever(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            while self.pending:
+                ops, self.pending = self.pending[:self.group], self.pending[self.group:]
+                try:
+                    outcomes = self.pool.apply(self.run_group, (ops,))
+                except Exception as e:
+                    log.exception("Error running storage operations", exc_info=e)
+                    outcomes = [(None, e)] * len(ops)
+                group_ops.observe(len(ops), (self.name,))
+                for (_, _, _, _, result), (value, exception) in zip(ops, outcomes):
+                    if exception is None:
+                        result.set(value)
+                    else:
+                        result.set_exception(exception)
+
+    def run_group(self, ops):
+        """
+        On the storage thread, returns (value, exception) per operation
+        """
+        self.thread = get_ident()
+        write = any(op_write for _, _, _, op_write, _ in ops)
+        if not write:
+            return [self.run_op(f, args, kwargs, False) for f, args, kwargs, _, _ in ops]
+
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            outcomes = [self.run_op(f, args, kwargs, True) for f, args, kwargs, _, _ in ops]
+            self.db.execute('COMMIT')
+        except Exception as e:
+            # Nothing of the group was kept
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            return [(None, e)] * len(ops)
+        return outcomes
+
+    def run_op(self, f, args, kwargs, savepoint):
+        if savepoint:
+            self.db.execute('SAVEPOINT op')
+        try:
+            value = f(*args, **kwargs)
+            if isinstance(value, (sqlite3.Cursor, GeneratorType)):
+                # Rows are read here, cursors stay on the storage thread
+                value = list(value)
+        except Exception as e:
+            if savepoint:
+                self.db.execute('ROLLBACK TO op')
+                self.db.execute('RELEASE op')
+            return None, e
+        if savepoint:
+            self.db.execute('RELEASE op')
+        return value, None
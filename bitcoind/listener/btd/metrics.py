@@ -0,0 +1,181 @@
+"""
+Counters and latency histograms, served in the Prometheus text format on BTD_METRICS_PORT.
+Nothing is recorded while BTD_METRICS_PORT is None.
+
+A snapshot is a list of (name, kind, help, labelnames, buckets, values), values mapping a tuple of label values to a
+number, or for histograms to ([count per bucket and +Inf], sum, count). Snapshots are plain data so worker processes
+can send theirs to the supervisor, which merges them into one exposition.
+"""
+from gevent.pywsgi import WSGIServer
+
+from . import settings
+
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+from time import monotonic
+
+from logging import getLogger
+log = getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = OrderedDict()
+# Called at scrape time for values that are already counted elsewhere, key -> f() returning snapshot entries
+collectors = OrderedDict()
+
+
+def enabled():
+    return settings.BTD_METRICS_PORT is not None
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = None
+        self.values = {}
+        registry[name] = self
+
+    def snapshot(self):
+        return (self.name, self.kind, self.help, self.labelnames, self.buckets, self.copy_values())
+
+    def copy_values(self):
+        return dict(self.values)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        if settings.BTD_METRICS_PORT is None:
+            return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        if settings.BTD_METRICS_PORT is None:
+            return
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def copy_values(self):
+        return dict((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items())
+
+
+def timed(histogram: Histogram, name, errors: Counter=None):
+    """
+    Decorate a method of an object with a conf, observing its duration labelled (conf filename, name)
+    """
+    def decorator(f):
+        @wraps(f)
+        def timed(self, *args, **kwargs):
+            if settings.BTD_METRICS_PORT is None:
+                return f(self, *args, **kwargs)
+            labels = (self.conf.filename, name)
+            start = monotonic()
+            try:
+                return f(self, *args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(labels)
+                raise
+            finally:
+                histogram.observe(monotonic() - start, labels)
+        return timed
+    return decorator
+
+
+def snapshot():
+    if not enabled():
+        return None
+    entries = [metric.snapshot() for metric in registry.values() if metric.values]
+    for collect in list(collectors.values()):
+        entries.extend(collect())
+    return entries
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def merge(snapshots):
+    """
+    Sum snapshots from several processes, counters and histogram buckets are additive
+    """
+    merged = OrderedDict()
+    for entries in snapshots:
+        for name, kind, help, labelnames, buckets, values in entries or ():
+            if name not in merged:
+                merged[name] = (name, kind, help, labelnames, buckets, {})
+            into = merged[name][5]
+            for labels, value in values.items():
+                if labels not in into:
+                    into[labels] = value
+                elif kind == 'histogram':
+                    counts, total, count = into[labels]
+                    into[labels] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+                else:
+                    into[labels] = into[labels] + value
+    return list(merged.values())
+
+
+def render(entries):
+    lines = []
+    for name, kind, help, labelnames, buckets, values in entries:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in sorted(values.items()):
+            if kind == 'histogram':
+                counts, total, count = value
+                cumulative = 0
+                for le, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labelnames, labels, (('le', le),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labelnames, labels), total))
+                lines.append('{}_count{} {}'.format(name, format_labels(labelnames, labels), count))
+            else:
+                lines.append('{}{} {}'.format(name, format_labels(labelnames, labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(collect=None):
+    """
+    Serve render(collect()) over HTTP until killed, collect defaults to this process' snapshot
+    """
+    collect = collect or (lambda: snapshot())
+
+    def app(environ, start_response):
+        try:
+            body = render(collect()).encode()
+        except Exception as e:
+            log.exception("Failed rendering metrics", exc_info=e)
+            start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+            return [b'']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    server = WSGIServer((settings.BTD_METRICS_BIND, settings.BTD_METRICS_PORT), app, log=None)
+    log.info("Serving metrics on {}:{}".format(settings.BTD_METRICS_BIND, settings.BTD_METRICS_PORT))
+    server.serve_forever()
@@ -0,0 +1,75 @@
+"""
+Convert rows written before the compact storage format while the listener keeps running
+
+    python3 -m btd.migrate [conf ...] [--chunk N] [--pause S]
+
+Rows are converted oldest first in short transactions, and readers fall back to the legacy columns of rows not reached
+yet, so the tool can be stopped and started again at any point.
+"""
+from gevent import sleep
+
+from . import settings
+from .bitcoind import BitcoindConf
+from .engine import BtdStorage
+from .migrations import COMPACT_COLUMNS
+
+import argparse
+import logging
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+def compact_table(storage: BtdStorage, table, columns, chunk, pause):
+    """
+    Move the legacy values of table into its compact columns, returns the number of rows converted
+    """
+    assignments = ', '.join('{0}=COALESCE({0}, {1}), {2}=NULL'.format(compact, convert.format(legacy), legacy)
+                            for compact, legacy, convert in columns)
+    pending = ' OR '.join('{} IS NOT NULL'.format(legacy) for _, legacy, _ in columns)
+    sql = 'UPDATE {} SET {} WHERE rowid>? AND rowid<=? AND ({})'.format(table, assignments, pending)
+
+    def convert(last):
+        # On the storage thread, returns the last rowid converted and the rows changed
+        end = storage.db.execute('SELECT MAX(rowid) FROM (SELECT rowid FROM {} WHERE rowid>? ORDER BY rowid LIMIT ?)'.format(
+            table), (last, chunk)).fetchone()[0]
+        return end, 0 if end is None else storage.db.execute(sql, (last, end)).rowcount
+
+    converted = 0
+    last = 0
+    while True:
+        last, count = storage.executor.run(convert, (last,))
+        if last is None:
+            return converted
+        converted += count
+        sleep(pause)
+
+
+def compact(storage: BtdStorage, chunk=None, pause=None):
+    """
+    Convert every table of storage, returns table -> rows converted
+    """
+    chunk = chunk or settings.BTD_MIGRATE_CHUNK
+    pause = settings.BTD_MIGRATE_PAUSE if pause is None else pause
+    converted = {}
+    for table, columns in COMPACT_COLUMNS:
+        converted[table] = compact_table(storage, table, columns, chunk, pause)
+        log.info("Converted {} {} rows of conf:{}".format(converted[table], table, storage.conf.filename))
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('confs', nargs='*', help='conf filenames, all of them by default')
+    parser.add_argument('--chunk', type=int, default=None, help='rows per transaction')
+    parser.add_argument('--pause', type=float, default=None, help='seconds between transactions')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    confs = [BitcoindConf.from_file(filename) for filename in args.confs] if args.confs else BitcoindConf.enumerate_confs()
+    for conf in confs:
+        compact(BtdStorage(conf), args.chunk, args.pause)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+from .balance import sum_balances
+
+from datetime import datetime
+import json
+
+from logging import getLogger
+log = getLogger(__name__)
+
+migrations = []
+
+# Rows written before add_compact_columns keep DECIMAL amounts and local time ISO DATETIMEs in the legacy columns
+SQL_LEGACY_SATOSHIS = 'CAST(ROUND({} * 100000000) AS INTEGER)'
+SQL_LEGACY_EPOCH = "CAST(strftime('%s', {}, 'utc') AS INTEGER)"
+# table -> (compact column, legacy column, conversion of the legacy value)
+COMPACT_COLUMNS = (
+    ('addr', (('created_ts', 'created', SQL_LEGACY_EPOCH),
+              ('modified_ts', 'modified', SQL_LEGACY_EPOCH))),
+    ('tx', (('amount_sat', 'amount', SQL_LEGACY_SATOSHIS),
+            ('created_ts', 'created', SQL_LEGACY_EPOCH),
+            ('modified_ts', 'modified', SQL_LEGACY_EPOCH))),
+    ('payout', (('amount_sat', 'amount', SQL_LEGACY_SATOSHIS),
+                ('created_ts', 'created', SQL_LEGACY_EPOCH),
+                ('modified_ts', 'modified', SQL_LEGACY_EPOCH))),
+)
+
+
+def migration(f):
+    """
+    Registers f(db) as the next schema version, never reorder or remove registered migrations
+    """
+    migrations.append(f)
+    return f
+
+
+@migration
+def create_tables(db):
+    db.execute('CREATE TABLE IF NOT EXISTS addr ('
+               'id INTEGER PRIMARY KEY,'
+               'address VARCHAR(34) UNIQUE,'
+               'context BLOB NULL,'
+               'contexthash VARCHAR(32) NULL,'
+               'created DATETIME,'
+               'modified DATETIME)')
+    db.execute('CREATE TABLE IF NOT EXISTS tx ('
+               'id INTEGER PRIMARY KEY,'
+               'uuid VARCHAR(36),'
+               'txid VARCHAR(64),'
+               'addr_id INTEGER,'
+               'amount DECIMAL,'
+               'confirmations INTEGER,'
+               'orig BLOB,'
+               'silenced BOOL,'
+               'created DATETIME,'
+               'modified DATETIME,'
+               'FOREIGN KEY (addr_id) REFERENCES addr(id))')
+    db.execute('CREATE TABLE IF NOT EXISTS state ('
+               'key VARCHAR(32) PRIMARY KEY,'
+               'value BLOB)')
+
+
+@migration
+def index_hot_columns(db):
+    # A transaction has a row per output, key_tx_outputs replaces this with the unique per-output key
+    db.execute('CREATE INDEX IF NOT EXISTS tx_txid ON tx (txid)')
+    # Covers the unused address anti-join
+    db.execute('CREATE INDEX IF NOT EXISTS tx_addr_id ON tx (addr_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS addr_contexthash ON addr (contexthash, address)')
+
+
+@migration
+def add_address_pool(db):
+    # Pre-generated addresses waiting to be claimed by a context
+    db.execute('ALTER TABLE addr ADD COLUMN pooled BOOL NOT NULL DEFAULT 0')
+    db.execute('CREATE INDEX IF NOT EXISTS addr_pooled ON addr (pooled) WHERE pooled=1')
+
+
+@migration
+def add_tx_block(db):
+    # Confirmations are computed from the block height and the tracked tip
+    db.execute('ALTER TABLE tx ADD COLUMN blockhash VARCHAR(64) NULL')
+    db.execute('ALTER TABLE tx ADD COLUMN blockheight INTEGER NULL')
+    db.execute('CREATE INDEX IF NOT EXISTS tx_blockheight ON tx (blockheight)')
+
+
+@migration
+def add_ctx_table(db):
+    # Contexts shared by many addresses are stored once, keyed by the addr.contexthash already pointing at them
+    db.execute('CREATE TABLE IF NOT EXISTS ctx ('
+               'hash VARCHAR(32) PRIMARY KEY,'
+               'data BLOB,'
+               'compressed BOOL NOT NULL DEFAULT 0)')
+    db.execute('INSERT OR IGNORE INTO ctx (hash, data) SELECT contexthash, context FROM addr WHERE contexthash IS NOT NULL')
+    db.execute('UPDATE addr SET context=NULL WHERE context IS NOT NULL')
+
+
+@migration
+def add_payout_table(db):
+    # Sends waiting for, or going out in, a batched sendmany
+    db.execute('CREATE TABLE IF NOT EXISTS payout ('
+               'id INTEGER PRIMARY KEY,'
+               'uuid VARCHAR(36) UNIQUE,'
+               'address VARCHAR(34),'
+               'amount DECIMAL,'
+               'contexthash VARCHAR(32) NULL,'
+               'state VARCHAR(8),'
+               'batch VARCHAR(36) NULL,'
+               'txid VARCHAR(64) NULL,'
+               'error TEXT NULL,'
+               'created DATETIME,'
+               'modified DATETIME)')
+    db.execute("CREATE INDEX IF NOT EXISTS payout_state ON payout (state) WHERE state IN ('queued', 'sending')")
+    db.execute('CREATE INDEX IF NOT EXISTS payout_batch ON payout (batch)')
+
+
+@migration
+def add_balance_tables(db):
+    # Received totals in satoshis per address and per context, kept up to date by BtdStorage.store_tx_dats
+    db.execute('ALTER TABLE tx ADD COLUMN category VARCHAR(16) NULL')
+    db.executemany('UPDATE tx SET category=? WHERE rowid=?',
+                   [(json.loads(orig).get('category'), rowid)
+                    for rowid, orig in db.execute('SELECT rowid, orig FROM tx WHERE orig IS NOT NULL')])
+    db.execute('CREATE TABLE IF NOT EXISTS addr_balance ('
+               'addr_id INTEGER PRIMARY KEY,'
+               'confirmed INTEGER NOT NULL DEFAULT 0,'
+               'unconfirmed INTEGER NOT NULL DEFAULT 0,'
+               'FOREIGN KEY (addr_id) REFERENCES addr(id))')
+    db.execute('CREATE TABLE IF NOT EXISTS ctx_balance ('
+               'contexthash VARCHAR(32) PRIMARY KEY,'
+               'confirmed INTEGER NOT NULL DEFAULT 0,'
+               'unconfirmed INTEGER NOT NULL DEFAULT 0)')
+    write_balances(db, SQL_LEGACY_SATOSHIS.format('amount'))
+
+
+def write_balances(db, amount):
+    """
+    Replace the balance aggregates with sums of the tx rows, amount being the SQL of a row's satoshis
+    """
+    db.execute('DELETE FROM addr_balance')
+    db.execute('DELETE FROM ctx_balance')
+    db.executemany('INSERT INTO addr_balance (addr_id, confirmed, unconfirmed) VALUES (?, ?, ?)',
+                   ((addr_id, confirmed, unconfirmed) for addr_id, (confirmed, unconfirmed) in sum_balances(
+                       db.execute('SELECT addr_id, {}, category, confirmations, blockheight FROM tx'.format(
+                           amount))).items()))
+    db.execute('INSERT INTO ctx_balance (contexthash, confirmed, unconfirmed)'
+               ' SELECT addr.contexthash, SUM(b.confirmed), SUM(b.unconfirmed) FROM addr_balance b'
+               ' JOIN addr ON addr.rowid = b.addr_id WHERE addr.contexthash IS NOT NULL GROUP BY addr.contexthash')
+
+
+@migration
+def add_compact_columns(db):
+    # Amounts in satoshis and timestamps in epoch seconds, read without converters. Adding columns is cheap, existing
+    # rows are converted online by btd.migrate and read through compacted() until then
+    for table, columns in COMPACT_COLUMNS:
+        for compact, _, _ in columns:
+            db.execute('ALTER TABLE {} ADD COLUMN {} INTEGER NULL'.format(table, compact))
+
+
+@migration
+def key_tx_outputs(db):
+    # A row per output and category instead of per txid, keyed on the category added by add_balance_tables
+    db.execute('ALTER TABLE tx ADD COLUMN vout INTEGER NULL')
+    db.executemany('UPDATE tx SET vout=? WHERE rowid=?',
+                   [(json.loads(orig).get('vout'), rowid)
+                    for rowid, orig in db.execute('SELECT rowid, orig FROM tx WHERE orig IS NOT NULL')])
+    # Only rows of the same output are duplicates, rows without a vout are all kept
+    db.execute('DELETE FROM tx WHERE vout IS NOT NULL AND rowid NOT IN'
+               ' (SELECT MAX(rowid) FROM tx WHERE vout IS NOT NULL GROUP BY txid, vout, category)')
+    db.execute('DROP INDEX IF EXISTS tx_txid')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tx_output ON tx (txid, vout, category)')
+    # Summed again per output, add_balance_tables summed whichever entry of a tx was stored last
+    write_balances(db, compacted('tx', 'amount_sat'))
+    # Outputs overwritten while rows were keyed on txid come back with a sync from the start of the wallet
+    db.execute("DELETE FROM state WHERE key='sync_cursor'")
+
+
+def compacted(table, compact):
+    """
+    SQL for a compact column of table, falling back to its legacy column in rows not converted yet
+    """
+    for name, columns in COMPACT_COLUMNS:
+        for column, legacy, convert in columns:
+            if name == table and column == compact:
+                return 'COALESCE({0}.{1}, {2})'.format(table, column, convert.format('{}.{}'.format(table, legacy)))
+    raise KeyError('{}.{}'.format(table, compact))
+
+
+def schema_version(db):
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate(db):
+    """
+    Upgrade db in place, each migration runs in its own transaction
+    """
+    # Take over transaction handling so DDL does not implicitly commit halfway through a migration
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS schema_version ('
+                   'version INTEGER PRIMARY KEY,'
+                   'name VARCHAR(64),'
+                   'applied DATETIME)')
+
+        current = schema_version(db)
+        for version, f in enumerate(migrations[current:], current + 1):
+            log.info("Migrating schema to version:{} ({})".format(version, f.__name__))
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                f(db)
+                db.execute('INSERT INTO schema_version (version, name, applied) VALUES (?, ?, ?)',
+                           (version, f.__name__, datetime.now()))
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+    finally:
+        db.isolation_level = isolation_level
+
+
+def query_plan_scans(db, queries):
+    """
+    Returns (name, plan detail) for every query whose plan scans a table instead of searching an index
+    """
+    scans = []
+    for name, sql, params in queries:
+        for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[-1]
+            if detail.startswith('SCAN') and 'INDEX' not in detail and 'CONSTANT ROW' not in detail:
+                scans.append((name, detail))
+    return scans
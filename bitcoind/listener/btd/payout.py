@@ -0,0 +1,187 @@
+from . import settings
+
+from bitcoin.rpc import JSONRPCError, InWarmupError
+from gevent import spawn, sleep
+from gevent.event import Event, AsyncResult
+from decimal import Decimal
+from time import time
+from uuid import uuid4
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class PayoutQueue:
+    """
+    Collects sends for up to BTD_PAYOUT_WINDOW seconds or BTD_PAYOUT_BATCH payouts and pays them with one sendmany
+
+    Payouts are persisted before they are queued. A batch is marked sending under a uuid that goes out as the sendmany
+    comment, so after a crash or a dropped connection the wallet tells whether the batch was sent. bitcoind may still be
+    working on a sendmany whose connection dropped, so a batch missing from the wallet stays sending and is only queued
+    again once BTD_PAYOUT_SETTLE_SECONDS passed without it showing up.
+    """
+    def __init__(self, rpc, storage, window=None, batch=None):
+        self.rpc = rpc
+        self.storage = storage
+        self.window = settings.BTD_PAYOUT_WINDOW if window is None else window
+        self.batch = settings.BTD_PAYOUT_BATCH if batch is None else batch
+        # (uuid, address, amount) waiting for the next flush
+        self.pending = []
+        # uuid -> AsyncResult of payouts queued by this process
+        self.results = {}
+        # Batches whose sendmany this process is waiting on
+        self.sending = set()
+        self.wake = Event()
+        self.full = Event()
+        self.greenlet = None
+        self.settler = None
+
+    def start(self):
+        if self.greenlet is None:
+            self.recover()
+            self.greenlet = spawn(self.flush_forever)
+            self.settler = spawn(self.settle_forever)
+        return self.greenlet
+
+    def send(self, address, amount, context):
+        """
+        Queue a payout, returns an AsyncResult resolving to its txid
+        """
+        uuid = str(uuid4())
+        self.storage.queue_payout(uuid, address, amount, context)
+        result = self.results[uuid] = AsyncResult()
+        self.pending.append((uuid, address, amount))
+        self.wake.set()
+        if len(self.pending) >= self.batch:
+            self.full.set()
+        return result
+
+    def recover(self):
+        """
+        Queue the payouts that never went out and settle batches interrupted by a crash
+        """
+        self.pending = [(uuid, address, amount) for uuid, address, amount, _, _ in self.storage.iter_payouts('queued')]
+        if self.pending:
+            log.info("Resuming {} queued payouts".format(len(self.pending)))
+            self.wake.set()
+        try:
+            self.settle()
+        except Exception as e:
+            log.warning("Cannot settle interrupted payout batches yet: {}".format(e))
+
+    def find_batches(self, batches):
+        """
+        batch -> txid of the batches in the wallet, batches mapping each batch to when it started sending
+        Pages back through the wallet until it reaches transactions older than every batch
+        """
+        oldest = min(batches.values()) - settings.BTD_PAYOUT_CLOCK_SLACK
+        found = {}
+        skip = 0
+        while True:
+            txs = self.rpc.list_transactions(settings.BTD_PAYOUT_RECOVERY_SCAN, skip)
+            for tx in txs:
+                if tx.get('comment') in batches and tx.get('category') == 'send':
+                    found[tx['comment']] = tx['txid']
+            if len(txs) < settings.BTD_PAYOUT_RECOVERY_SCAN or len(found) == len(batches) or \
+                    any(tx.get('time', oldest) < oldest for tx in txs):
+                return found
+            skip += len(txs)
+
+    def flush_forever(self):
+        while True:
+            self.wake.wait()
+            # Returns early once a full batch is waiting
+            self.full.wait(self.window)
+            self.wake.clear()
+            self.full.clear()
+            while self.pending:
+                payouts, self.pending = self.pending[:self.batch], self.pending[self.batch:]
+                try:
+                    self.flush(payouts)
+                except Exception as e:
+                    # Failed before anything was sent, try again
+                    log.exception("Error flushing payouts", exc_info=e)
+                    self.pending[:0] = payouts
+                    sleep(settings.BTD_STARTUP_POLL_MAX)
+
+    def settle_forever(self):
+        while True:
+            sleep(settings.BTD_PAYOUT_SETTLE_INTERVAL)
+            try:
+                self.settle()
+            except Exception as e:
+                log.warning("Cannot settle interrupted payout batches yet: {}".format(e))
+
+    def flush(self, payouts):
+        batch = str(uuid4())
+        self.storage.start_payout_batch(batch, [uuid for uuid, _, _ in payouts])
+
+        # sendmany takes each address once
+        amounts = {}
+        for _, address, amount in payouts:
+            amounts[address] = amounts.get(address, Decimal(0)) + amount
+
+        self.sending.add(batch)
+        try:
+            txid = self.rpc.send_many(amounts, batch)
+        except InWarmupError:
+            # Turned away before the wallet was loaded, nothing was sent
+            self.storage.requeue_payout_batch(batch)
+            raise
+        except JSONRPCError as e:
+            # Rejected by bitcoind, nothing was sent
+            log.error("Payout batch:{} rejected: {}".format(batch, e.error))
+            self.storage.finish_payout_batch(batch, error=str(e.error))
+            self.resolve(payouts, exception=e)
+            return
+        except Exception as e:
+            # Left sending, the wallet may still be sending it
+            log.warning("Payout batch:{} interrupted, settling it from the wallet: {}".format(batch, e))
+            return
+        finally:
+            self.sending.discard(batch)
+
+        try:
+            self.storage.finish_payout_batch(batch, txid)
+        except Exception as e:
+            # Sent regardless, left sending for settle to record from the wallet
+            log.exception("Error recording payout batch:{} as tx:{}".format(batch, txid), exc_info=e)
+        self.resolve(payouts, txid)
+
+    def settle(self):
+        """
+        Look the batches left sending up in the wallet, queueing them again once they are definitely missing
+        """
+        batches = {}
+        for uuid, address, amount, batch, modified in self.storage.iter_payouts('sending'):
+            # Marked sending together, when the batch started sending
+            if batch not in self.sending:
+                batches.setdefault(batch, (modified, []))[1].append((uuid, address, amount))
+        if not batches:
+            return
+
+        found = self.find_batches(dict((batch, started) for batch, (started, _) in batches.items()))
+        now = time()
+        for batch, (started, payouts) in batches.items():
+            txid = found.get(batch)
+            if txid is not None:
+                log.info("Payout batch:{} was sent as tx:{}".format(batch, txid))
+                self.storage.finish_payout_batch(batch, txid)
+                self.resolve(payouts, txid)
+            elif now - started >= settings.BTD_PAYOUT_SETTLE_SECONDS:
+                log.warning("Payout batch:{} is not in the wallet {}s after it was sent, queueing it again".format(
+                    batch, int(now - started)))
+                self.storage.requeue_payout_batch(batch)
+                self.pending[:0] = payouts
+                self.wake.set()
+
+    def resolve(self, payouts, txid=None, exception=None):
+        for uuid, _, _ in payouts:
+            result = self.results.pop(uuid, None)
+            if result is None:
+                # Queued before a restart, nobody is waiting
+                continue
+            if exception is None:
+                result.set(txid)
+            else:
+                result.set_exception(exception)
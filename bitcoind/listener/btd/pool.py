@@ -0,0 +1,95 @@
+from gevent import spawn, sleep
+from gevent.lock import BoundedSemaphore
+
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of keep-alive connections shared between greenlets
+
+    Connections are checked out LIFO so the warmest ones are reused first. Idle connections past
+    max_idle are evicted, and check(conn) is called before handing an idle connection out again. A connection is only
+    reused after its block exits normally, an error or an interruption (Timeout, kill) may leave it halfway through a
+    request.
+    """
+    def __init__(self, factory, size, max_idle=None, check=None, close=None):
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.check = check
+        self.close = close
+        self.idle = deque()
+        self.slots = BoundedSemaphore(size)
+        self.reaper = None
+
+    def checkout(self):
+        self.slots.acquire()
+        try:
+            now = monotonic()
+            while self.idle:
+                conn, used = self.idle.pop()
+                if self.max_idle is not None and now - used > self.max_idle:
+                    self.discard(conn)
+                    continue
+                if self.check is not None and not self.check(conn):
+                    log.info("Discarding unhealthy pooled connection")
+                    self.discard(conn)
+                    continue
+                return conn
+            return self.factory()
+        except:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, discard=False):
+        if discard:
+            self.discard(conn)
+        else:
+            self.idle.append((conn, monotonic()))
+            if self.max_idle is not None and self.reaper is None:
+                self.reaper = spawn(self.reap_forever)
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        except BaseException:
+            self.checkin(conn, discard=True)
+            raise
+        else:
+            self.checkin(conn)
+
+    def discard(self, conn):
+        if self.close is not None:
+            try:
+                self.close(conn)
+            except Exception as e:
+                log.exception("Error closing pooled connection", exc_info=e)
+
+    def clear(self):
+        while self.idle:
+            conn, _ = self.idle.pop()
+            self.discard(conn)
+
+    def evict_idle(self):
+        deadline = monotonic() - self.max_idle
+        # Oldest connections sit at the left of the deque
+        while self.idle and self.idle[0][1] < deadline:
+            conn, _ = self.idle.popleft()
+            self.discard(conn)
+
+    def reap_forever(self):
+        try:
+            while self.idle:
+                sleep(self.max_idle)
+                self.evict_idle()
+        finally:
+            self.reaper = None
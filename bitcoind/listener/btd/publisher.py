@@ -0,0 +1,161 @@
+"""
+Each ZMQ message is [topic, conf, record, record, ...], the topic being the ascii context hash (empty without a context)
+so consumers can subscribe server side to the contexts they own. Every conf numbers its records separately, from its
+event log, and listeners of all confs share the publisher, so a seq only orders records of the same conf frame.
+
+Records are packed little endian:
+    seq Q, change B, category B, confirmations i, amount (satoshis) q, txid 32s, uuid 16s,
+    address length B, address, context length i (-1 for no context), context
+"""
+import zmq.green as zmq
+from gevent import spawn_later
+
+from . import settings
+from . import int2bit, bit2int
+
+from collections import namedtuple
+from uuid import UUID
+import binascii
+import struct
+
+from logging import getLogger
+log = getLogger(__name__)
+
+CHANGES = ('new', 'modified', 'confirmations')
+CATEGORIES = ('send', 'receive', 'move', 'generate', 'immature', 'orphan')
+UNKNOWN = 255
+
+record_header = struct.Struct('<QBBiq32s16sB')
+context_length = struct.Struct('<i')
+
+Event = namedtuple('Event', 'seq uuid change category txid addr context amount confirmations')
+
+
+def encode_txinfo(seq, txinfo):
+    addr = txinfo.addr.encode()
+    context = txinfo.context
+    return b''.join((
+        record_header.pack(
+            seq,
+            CHANGES.index(txinfo.change) if txinfo.change in CHANGES else UNKNOWN,
+            CATEGORIES.index(txinfo.category) if txinfo.category in CATEGORIES else UNKNOWN,
+            txinfo.confirmations,
+            bit2int(txinfo.amount),
+            binascii.a2b_hex(txinfo.txid),
+            txinfo.uuid.bytes,
+            len(addr)),
+        addr,
+        context_length.pack(-1 if context is None else len(context)),
+        context or b''))
+
+
+def decode_record(record, offset=0):
+    """
+    Returns the Event at offset and the offset of the next record
+    """
+    seq, change, category, confirmations, amount, txid, uuid, addr_len = record_header.unpack_from(record, offset)
+    offset += record_header.size
+    addr = record[offset:offset + addr_len].decode()
+    offset += addr_len
+    ctx_len, = context_length.unpack_from(record, offset)
+    offset += context_length.size
+    context = None
+    if ctx_len >= 0:
+        context = bytes(record[offset:offset + ctx_len])
+        offset += ctx_len
+
+    return Event(
+        seq=seq,
+        uuid=UUID(bytes=bytes(uuid)),
+        change=CHANGES[change] if change < len(CHANGES) else None,
+        category=CATEGORIES[category] if category < len(CATEGORIES) else None,
+        txid=binascii.b2a_hex(txid).decode(),
+        addr=addr,
+        context=context,
+        amount=int2bit(amount),
+        confirmations=confirmations), offset
+
+
+def decode_message(msg):
+    """
+    Decode a received [topic, conf, record, ...] multipart message into the conf and its Events
+    """
+    return msg[1].decode(), [decode_record(record)[0] for record in msg[2:]]
+
+
+class BtdPublisher:
+    """
+    Publishes transaction diffs on a ZMQ PUB socket, batching records per topic and conf for BTD_PUB_BATCH_WINDOW
+    seconds
+    """
+    def __init__(self, endpoint=None, hwm=None, window=None, bind=True, context=None):
+        self.endpoint = endpoint or 'tcp://{}:{}'.format(settings.BTD_PUB_BIND, settings.BTD_PUB_PORT)
+        self.window = settings.BTD_PUB_BATCH_WINDOW if window is None else window
+        # conf -> last seq published, for confs without an event log to number their records
+        self.seqs = {}
+        self.pending = {}
+        self.flusher = None
+
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, settings.BTD_PUB_HWM if hwm is None else hwm)
+        if bind:
+            self.socket.bind(self.endpoint)
+        else:
+            # Publishing through a forwarder that owns the public port
+            self.socket.connect(self.endpoint)
+        log.info("Publishing diffs on {}".format(self.endpoint))
+
+    def publish(self, topic, conf, txinfo):
+        """
+        Queue txinfo under topic with conf's next sequence number, returns the sequence number
+        """
+        seq = self.seqs.get(conf, 0) + 1
+        self.publish_record(topic, conf, seq, encode_txinfo(seq, txinfo))
+        return seq
+
+    def publish_record(self, topic, conf, seq, record):
+        """
+        Queue a record of conf encoded elsewhere, such as by the event log
+        """
+        self.seqs[conf] = max(self.seqs.get(conf, 0), seq)
+        key = (topic, conf.encode())
+        if not self.window:
+            self.socket.send_multipart(key + (record,))
+            return
+
+        records = self.pending.setdefault(key, [])
+        records.append(record)
+        if len(records) >= settings.BTD_PUB_BATCH_MAX:
+            self.socket.send_multipart(list(key) + self.pending.pop(key))
+        elif self.flusher is None:
+            self.flusher = self.later(self.window, self.flush_later)
+
+    def later(self, seconds, f):
+        return spawn_later(seconds, f)
+
+    def flush_later(self):
+        self.flusher = None
+        self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        for key, records in pending.items():
+            self.socket.send_multipart(list(key) + records)
+
+    def close(self):
+        self.flush()
+        self.socket.close()
+
+
+publishers = {}
+
+
+def connect_publisher(endpoint=None):
+    """
+    :rtype: BtdPublisher
+    """
+    global publishers
+    if endpoint not in publishers:
+        publishers[endpoint] = BtdPublisher(endpoint)
+    return publishers[endpoint]
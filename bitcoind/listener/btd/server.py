@@ -0,0 +1,229 @@
+"""
+Requests are JSON objects {"id", "method", "params", "conf", "deadline"} sent from a DEALER (pipelined, matched by id)
+or REQ socket. Replies are {"id", "result", "error"}, errors being {"code", "message"}. Amounts are read as decimals,
+either JSON numbers or strings, and must be whole satoshis.
+"""
+import zmq.green as zmq
+from gevent import spawn, Timeout
+from gevent.queue import Queue
+
+from . import settings
+from .engine import BtdRPC
+from . import metrics
+
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from inspect import signature
+from time import monotonic
+import json
+
+from logging import getLogger
+log = getLogger(__name__)
+
+ERROR_INVALID = -32600
+ERROR_METHOD = -32601
+ERROR_INTERNAL = -32603
+ERROR_OVERLOADED = -1
+ERROR_DEADLINE = -2
+
+SATOSHI = Decimal('0.00000001')
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def parse_amount(amount):
+    if isinstance(amount, float) or isinstance(amount, bool):
+        raise RPCError(ERROR_INVALID, 'amount must be a decimal')
+    try:
+        amount = Decimal(amount)
+        whole = amount.is_finite() and amount > 0 and amount == amount.quantize(SATOSHI)
+    except (InvalidOperation, TypeError, ValueError):
+        raise RPCError(ERROR_INVALID, 'amount must be a decimal')
+    if not whole:
+        raise RPCError(ERROR_INVALID, 'amount must be a positive number of whole satoshis')
+    return amount
+
+
+def parse_deadline(deadline):
+    if deadline is None:
+        return settings.BTD_RPC_DEADLINE
+    try:
+        valid = not isinstance(deadline, bool) and 0 < float(deadline) < float('inf')
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        raise RPCError(ERROR_INVALID, 'deadline must be a positive number of seconds')
+    return min(float(deadline), settings.BTD_RPC_DEADLINE)
+
+
+class BtdRPCServer:
+    """
+    Serves BtdRPC for every conf on a ZMQ ROUTER socket from a bounded pool of worker greenlets
+    """
+    # Methods that move money are never interrupted once started, their deadline only applies while queued
+    methods = {
+        'get_address': True,
+        'send': False,
+        'get_balance': True,
+    }
+    # Parameters that must be strings, or None where the method defaults them to None
+    strings = ('context', 'address')
+
+    def __init__(self, btd_rpcs, endpoint=None, workers=None, max_pending=None):
+        self.btd_rpcs = btd_rpcs
+        self.endpoint = endpoint or 'tcp://{}:{}'.format(settings.BTD_RPC_BIND, settings.BTD_RPC_PORT)
+        self.workers = workers or settings.BTD_RPC_WORKERS
+        self.max_pending = max_pending or settings.BTD_RPC_MAX_PENDING
+        self.requests = Queue()
+        self.replies = Queue()
+        self.stats = Counter()
+        self.socket = None
+        metrics.collectors[('server', self.endpoint)] = self.collect
+
+    def serve_forever(self):
+        self.socket = zmq.Context.instance().socket(zmq.ROUTER)
+        self.socket.bind(self.endpoint)
+        log.info("Serving BtdRPC on {}".format(self.endpoint))
+
+        greenlets = [spawn(self.work_forever) for _ in range(self.workers)]
+        greenlets.append(spawn(self.reply_forever))
+        try:
+            self.receive_forever()
+        finally:
+            for g in greenlets:
+                g.kill()
+
+    def collect(self):
+        return [
+            ('btd_server_requests_total', 'counter', 'BtdRPC requests by outcome', ('event',), None,
+             dict(((event,), count) for event, count in self.stats.items())),
+            ('btd_server_pending', 'gauge', 'BtdRPC requests waiting for a worker', (), None, {(): self.requests.qsize()}),
+        ]
+
+    def receive_forever(self):
+        while True:
+            frames = self.socket.recv_multipart()
+            envelope, payload = frames[:-1], frames[-1]
+            self.stats['received'] += 1
+
+            if self.requests.qsize() >= self.max_pending:
+                self.stats['shed'] += 1
+                self.reply(envelope, self.request_id(payload), error=RPCError(ERROR_OVERLOADED, 'overloaded'))
+                continue
+
+            self.requests.put((monotonic(), envelope, payload))
+
+    def work_forever(self):
+        while True:
+            received, envelope, payload = self.requests.get()
+            request_id = None
+            try:
+                request = self.parse(payload)
+                request_id = request.get('id')
+                result = self.dispatch(request, received)
+            except RPCError as e:
+                self.reply(envelope, request_id, error=e)
+            except Exception as e:
+                log.exception("Error handling BtdRPC request", exc_info=e)
+                self.reply(envelope, request_id, error=RPCError(ERROR_INTERNAL, str(e)))
+            else:
+                self.reply(envelope, request_id, result=result)
+
+    def reply_forever(self):
+        # One sender so replies from concurrent workers never interleave frames
+        while True:
+            self.socket.send_multipart(self.replies.get())
+
+    def reply(self, envelope, request_id, result=None, error=None):
+        if error is not None:
+            self.stats['errors'] += 1
+            error = {'code': error.code, 'message': error.message}
+        self.replies.put(envelope + [json.dumps({'id': request_id, 'result': result, 'error': error}).encode()])
+
+    @staticmethod
+    def parse(payload):
+        try:
+            # Amounts are not rounded through floats
+            request = json.loads(payload.decode(), parse_float=Decimal)
+        except ValueError:
+            raise RPCError(ERROR_INVALID, 'request is not JSON')
+        if not isinstance(request, dict):
+            raise RPCError(ERROR_INVALID, 'request is not an object')
+        return request
+
+    def request_id(self, payload):
+        try:
+            return self.parse(payload).get('id')
+        except RPCError:
+            return None
+
+    def dispatch(self, request, received):
+        method = request.get('method')
+        if method not in self.methods:
+            raise RPCError(ERROR_METHOD, 'unknown method:{}'.format(method))
+
+        conf = request.get('conf')
+        if conf is None and len(self.btd_rpcs) == 1:
+            conf = next(iter(self.btd_rpcs))
+        if conf not in self.btd_rpcs:
+            raise RPCError(ERROR_INVALID, 'unknown conf:{}'.format(conf))
+
+        params = request.get('params') or {}
+        if not isinstance(params, dict):
+            raise RPCError(ERROR_INVALID, 'params must be an object')
+
+        deadline = parse_deadline(request.get('deadline'))
+        remaining = deadline - (monotonic() - received)
+        if remaining <= 0:
+            self.stats['expired'] += 1
+            raise RPCError(ERROR_DEADLINE, 'deadline exceeded')
+
+        handler = getattr(self, 'rpc_' + method)
+        parameters = signature(handler).parameters
+        try:
+            signature(handler).bind(self.btd_rpcs[conf], **params)
+        except TypeError as e:
+            raise RPCError(ERROR_INVALID, str(e))
+        for name in self.strings:
+            value = params.get(name)
+            if name in params and not isinstance(value, str) and not (value is None and parameters[name].default is None):
+                raise RPCError(ERROR_INVALID, '{} must be a string'.format(name))
+
+        try:
+            if not self.methods[method]:
+                return handler(self.btd_rpcs[conf], **params)
+            with Timeout(remaining):
+                return handler(self.btd_rpcs[conf], **params)
+        except Timeout:
+            self.stats['expired'] += 1
+            raise RPCError(ERROR_DEADLINE, 'deadline exceeded')
+
+    @staticmethod
+    def rpc_get_address(btd_rpc, context):
+        return btd_rpc.get_address(context.encode())
+
+    @staticmethod
+    def rpc_send(btd_rpc, address, amount, context):
+        return btd_rpc.send(address, parse_amount(amount), context.encode())
+
+    @staticmethod
+    def rpc_get_balance(btd_rpc, context=None, address=None):
+        balance = btd_rpc.get_balance(None if context is None else context.encode(), address)
+        return {'confirmed': str(balance.confirmed), 'unconfirmed': str(balance.unconfirmed)}
+
+
+def start_rpc_server(confs, storages=None):
+    """
+    Spawn a server for every conf in confs (filename -> BitcoindConf), on storages (filename -> BtdStorage) when given
+    """
+    storages = storages or {}
+    btd_rpcs = dict((filename, BtdRPC(conf, storage=storages.get(filename))) for filename, conf in confs.items())
+    for btd_rpc in btd_rpcs.values():
+        btd_rpc.start()
+    server = BtdRPCServer(btd_rpcs)
+    return spawn(server.serve_forever)
@@ -3,8 +3,115 @@ import os
 BITCOIN_CONF_DIR = '/etc/bitcoin'
 BITCOIN_DATA_DIR = '/var/bitcoin'
 BTD_PUB_PORT = 10033
+BTD_PUB_BIND = '127.0.0.1'
+BTD_PUB_HWM = 100000
+# Seconds records are held to be sent together per topic, 0 sends immediately
+BTD_PUB_BATCH_WINDOW = 0.005
+BTD_PUB_BATCH_MAX = 1000
+# Worker processes the listeners are spread over, 0 runs them all in this process
+BTD_WORKER_PROCESSES = 0
+# Where worker processes publish to be forwarded onto BTD_PUB_PORT, None uses an ipc socket in BTD_SQLITE_DIR
+BTD_PUB_FORWARD_ENDPOINT = None
+BTD_HEALTH_INTERVAL = 5
+# Workers silent for this many seconds are terminated and restarted
+BTD_WORKER_HANG_TIMEOUT = 60
+# Serve Prometheus metrics on this port, nothing is recorded while None
+BTD_METRICS_PORT = None
+BTD_METRICS_BIND = '127.0.0.1'
+# Restart delay doubles up to MAX, and resets once a listener ran for STABLE seconds
+BTD_RESTART_BACKOFF_MIN = 1
+BTD_RESTART_BACKOFF_MAX = 60
+BTD_RESTART_STABLE = 300
+# Durable, replayable log of published diffs under BTD_SQLITE_DIR
+BTD_EVENTLOG = True
+BTD_EVENTLOG_SEGMENT_BYTES = 64 * 1024 * 1024
+# fsync after this many records or seconds, whichever comes first
+BTD_EVENTLOG_FSYNC_RECORDS = 1000
+BTD_EVENTLOG_FSYNC_INTERVAL = 0.05
+# Seconds consumer acks are held before consumers.json is rewritten, acks lost in a crash are delivered again
+BTD_EVENTLOG_ACK_INTERVAL = 1
+# Segments past either limit are removed even when consumers have not acknowledged them
+BTD_EVENTLOG_RETENTION_BYTES = 1024 * 1024 * 1024
+BTD_EVENTLOG_RETENTION_SECONDS = 7 * 24 * 60 * 60
+# Diffs are POSTed as JSON batches to these endpoints from the event log, url -> context hashes to deliver or None for all
+BTD_WEBHOOKS = {}
+# Most diffs per POST, and seconds new diffs are held so they go out together
+BTD_WEBHOOK_BATCH_MAX = 100
+# Endpoints added to BTD_WEBHOOKS start with the diffs logged from then on, True sends them the retained log first
+BTD_WEBHOOK_BACKFILL = False
+BTD_WEBHOOK_BATCH_WINDOW = 0.05
+# Keep-alive connections per endpoint host, closed after IDLE seconds unused
+BTD_WEBHOOK_POOL_SIZE = 4
+BTD_WEBHOOK_POOL_IDLE = 30
+BTD_WEBHOOK_TIMEOUT = 10
+# Retry delay doubles from MIN up to MAX seconds while an endpoint keeps failing
+BTD_WEBHOOK_RETRY_MIN = 1
+BTD_WEBHOOK_RETRY_MAX = 300
 BTD_RPC_PORT = 10044
+BTD_RPC_BIND = '127.0.0.1'
+# Requests handled concurrently, queued beyond that and shed past MAX_PENDING
+BTD_RPC_WORKERS = 16
+BTD_RPC_MAX_PENDING = 1000
+# Upper bound in seconds on a request's deadline, including time spent queued
+BTD_RPC_DEADLINE = 30
 BTD_SQLITE_DIR = '/var/btd/'
+BTD_SQLITE_SYNCHRONOUS = 'NORMAL'
+BTD_SQLITE_CACHE_KB = 16384
+# Most storage operations committed together in one transaction by the storage thread
+BTD_SQLITE_GROUP_COMMIT = 100
+# Rows converted per transaction by btd.migrate, and seconds it pauses between them to let writers in
+BTD_MIGRATE_CHUNK = 1000
+BTD_MIGRATE_PAUSE = 0.05
+# Contexts of at least this many bytes are stored zlib compressed, None stores them as is
+BTD_CONTEXT_COMPRESS_BYTES = 256
+# Entries in each of the storage's context LRU caches, 0 disables them
+BTD_CONTEXT_CACHE_SIZE = 10000
+# Transactions with fewer confirmations are relisted on every sync, so reorgs up to this depth are picked up
+BTD_SYNC_CONFIRMATIONS = 10
+# Confirmation counts announced with a 'confirmations' event, computed locally from the tracked tip, () announces none
+BTD_CONFIRMATION_MILESTONES = (1, 3, 6)
+# Heights of this many recent blocks are remembered to place synced transactions without asking bitcoind
+BTD_CONFIRMATION_HEIGHT_CACHE = 1000
+# Calls per JSON-RPC batch request
+BTD_RPC_BATCH_SIZE = 500
+# Pooled RPC connections per conf, None uses the conf's rpcthreads
+BTD_RPC_POOL_SIZE = None
+# Seconds before an idle pooled connection is closed, below bitcoind's rpcservertimeout
+BTD_RPC_POOL_IDLE = 20
+# Backoff in seconds between readiness probes while bitcoind starts and warms up
+BTD_STARTUP_POLL_MIN = 0.05
+BTD_STARTUP_POLL_MAX = 2
+# Pre-generated addresses are refilled up to HIGH once fewer than LOW remain, HIGH = 0 disables the pool
+BTD_ADDRESS_POOL_LOW = 20
+BTD_ADDRESS_POOL_HIGH = 100
+BTD_ADDRESS_POOL_INTERVAL = 60
+# Collect sends for up to this many seconds and pay them with one sendmany, None sends each right away
+BTD_PAYOUT_WINDOW = None
+# Most payouts in one sendmany
+BTD_PAYOUT_BATCH = 100
+# Wallet transactions per listtransactions page searched for an interrupted batch's comment
+BTD_PAYOUT_RECOVERY_SCAN = 1000
+# An interrupted batch missing from the wallet is sent again after SECONDS, the wallet is checked every INTERVAL seconds
+BTD_PAYOUT_SETTLE_SECONDS = 600
+BTD_PAYOUT_SETTLE_INTERVAL = 30
+# Seconds bitcoind's clock may be behind when paging back to the time a batch started sending
+BTD_PAYOUT_CLOCK_SLACK = 300
+# Seconds between checks of the balance aggregates against the tx table and bitcoind, None disables them
+BTD_BALANCE_RECONCILE_INTERVAL = 3600
+# rawtx matching: addresses held exactly in memory before switching to a bloom filter
+BTD_WATCH_EXACT_LIMIT = 1000000
+BTD_WATCH_BLOOM_FP = 0.001
+# Seconds between picking up newly stored addresses
+BTD_WATCH_REFRESH = 1
+# ZMQ messages buffered between the receiver and processor, overflow is dropped and forces a sync
+BTD_LISTEN_QUEUE_SIZE = 10000
+# Seconds the processor waits between syncs so bursts coalesce
+BTD_PROCESS_INTERVAL = 0.1
+# Record the ZMQ messages and RPC responses each listener sees into this directory for bench.replay, None disables it
+BTD_CAPTURE_DIR = None
+# Seconds a capture records for before it stops, None records until the listener stops
+BTD_CAPTURE_SECONDS = 600
+BTD_CAPTURE_FLUSH_INTERVAL = 1
 
 from bitcoin import SelectParams
-SelectParams('regtest')
+SelectParams('regtest')
\ No newline at end of file
@@ -0,0 +1,218 @@
+import zmq.green as zmq
+from gevent import spawn, sleep, monkey
+from gevent.socket import wait_read
+
+from . import settings
+from .bitcoind import load_confs, start_nodes
+from .engine import BtdListener, BtdStorage
+from .publisher import BtdPublisher
+from .server import start_rpc_server
+from . import metrics
+
+import multiprocessing
+from os import path
+from time import monotonic
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+def start_all():
+    """
+    Start every configured bitcoind, then supervise a listener per conf and serve BtdRPC
+    Returns the greenlets to join
+    """
+    confs = load_confs()
+    start_nodes(confs)
+
+    supervisor = Supervisor(confs)
+    # The RPC server shares the supervisor's storages, one writer and one set of context caches per conf
+    greenlets = supervisor.start() + [start_rpc_server(confs, supervisor.storages())]
+    if metrics.enabled():
+        greenlets.append(spawn(metrics.serve_metrics, supervisor.metrics))
+    return greenlets
+
+
+def forward_endpoint():
+    return settings.BTD_PUB_FORWARD_ENDPOINT or 'ipc://' + path.join(settings.BTD_SQLITE_DIR, 'pub.ipc')
+
+
+def forward_pub():
+    """
+    Republish worker processes' diffs on the public PUB port, passing subscriptions upstream
+    """
+    context = zmq.Context.instance()
+    xsub = context.socket(zmq.XSUB)
+    xsub.bind(forward_endpoint())
+    xpub = context.socket(zmq.XPUB)
+    xpub.setsockopt(zmq.SNDHWM, settings.BTD_PUB_HWM)
+    xpub.bind('tcp://{}:{}'.format(settings.BTD_PUB_BIND, settings.BTD_PUB_PORT))
+
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    while True:
+        for socket, _ in poller.poll():
+            if socket is xsub:
+                xpub.send_multipart(xsub.recv_multipart())
+            else:
+                xsub.send_multipart(xpub.recv_multipart())
+
+
+def settings_snapshot():
+    return dict((name, getattr(settings, name)) for name in dir(settings) if name.isupper())
+
+
+def run_worker(filenames, health, overrides):
+    """
+    Worker process entry point, listens to the confs in filenames and reports health through the health pipe
+    """
+    # Started fresh rather than forked, a forked hub would keep running the parent's greenlets
+    monkey.patch_all()
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    confs = load_confs()
+    pub = BtdPublisher(forward_endpoint(), bind=False)
+    listeners = [BtdListener(confs[filename], publisher=pub) for filename in filenames]
+    greenlets = [spawn(listener.listen_forever) for listener in listeners]
+
+    while True:
+        for g in greenlets:
+            if g.ready() and not g.successful():
+                # Exit so the supervisor restarts the process
+                raise g.exception
+        health.send((dict((listener.conf.filename, listener.health()) for listener in listeners), metrics.snapshot()))
+        sleep(settings.BTD_HEALTH_INTERVAL)
+
+
+class Worker:
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.process = None
+        self.health = None
+        self.conf_health = {}
+        self.metrics = None
+        self.heartbeat = None
+        self.started = None
+        self.restarts = 0
+
+    def start(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run_worker, args=(self.filenames, sender, settings_snapshot()), name='btd-' + '-'.join(self.filenames), daemon=True)
+        self.process.start()
+        sender.close()
+        self.health = receiver
+        self.heartbeat = self.started = monotonic()
+        log.info("Started worker pid:{} for confs:{}".format(self.process.pid, self.filenames))
+
+
+class Supervisor:
+    """
+    Runs a BtdListener per conf, spread over BTD_WORKER_PROCESSES processes or in this process when 0
+    Crashed listeners are restarted with exponential backoff, reusing the conf's storage
+    """
+    def __init__(self, confs, processes=None):
+        self.confs = confs
+        self.processes = settings.BTD_WORKER_PROCESSES if processes is None else processes
+        self.workers = []
+        self.listeners = {}
+        self.conf_storages = {}
+
+    def start(self):
+        if not self.processes:
+            return [spawn(self.supervise_listener, conf) for conf in self.confs.values()]
+
+        filenames = sorted(self.confs)
+        count = min(self.processes, len(filenames))
+        self.workers = [Worker(filenames[i::count]) for i in range(count)]
+        return [spawn(forward_pub)] + [spawn(self.supervise_worker, worker) for worker in self.workers]
+
+    def storages(self):
+        """
+        filename -> BtdStorage of every conf, opened once and shared with listeners in this process
+        """
+        for filename, conf in self.confs.items():
+            if filename not in self.conf_storages:
+                self.conf_storages[filename] = BtdStorage(conf)
+        return dict(self.conf_storages)
+
+    @staticmethod
+    def backoff(delay, ran_for):
+        if delay is None or ran_for > settings.BTD_RESTART_STABLE:
+            return settings.BTD_RESTART_BACKOFF_MIN
+        return min(delay * 2, settings.BTD_RESTART_BACKOFF_MAX)
+
+    def supervise_listener(self, conf):
+        delay = None
+        while True:
+            listener = self.listeners[conf.filename] = BtdListener(conf, storage=self.storages()[conf.filename])
+            started = monotonic()
+            g = spawn(listener.listen_forever)
+            try:
+                g.join()
+            finally:
+                # Its event log and capture files are opened again by the next listener
+                listener.close()
+            if g.successful() and monotonic() - started < settings.BTD_RESTART_STABLE:
+                # listen_forever returns straight away for confs without ZMQ
+                return
+            delay = self.backoff(delay, monotonic() - started)
+            log.error("Listener for conf:{} stopped, restarting in {}s".format(conf.filename, delay), exc_info=g.exception)
+            sleep(delay)
+
+    def supervise_worker(self, worker):
+        delay = None
+        worker.start()
+        while True:
+            try:
+                wait_read(worker.health.fileno(), timeout=settings.BTD_HEALTH_INTERVAL)
+                while worker.health.poll():
+                    worker.conf_health, worker.metrics = worker.health.recv()
+                    worker.heartbeat = monotonic()
+            except (OSError, EOFError):
+                # Timed out waiting, or the pipe closed because the process is gone
+                pass
+
+            if worker.process.is_alive():
+                if monotonic() - worker.heartbeat > settings.BTD_WORKER_HANG_TIMEOUT:
+                    log.error("Worker pid:{} stopped reporting, terminating".format(worker.process.pid))
+                    worker.process.terminate()
+                    worker.process.join(1)
+                continue
+
+            delay = self.backoff(delay, monotonic() - worker.started)
+            log.error("Worker pid:{} for confs:{} exited with:{}, restarting in {}s".format(
+                worker.process.pid, worker.filenames, worker.process.exitcode, delay))
+            worker.health.close()
+            worker.restarts += 1
+            sleep(delay)
+            worker.start()
+
+    def health(self):
+        """
+        Aggregated health of every conf's listener
+        """
+        if not self.processes:
+            return dict((filename, listener.health()) for filename, listener in self.listeners.items())
+
+        now = monotonic()
+        health = {}
+        for worker in self.workers:
+            for filename in worker.filenames:
+                conf_health = dict(worker.conf_health.get(filename, {}))
+                conf_health.update({
+                    'pid': worker.process.pid,
+                    'alive': worker.process.is_alive(),
+                    'restarts': worker.restarts,
+                    'heartbeat_age': now - worker.heartbeat,
+                })
+                health[filename] = conf_health
+        return health
+
+    def metrics(self):
+        """
+        This process' metrics merged with the last snapshot reported by every worker
+        """
+        return metrics.merge([metrics.snapshot()] + [worker.metrics for worker in self.workers])
@@ -0,0 +1,156 @@
+from . import settings
+
+from bitcoin.core import CTransaction, b2lx
+from bitcoin.core.script import CScript
+from bitcoin.core.serialize import SerializationError
+from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
+
+from hashlib import md5
+from math import log as ln
+from time import monotonic
+import struct
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set, false positives run at about fp_rate until capacity items are added
+    """
+    def __init__(self, capacity, fp_rate):
+        self.capacity = capacity
+        self.nbits = max(8, int(-capacity * ln(fp_rate) / (ln(2) ** 2)))
+        self.nhashes = max(1, int(round(self.nbits / capacity * ln(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # Double hashing, both halves of one digest
+        h1, h2 = struct.unpack('<QQ', md5(item).digest())
+        return ((h1 + i * h2) % self.nbits for i in range(self.nhashes))
+
+    def add(self, item):
+        for p in self.positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(item))
+
+
+def address_script(address):
+    try:
+        return bytes(CBitcoinAddress(address).to_scriptPubKey())
+    except CBitcoinAddressError:
+        log.warning("Cannot watch address:{}".format(address))
+        return None
+
+
+def decode_tx(raw):
+    """
+    The CTransaction of a rawtx, None when this python-bitcoinlib cannot decode it
+    """
+    try:
+        return CTransaction.deserialize(raw)
+    except (SerializationError, ValueError) as e:
+        log.debug("Cannot decode rawtx: {}".format(e))
+        return None
+
+
+def tx_txid(tx):
+    # From python-bitcoinlib 0.10 GetHash includes the witness, GetTxid does not
+    return b2lx(tx.GetTxid() if hasattr(tx, 'GetTxid') else tx.GetHash())
+
+
+def script_address(script):
+    try:
+        return str(CBitcoinAddress.from_scriptPubKey(CScript(script)))
+    except CBitcoinAddressError:
+        return None
+
+
+class WatchIndex:
+    """
+    In memory index of the addr table's scriptPubKeys and the wallet's txids, matches raw transactions without RPC
+
+    Past BTD_WATCH_EXACT_LIMIT addresses only a bloom filter is kept and its hits are confirmed against storage.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.scripts = set()
+        self.bloom = None
+        self.txids = set()
+        self.last_rowid = 0
+        self.loaded = None
+
+    def load(self):
+        """
+        Pick up addr rows added since the last load
+        """
+        for rowid, address in self.storage.iter_addresses(self.last_rowid):
+            self.add_address(address)
+            self.last_rowid = rowid
+        self.loaded = monotonic()
+
+    def load_txids(self):
+        self.txids.update(self.storage.iter_txids())
+
+    def warm_txids(self, txs):
+        """
+        Collect txids from rows passing through, rows starting with the txid
+        """
+        for tx in txs:
+            self.txids.add(tx[0])
+            yield tx
+
+    def stale(self):
+        return self.loaded is None or monotonic() - self.loaded > settings.BTD_WATCH_REFRESH
+
+    def refresh(self):
+        if self.stale():
+            self.load()
+
+    def add_address(self, address):
+        script = address_script(address)
+        if script is None:
+            return
+
+        if self.bloom is None:
+            self.scripts.add(script)
+            if len(self.scripts) > settings.BTD_WATCH_EXACT_LIMIT:
+                self.build_bloom(self.scripts)
+                self.scripts = set()
+        else:
+            if self.bloom.count >= self.bloom.capacity:
+                # Rebuild with headroom before the false positive rate degrades
+                self.build_bloom(script for _, address in self.storage.iter_addresses(0)
+                                 for script in (address_script(address),) if script is not None)
+            self.bloom.add(script)
+
+    def build_bloom(self, scripts):
+        scripts = list(scripts)
+        log.info("Watching {} addresses through a bloom filter".format(len(scripts)))
+        self.bloom = BloomFilter(max(2 * len(scripts), settings.BTD_WATCH_EXACT_LIMIT), settings.BTD_WATCH_BLOOM_FP)
+        for script in scripts:
+            self.bloom.add(script)
+
+    def watches(self, script):
+        if self.bloom is None:
+            return script in self.scripts
+        if script not in self.bloom:
+            return False
+        address = script_address(script)
+        return address is not None and self.storage.has_address(address)
+
+    def matches(self, tx):
+        """
+        Whether a deserialized CTransaction spends from a wallet transaction or pays a watched address
+        """
+        for txin in tx.vin:
+            if b2lx(txin.prevout.hash) in self.txids:
+                return True
+        for txout in tx.vout:
+            if self.watches(bytes(txout.scriptPubKey)):
+                return True
+        return False
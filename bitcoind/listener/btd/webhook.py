@@ -0,0 +1,210 @@
+"""
+Each endpoint is a consumer of the conf's event log named webhook:<url>. Diffs are read from its last acknowledged seq
+and POSTed in order as {"conf", "events": [...]}, the seq being acknowledged once the endpoint answered 2xx. A batch
+is retried until it is delivered, so the log is the persisted retry queue and delivery is at least once: endpoints
+dedupe on the event uuid. A new endpoint starts at the head of the log unless BTD_WEBHOOK_BACKFILL, and the consumers
+of endpoints no longer configured are dropped so they do not hold back compaction.
+"""
+from gevent import spawn, sleep
+from gevent.event import Event
+
+from . import settings
+from . import metrics
+from .pool import ConnectionPool
+from .publisher import decode_record
+
+from contextlib import closing
+from http.client import HTTPConnection, HTTPSConnection
+from select import select
+from time import monotonic
+from urllib.parse import urlsplit
+import json
+
+from logging import getLogger
+log = getLogger(__name__)
+
+webhook_seconds = metrics.Histogram('btd_webhook_seconds', 'Webhook POST latency', ('conf',))
+webhook_deliveries = metrics.Counter('btd_webhook_deliveries_total', 'Webhook POSTs by outcome', ('conf', 'outcome'))
+
+
+def event_json(event):
+    return {
+        'seq': event.seq,
+        'uuid': str(event.uuid),
+        'change': event.change,
+        'category': event.category,
+        'txid': event.txid,
+        'address': event.addr,
+        'context': None if event.context is None else event.context.decode(errors='replace'),
+        'amount': str(event.amount),
+        'confirmations': event.confirmations,
+    }
+
+
+def connection_is_idle(conn):
+    """
+    A keep-alive connection should have nothing to read, otherwise the endpoint closed it
+    """
+    if conn.sock is None:
+        return True
+    readable, _, _ = select([conn.sock], [], [], 0)
+    return not readable
+
+
+class DeliveryError(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, url, topics=None):
+        self.url = url
+        self.consumer = 'webhook:' + url
+        # Context hashes to deliver, None for every diff
+        self.topics = None if topics is None else set(topic.encode() for topic in topics)
+        parts = urlsplit(url)
+        self.origin = (parts.scheme, parts.hostname, parts.port)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.wake = Event()
+        self.greenlet = None
+        self.failures = 0
+
+    def wants(self, topic):
+        return self.topics is None or bytes(topic) in self.topics
+
+
+class WebhookDispatcher:
+    """
+    Delivers the diffs appended to a conf's event log to BTD_WEBHOOKS, each endpoint from its own greenlet
+
+    An endpoint only ever has one batch in flight so it sees diffs in order, while a slow or failing endpoint only
+    holds up itself. Connections are kept alive in a bounded pool per host.
+    """
+    def __init__(self, conf, eventlog, webhooks=None, backfill=None):
+        self.conf = conf
+        self.eventlog = eventlog
+        webhooks = settings.BTD_WEBHOOKS if webhooks is None else webhooks
+        self.endpoints = [Endpoint(url, topics) for url, topics in sorted(webhooks.items())]
+        self.backfill = settings.BTD_WEBHOOK_BACKFILL if backfill is None else backfill
+        self.pools = {}
+
+    def register(self):
+        """
+        Reconcile the event log's webhook consumers with the configured endpoints
+        """
+        consumers = set(endpoint.consumer for endpoint in self.endpoints)
+        for consumer in list(self.eventlog.consumers):
+            if consumer.startswith('webhook:') and consumer not in consumers:
+                log.info("Dropping event log consumer:{} no longer in BTD_WEBHOOKS".format(consumer))
+                self.eventlog.remove_consumer(consumer)
+        for endpoint in self.endpoints:
+            if endpoint.consumer not in self.eventlog.consumers and not self.backfill:
+                log.info("Webhook {} starts after seq:{}".format(endpoint.url, self.eventlog.next_seq - 1))
+                self.eventlog.ack(endpoint.consumer, self.eventlog.next_seq - 1)
+
+    def start(self):
+        self.register()
+        for endpoint in self.endpoints:
+            if endpoint.greenlet is None:
+                endpoint.greenlet = spawn(self.deliver_forever, endpoint)
+        return [endpoint.greenlet for endpoint in self.endpoints]
+
+    def stop(self):
+        for endpoint in self.endpoints:
+            if endpoint.greenlet is not None:
+                endpoint.greenlet.kill()
+                endpoint.greenlet = None
+        for pool in self.pools.values():
+            pool.clear()
+
+    def notify(self):
+        """
+        Called after appending to the event log
+        """
+        for endpoint in self.endpoints:
+            endpoint.wake.set()
+
+    def pool(self, origin):
+        if origin not in self.pools:
+            scheme, host, port = origin
+            Connection = HTTPSConnection if scheme == 'https' else HTTPConnection
+            self.pools[origin] = ConnectionPool(
+                lambda: Connection(host, port, timeout=settings.BTD_WEBHOOK_TIMEOUT),
+                settings.BTD_WEBHOOK_POOL_SIZE,
+                max_idle=settings.BTD_WEBHOOK_POOL_IDLE,
+                check=connection_is_idle,
+                close=lambda conn: conn.close())
+        return self.pools[origin]
+
+    def deliver_forever(self, endpoint):
+        # Whatever was logged while nothing was running is delivered first
+        endpoint.wake.set()
+        while True:
+            endpoint.wake.wait()
+            endpoint.wake.clear()
+            # Let diffs broadcast together go out together
+            sleep(settings.BTD_WEBHOOK_BATCH_WINDOW)
+
+            delay = settings.BTD_WEBHOOK_RETRY_MIN
+            while True:
+                try:
+                    if not self.deliver(endpoint):
+                        break
+                    endpoint.failures = 0
+                    delay = settings.BTD_WEBHOOK_RETRY_MIN
+                except Exception as e:
+                    endpoint.failures += 1
+                    log.warning("Webhook {} failed {} times, retrying in {}s: {}".format(
+                        endpoint.url, endpoint.failures, delay, e))
+                    sleep(delay)
+                    delay = min(delay * 2, settings.BTD_WEBHOOK_RETRY_MAX)
+
+    def deliver(self, endpoint):
+        """
+        POST the next batch of unacknowledged diffs, returns whether there was anything to read
+        """
+        acked = self.eventlog.consumers.get(endpoint.consumer, 0)
+        if self.eventlog.segments and acked + 1 < self.eventlog.segments[0]:
+            log.error("Webhook {} missed diffs {} to {} removed from the event log".format(
+                endpoint.url, acked + 1, self.eventlog.segments[0] - 1))
+
+        events = []
+        last = None
+        with closing(self.eventlog.read(acked + 1)) as records:
+            for seq, topic, record in records:
+                last = seq
+                if endpoint.wants(topic):
+                    events.append(decode_record(record)[0])
+                    if len(events) >= settings.BTD_WEBHOOK_BATCH_MAX:
+                        break
+        if last is None:
+            return False
+
+        if events:
+            self.post(endpoint, {'conf': self.conf.filename, 'events': [event_json(event) for event in events]})
+        self.eventlog.ack(endpoint.consumer, last)
+        return True
+
+    def post(self, endpoint, payload):
+        body = json.dumps(payload).encode()
+        labels = (self.conf.filename,)
+        start = monotonic()
+        try:
+            with self.pool(endpoint.origin).connection() as conn:
+                conn.request('POST', endpoint.path, body, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                if response.will_close:
+                    # Reconnects on its next request
+                    conn.close()
+        except Exception:
+            webhook_deliveries.inc(labels + ('error',))
+            raise
+        finally:
+            webhook_seconds.observe(monotonic() - start, labels)
+
+        if not 200 <= response.status < 300:
+            webhook_deliveries.inc(labels + ('rejected',))
+            raise DeliveryError("{} answered {} {}".format(endpoint.url, response.status, response.reason))
+        webhook_deliveries.inc(labels + ('delivered',))
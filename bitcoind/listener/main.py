@@ -1,3 +1,6 @@
+from gevent import monkey
+monkey.patch_all()
+
 from gevent import joinall
 from logging.config import dictConfig
 import logging
@@ -23,7 +26,6 @@ dictConfig(logging_config)
 log = logging.getLogger(__name__)
 
 from btd.start import start_all
-from btd.listener import start_transaction_listener
 
 
 if __name__ == '__main__':
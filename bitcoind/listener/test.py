@@ -1,3 +1,6 @@
+from gevent import monkey
+monkey.patch_all()
+
 import unittest
 from logging.config import dictConfig
 import logging
@@ -24,10 +27,10 @@ logging_config = dict(
 dictConfig(logging_config)
 log = logging.getLogger(__name__)
 
-from btd.bitcoind import load_confs, start_bitcoind, BitcoindRPC
+from btd.bitcoind import load_confs, start_nodes, BitcoindRPC
 from btd.engine import BtdListener
 
-from gevent import spawn, sleep, joinall
+from gevent import spawn, sleep
 from decimal import Decimal
 
 class TestApplication:
@@ -65,9 +68,7 @@ class TestIntegration(unittest.TestCase):
         confs['miner.conf'].clean_regtest()
         confs['regtest.conf'].clean_regtest()
 
-        joinall((
-            spawn(start_bitcoind, confs['miner.conf']),
-            spawn(start_bitcoind, confs['regtest.conf'])))
+        start_nodes(dict((filename, confs[filename]) for filename in ('miner.conf', 'regtest.conf')))
 
         # Make client
         self.app = TestApplication(confs['regtest.conf'])
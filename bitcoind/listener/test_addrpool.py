@@ -0,0 +1,79 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+from gevent import sleep
+
+from btd import settings
+from btd.addrpool import AddressPool
+from btd.engine import BtdRPC
+from test_engine import StorageTestCase
+
+
+class TestAddressPool(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = AddressPool(self.rpc, self.storage, low=2, high=5)
+
+    def tearDown(self):
+        if self.pool.greenlet is not None:
+            self.pool.greenlet.kill()
+        super().tearDown()
+
+    def test_claimed_addresses_take_the_context(self):
+        self.pool.refill()
+        self.assertEqual(self.storage.count_pool_addresses(), 5)
+
+        address = self.pool.claim(b'ctx')
+        self.assertIn(address, self.fake.wallet)
+        self.assertEqual(self.storage.lookup_context(address), b'ctx')
+        self.assertEqual(self.storage.lookup_unused_address(b'ctx'), address)
+        self.assertEqual((self.pool.available, self.storage.count_pool_addresses()), (4, 4))
+
+        # Above low nothing is generated
+        wallet = len(self.fake.wallet)
+        self.pool.refill()
+        self.assertEqual(len(self.fake.wallet), wallet)
+
+        claimed = set(self.pool.claim(str(n).encode()) for n in range(4))
+        self.assertEqual(len(claimed | {address}), 5)
+        self.assertIsNone(self.pool.claim(b'empty'))
+        self.assertEqual(self.pool.available, 0)
+
+    def test_claims_below_low_wake_the_refill(self):
+        self.pool.start()
+        while self.storage.count_pool_addresses() < 5:
+            sleep(0.01)
+        for n in range(4):
+            self.pool.claim(str(n).encode())
+        # Refilled long before BTD_ADDRESS_POOL_INTERVAL
+        for _ in range(100):
+            if self.storage.count_pool_addresses() == 5:
+                break
+            sleep(0.01)
+        self.assertEqual(self.storage.count_pool_addresses(), 5)
+        self.assertFalse(self.pool.wake.is_set())
+
+
+    def test_btd_rpc_refills_once_started(self):
+        pool_high = settings.BTD_ADDRESS_POOL_HIGH
+        settings.BTD_ADDRESS_POOL_HIGH = 5
+        try:
+            btd_rpc = BtdRPC(self.conf, self.rpc, self.storage)
+        finally:
+            settings.BTD_ADDRESS_POOL_HIGH = pool_high
+        self.pool = btd_rpc.address_pool
+        sleep(0.05)
+        # Constructing it asks nothing of bitcoind
+        self.assertEqual(self.fake.calls, 0)
+
+        btd_rpc.start()
+        while self.storage.count_pool_addresses() < 5:
+            sleep(0.01)
+        address = btd_rpc.get_address(b'ctx')
+        self.assertEqual(btd_rpc.get_address(b'ctx'), address)
+        self.assertEqual(self.storage.lookup_context(address), b'ctx')
+
+
+if __name__ == '__main__':
+    unittest.main()
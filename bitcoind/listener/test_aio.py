@@ -0,0 +1,194 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import asyncio
+import binascii
+
+from btd import settings
+from btd.aio import AsyncBitcoindRPC, AsyncBtdStorage, AsyncBtdListener
+from btd.engine import BtdListener
+from bitcoin.rpc import JSONRPCError
+from test_engine import StorageTestCase
+
+from decimal import Decimal
+
+
+class AsyncTestCase(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.requests = 0
+        handle_http = self.fake.handle_http
+
+        def counted(environ, start_response):
+            self.requests += 1
+            return handle_http(environ, start_response)
+        self.fake.http.application = counted
+        self.async_rpc = AsyncBitcoindRPC(self.conf)
+
+    def tearDown(self):
+        self.async_rpc.connect()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super().tearDown()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class TestAsyncBitcoindRPC(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batch_size = settings.BTD_RPC_BATCH_SIZE
+
+    def tearDown(self):
+        settings.BTD_RPC_BATCH_SIZE = self.batch_size
+        super().tearDown()
+
+    def test_calls_are_sent_in_batches(self):
+        settings.BTD_RPC_BATCH_SIZE = 2
+        addresses = self.run_async(self.async_rpc.create_addresses(5))
+        self.assertEqual(len(set(addresses)), 5)
+        self.assertTrue(set(addresses) <= self.fake.wallet)
+        self.assertEqual(self.requests, 3)
+
+        # Unknown keys are left out, bitcoind's errors for the rest are raised
+        txid = self.pay((self.fake.new_address(), Decimal('0.5')))
+        found = self.run_async(self.async_rpc.get_transactions([txid, '00' * 32]))
+        self.assertEqual(list(found), [txid])
+        self.assertEqual(found[txid]['details'][0]['amount'], Decimal('0.5'))
+        results = self.run_async(self.async_rpc.batch([('getinfo', ()), ('nosuchmethod', ())]))
+        self.assertEqual(results[0].get()['blocks'], self.fake.tip_height)
+        with self.assertRaises(JSONRPCError):
+            results[1].get()
+
+    def test_reorged_out_cursor_is_listed_from_its_fork_point(self):
+        self.fake.generate(3, publish=False)
+        cursor = self.fake.chain[-1]
+        txid = self.pay((self.fake.new_address(), Decimal('0.4')))
+        del self.fake.chain[-2:]
+        self.fake.generate(3, publish=False)
+
+        since = self.run_async(self.async_rpc.list_since_block(cursor, 1))
+        self.assertEqual([entry['txid'] for entry in since['transactions']], [txid])
+        self.assertEqual(since, self.rpc.list_since_block(cursor, 1))
+        self.assertEqual(self.run_async(self.async_rpc.fork_point(cursor)), self.fake.chain[-4])
+        self.assertIsNone(self.run_async(self.async_rpc.fork_point('00' * 32)))
+
+    def test_dropped_keep_alive_connection_is_reconnected(self):
+        self.run_async(self.async_rpc.get_info())
+        self.assertEqual(len(self.async_rpc.idle), 1)
+        conn = self.async_rpc.idle[-1][0]
+
+        async def dropped(host, auth, body):
+            raise ConnectionResetError("bitcoind closed the connection")
+        conn.post = dropped
+
+        self.assertEqual(self.run_async(self.async_rpc.get_blockchain_info())['blocks'], self.fake.tip_height)
+        self.assertTrue(conn.closing)
+        self.assertNotIn(conn, [idle for idle, _ in self.async_rpc.idle])
+
+
+class TestAsyncListener(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.interval = settings.BTD_PROCESS_INTERVAL
+        self.async_storage = AsyncBtdStorage(self.fake.conf('async.conf'))
+        self.listener = AsyncBtdListener(self.async_storage.conf, self.async_rpc, self.async_storage)
+        self.diffs = []
+        self.listener.broadcast_diff = self.diffs.append
+        self.gevent_listener = BtdListener(self.conf, self.rpc, self.storage)
+        self.gevent_diffs = []
+        self.gevent_listener.broadcast_diff = self.gevent_diffs.append
+
+    def tearDown(self):
+        settings.BTD_PROCESS_INTERVAL = self.interval
+        for listener in (self.listener, self.gevent_listener):
+            if listener.eventlog is not None:
+                listener.eventlog.close()
+        self.run_async(self.async_storage.close())
+        super().tearDown()
+
+    def hashtx(self, txid, seq):
+        return [b'hashtx', binascii.a2b_hex(txid), seq.to_bytes(4, 'little')]
+
+    def test_burst_is_synced_once(self):
+        settings.BTD_PROCESS_INTERVAL = 0
+        address = self.fake.new_address()
+        self.run_async(self.async_storage.run(self.async_storage.store_address, address, b'ctx'))
+        self.run_async(self.listener.resume())
+        rebuilds = []
+        rebuild_tx = self.listener.rebuild_tx
+
+        async def counted():
+            await rebuild_tx()
+            rebuilds.append(True)
+        self.listener.rebuild_tx = counted
+
+        txids = [self.pay((address, Decimal('0.01'))) for _ in range(5)]
+        for seq, txid in enumerate(txids, 1):
+            self.listener.queue.put_nowait((0, self.hashtx(txid, seq)))
+
+        async def drain():
+            processor = asyncio.ensure_future(self.listener.process_forever())
+            while not rebuilds:
+                await asyncio.sleep(0.01)
+            # Nothing left to trigger another sync
+            await asyncio.sleep(0.05)
+            processor.cancel()
+        self.run_async(asyncio.wait_for(drain(), 5))
+
+        self.assertEqual(rebuilds, [True])
+        self.assertEqual(self.listener.stats['coalesced'], 4)
+        self.assertEqual(sorted(diff.txid for diff in self.diffs), sorted(txids))
+        self.assertEqual(self.run_async(self.async_storage.run(self.async_storage.get_address_balance, address)),
+                         (0, Decimal('0.05')))
+
+    def test_diffs_match_the_gevent_listener(self):
+        addr1, addr2 = self.fake.new_address(), self.fake.new_address()
+        self.storage.store_address(addr1, b'one')
+        self.run_async(self.async_storage.run(self.async_storage.store_address, addr1, b'one'))
+
+        def compare(sync=True):
+            self.gevent_diffs[:], self.diffs[:] = [], []
+            if sync:
+                self.gevent_listener.rebuild_tx()
+                self.run_async(self.listener.rebuild_tx())
+            self.gevent_listener.broadcast_milestones()
+            self.run_async(self.listener.broadcast_milestones())
+            fields = lambda diffs: sorted((diff.change, diff.category, diff.txid, diff.addr, diff.context, diff.amount,
+                                           diff.confirmations) for diff in diffs)
+            self.assertEqual(fields(self.diffs), fields(self.gevent_diffs))
+            return fields(self.diffs)
+
+        self.run_async(self.listener.resume())
+        self.gevent_listener.restore()
+        self.pay((addr1, Decimal('0.1')), (addr2, Decimal('0.2')))
+        self.assertEqual(len(compare()), 2)
+
+        def mine(count):
+            follow(self.fake.generate(count, publish=False))
+
+        def follow(blockhashes):
+            for blockhash in blockhashes:
+                self.gevent_listener.handle_blockid(blockhash)
+                self.run_async(self.listener.handle_blockid(blockhash))
+
+        mine(1)
+        self.assertEqual([(diff[0], diff[-1]) for diff in compare()], [('modified', 1), ('modified', 1)])
+        # Milestones are computed locally from the tracked tip
+        mine(2)
+        self.assertEqual([(diff[0], diff[-1]) for diff in compare(sync=False)],
+                         [('confirmations', 3), ('confirmations', 3)])
+
+        # Back in the mempool after the block that mined it was orphaned
+        self.fake.reorg(3, include=False)
+        follow(self.fake.chain[-3:])
+        self.assertEqual([(diff[0], diff[-1]) for diff in compare()], [('modified', 0), ('modified', 0)])
+        self.assertEqual(compare(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
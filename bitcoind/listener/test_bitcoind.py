@@ -0,0 +1,169 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import json
+from gevent import subprocess, spawn
+from time import monotonic
+
+from btd import settings
+from btd import bitcoind
+from btd.bitcoind import BatchResult, NodeStartup
+from bench.fakebitcoind import RPCError
+from bitcoin.rpc import JSONRPCError, InvalidAddressOrKeyError
+from test_engine import StorageTestCase
+
+from decimal import Decimal
+
+
+def respond(start_response, response):
+    body = json.dumps(response).encode()
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class TestBatch(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batch_size = settings.BTD_RPC_BATCH_SIZE
+        self.requests = []
+        self.handle_http = self.fake.handle_http
+        self.fake.http.application = self.reversed
+
+    def tearDown(self):
+        settings.BTD_RPC_BATCH_SIZE = self.batch_size
+        self.rpc.pool.clear()
+        super().tearDown()
+
+    def reversed(self, environ, start_response):
+        """
+        Answers batches in reverse, bitcoind does not promise to keep their order
+        """
+        body = b''.join(self.handle_http(environ, lambda status, headers: None))
+        response = json.loads(body.decode())
+        if isinstance(response, list):
+            self.requests.append(len(response))
+            response.reverse()
+        return respond(start_response, response)
+
+    def test_results_are_matched_to_their_calls(self):
+        settings.BTD_RPC_BATCH_SIZE = 2
+        txid = self.pay((self.fake.new_address(), Decimal('0.3')))
+
+        with self.rpc.batch() as b:
+            results = [b.call('getblockcount'),
+                       b.call('gettransaction', '00' * 32),
+                       b.call('gettransaction', txid, convert=lambda tx: tx['txid']),
+                       b.call('nosuchmethod'),
+                       b.call('getinfo')]
+            with self.assertRaises(RuntimeError):
+                results[0].get()
+
+        self.assertEqual(self.requests, [2, 2, 1])
+        self.assertEqual(results[0].get(), self.fake.tip_height)
+        # Errors map to python-bitcoinlib's exceptions and only fail their own call
+        self.assertRaises(InvalidAddressOrKeyError, results[1].get)
+        self.assertEqual(results[2].get(), txid)
+        with self.assertRaises(JSONRPCError) as raised:
+            results[3].get()
+        self.assertEqual(raised.exception.error['code'], -32601)
+        self.assertEqual(results[4].get()['blocks'], self.fake.tip_height)
+
+    def test_batch_is_not_sent_when_its_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.rpc.batch() as b:
+                result = b.call('getblockcount')
+                raise ValueError()
+        self.assertEqual(self.requests, [])
+        self.assertFalse(result.done)
+
+    def test_rejected_batch_raises(self):
+        def rejected(environ, start_response):
+            return respond(start_response, {'id': None, 'result': None, 'error': {'code': -32700, 'message': 'Parse error'}})
+        self.fake.http.application = rejected
+        with self.assertRaises(JSONRPCError):
+            self.rpc.create_addresses(2)
+
+    def test_warming_up_retries_the_whole_batch(self):
+        settings_poll = settings.BTD_STARTUP_POLL_MIN
+        settings.BTD_STARTUP_POLL_MIN = 0.001
+        warmups = []
+        rpc_getinfo = self.fake.rpc_getinfo
+
+        def warming_up():
+            if len(warmups) < 2:
+                warmups.append(True)
+                raise RPCError(-28, 'Loading block index...')
+            return rpc_getinfo()
+        self.fake.rpc_getinfo = warming_up
+        try:
+            results = self.rpc.send_batch([('getblockcount', ()), ('getinfo', ())])
+        finally:
+            settings.BTD_STARTUP_POLL_MIN = settings_poll
+
+        self.assertEqual(self.requests, [2, 2, 2])
+        self.assertEqual([result['id'] for result in results], [0, 1])
+        result = BatchResult()
+        result.set(results[1])
+        self.assertEqual(result.get()['blocks'], self.fake.tip_height)
+
+
+
+class TestNodeStartup(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings = dict((name, getattr(settings, name)) for name in ('BTD_STARTUP_POLL_MIN', 'BTD_STARTUP_POLL_MAX'))
+        settings.BTD_STARTUP_POLL_MIN = settings.BTD_STARTUP_POLL_MAX = 0.001
+        # connect_rpc keeps one client per conf filename, earlier tests' point at their own FakeBitcoind
+        bitcoind.conn.pop(self.conf.filename, None)
+        self.startup = NodeStartup(self.conf)
+
+    def tearDown(self):
+        self.startup.rpc.pool.clear()
+        bitcoind.conn.pop(self.conf.filename, None)
+        if self.startup.process is not None and self.startup.process.poll() is None:
+            self.startup.process.kill()
+            self.startup.process.wait()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        super().tearDown()
+
+    def test_phases_of_a_running_node(self):
+        probes = []
+        rpc_getblockcount = self.fake.rpc_getblockcount
+
+        def warming_up():
+            probes.append(True)
+            if len(probes) <= 3:
+                raise RPCError(-28, 'Loading block index...')
+            return rpc_getblockcount()
+        self.fake.rpc_getblockcount = warming_up
+
+        timings = self.startup.run()
+        # Already answering, so not spawned, and warming up counts as up
+        self.assertIsNone(self.startup.process)
+        self.assertEqual(list(timings), ['rpc_up', 'warmup_done', 'zmq_up'])
+        self.assertEqual(len(probes), 4)
+        self.assertTrue(timings['rpc_up'] <= timings['warmup_done'] <= timings['zmq_up'])
+
+    def test_progress_output_reprobes_straight_away(self):
+        settings.BTD_STARTUP_POLL_MIN = settings.BTD_STARTUP_POLL_MAX = 30
+        self.startup.process = subprocess.Popen(
+            ['sh', '-c', 'sleep 0.1; echo "init message: Loading wallet..."; sleep 30'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        spawn(self.startup.follow_output)
+        probes = []
+
+        started = monotonic()
+        self.startup.wait_until(lambda: probes.append(True) or len(probes) > 1)
+        self.assertLess(monotonic() - started, 5)
+
+    def test_exited_process_fails_the_startup(self):
+        self.startup.process = subprocess.Popen(['sh', '-c', 'exit 3'], stdout=subprocess.PIPE)
+        with self.assertRaises(RuntimeError) as raised:
+            self.startup.wait_until(lambda: False)
+        self.assertIn('exited with:3', str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
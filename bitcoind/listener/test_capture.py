@@ -0,0 +1,78 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import os
+
+from btd import settings
+from btd.capture import Capture, RecordingRPC, read_capture, STATE, ZMQ, RPC
+from bench.replay import Player, ReplayRPC
+from test_engine import StorageTestCase
+
+from decimal import Decimal
+
+
+class TestCapture(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.directory, 'test.btdcap')
+        self.capture = Capture(self.filename)
+        self.recording = RecordingRPC(self.conf, self.capture)
+        self.player = None
+
+    def tearDown(self):
+        self.capture.close()
+        self.recording.pool.clear()
+        if self.player is not None:
+            self.player.stop()
+        super().tearDown()
+
+    def test_round_trip(self):
+        txid = self.pay((self.fake.new_address(), Decimal('0.29')), (self.fake.new_address(), Decimal('0.00000001')))
+        state = {'sync_cursor': None, 'zmq_seq': '{"hashtx": 4}'}
+        self.capture.state(state)
+        self.capture.zmq([b'hashtx', bytes(32), b'\x05\x00\x00\x00'])
+        since = self.recording.list_since_block(None, settings.BTD_SYNC_CONFIRMATIONS)
+        found = self.recording.get_transactions([txid, '00' * 32])
+        self.capture.close()
+
+        records = list(read_capture(self.filename))
+        self.assertEqual([kind for kind, _, _ in records], [STATE, ZMQ, RPC, RPC, RPC])
+        self.assertEqual(records[0][2], state)
+        self.assertEqual(records[1][2], [b'hashtx', bytes(32), b'\x05\x00\x00\x00'])
+        self.assertTrue(all(a <= b for (_, a, _), (_, b, _) in zip(records, records[1:])))
+        # Amounts come back as the exact Decimals bitcoind sent
+        self.assertEqual(sorted(entry['amount'] for entry in records[2][2]['response']['result']['transactions']),
+                         [Decimal('0.00000001'), Decimal('0.29')])
+        # Calls of a batch are recorded one by one, errors included
+        self.assertEqual([(payload['method'], payload['params']) for _, _, payload in records[3:]],
+                         [('gettransaction', [txid]), ('gettransaction', ['00' * 32])])
+        self.assertIsNotNone(records[4][2]['response']['error'])
+
+        # The replay answers the listener as bitcoind did
+        self.player = Player(records)
+        self.assertEqual(self.player.state, {'zmq_seq': '{"hashtx": 4}'})
+        replay = ReplayRPC(self.player.conf(), self.player)
+        self.assertEqual(replay.list_since_block(None, settings.BTD_SYNC_CONFIRMATIONS)['transactions'],
+                         since['transactions'])
+        self.assertEqual(replay.get_transactions([txid, '00' * 32]), found)
+        self.assertEqual(dict(self.player.misses), {})
+
+    def test_truncated_capture_replays_what_was_flushed(self):
+        self.capture.state({'sync_cursor': None})
+        self.capture.zmq([b'hashblock', bytes(32), b'\x00\x00\x00\x00'])
+        self.capture.flush()
+        flushed = os.path.getsize(self.filename)
+        self.capture.zmq([b'hashtx', os.urandom(32) * 100, b'\x01\x00\x00\x00'])
+        self.capture.flush()
+        with open(self.filename, 'r+b') as f:
+            f.truncate(flushed + 10)
+
+        records = list(read_capture(self.filename))
+        self.assertEqual([kind for kind, _, _ in records], [STATE, ZMQ])
+        self.player = Player(records)
+        self.assertEqual([frames[0] for _, frames, _ in self.player.messages], [b'hashblock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
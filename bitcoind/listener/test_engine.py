@@ -0,0 +1,357 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import tempfile
+import shutil
+import binascii
+
+from btd import settings
+from btd.bitcoind import BitcoindRPC
+from btd.engine import BtdStorage, BtdListener, BtdRPC
+from btd.cache import LRUCache
+from bench.fakebitcoind import FakeBitcoind, RPCError
+
+from decimal import Decimal
+
+
+class StorageTestCase(unittest.TestCase):
+    """
+    A FakeBitcoind and a storage in a scratch directory
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='btd-test-')
+        self.sqlite_dir = settings.BTD_SQLITE_DIR
+        settings.BTD_SQLITE_DIR = self.directory
+        self.fake = FakeBitcoind()
+        self.conf = self.fake.conf()
+        self.rpc = BitcoindRPC(self.conf)
+        self.storage = BtdStorage(self.conf)
+
+    def tearDown(self):
+        self.storage.close()
+        self.fake.stop()
+        settings.BTD_SQLITE_DIR = self.sqlite_dir
+        shutil.rmtree(self.directory)
+
+    def pay(self, *outputs):
+        """
+        An outside payment to several addresses in one transaction
+        """
+        tx = self.fake.make_tx(outputs)
+        self.fake.accept(tx, publish=False)
+        return tx.txid
+
+
+class TestListenerDiffs(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listener = BtdListener(self.conf, self.rpc, self.storage)
+        self.diffs = []
+        self.listener.broadcast_diff = self.diffs.append
+
+    def tearDown(self):
+        if self.listener.eventlog is not None:
+            self.listener.eventlog.close()
+        super().tearDown()
+
+    def sync(self):
+        self.diffs[:] = []
+        self.listener.rebuild_tx()
+        self.listener.broadcast_milestones()
+        return sorted((diff.change, diff.addr, diff.amount, diff.confirmations) for diff in self.diffs)
+
+    def test_multi_output_tx_is_stored_per_output(self):
+        addr1, addr2 = self.fake.new_address(), self.fake.new_address()
+        self.storage.store_address(addr1, b'one')
+        self.storage.store_address(addr2, b'two')
+        txid = self.pay((addr1, Decimal('0.1')), (addr2, Decimal('0.2')))
+
+        self.assertEqual(self.sync(), sorted([('new', addr1, Decimal('0.1'), 0), ('new', addr2, Decimal('0.2'), 0)]))
+        self.assertEqual(sorted((key[1], row.addr_id) for key, row in self.storage.load_txs([txid]).items()),
+                         [(0, self.storage.get_address_rowid(addr1)), (1, self.storage.get_address_rowid(addr2))])
+        # Unchanged outputs are not diffed again while they are relisted
+        self.assertEqual(self.sync(), [])
+
+        self.listener.handle_blockid(self.fake.generate(1, publish=False)[0])
+        self.assertEqual(self.sync(), sorted([('modified', addr1, Decimal('0.1'), 1),
+                                              ('modified', addr2, Decimal('0.2'), 1)]))
+
+        # Milestones reached locally are announced for every output
+        for blockhash in self.fake.generate(2, publish=False):
+            self.listener.handle_blockid(blockhash)
+        self.diffs[:] = []
+        self.listener.broadcast_milestones()
+        self.assertEqual(sorted((diff.addr, diff.amount, diff.confirmations) for diff in self.diffs),
+                         sorted([(addr1, Decimal('0.1'), 3), (addr2, Decimal('0.2'), 3)]))
+        self.assertEqual(self.sync(), [])
+
+    def test_send_to_self_keeps_both_categories(self):
+        addr = self.fake.new_address()
+        tx = self.fake.make_tx([(addr, Decimal('0.5'))])
+        self.fake.accept(tx, publish=False)
+        entry = dict(next(self.fake.entries(tx)), category='send', amount=Decimal('-0.5'))
+        since = self.rpc.list_since_block(None, settings.BTD_SYNC_CONFIRMATIONS)
+        since['transactions'].append(entry)
+
+        diffs = self.listener.diff_since(since)
+        self.assertEqual(sorted(diff.category for diff in diffs), ['receive', 'send'])
+        self.listener.store_diffs(diffs, {}, since['lastblock'])
+        self.assertEqual(len(self.storage.load_txs([tx.txid])), 2)
+        self.assertEqual(self.listener.diff_since(since), [])
+
+    def test_removed_entries_mined_again_are_diffed_once(self):
+        addr = self.fake.new_address()
+        txid = self.pay((addr, Decimal('1')))
+        since = self.rpc.list_since_block(None, settings.BTD_SYNC_CONFIRMATIONS)
+        since['removed'] = [dict(since['transactions'][0], confirmations=-1)]
+
+        diffs = self.listener.diff_since(since)
+        self.assertEqual([(diff.txid, diff.confirmations) for diff in diffs], [(txid, 0)])
+
+    def test_no_milestones_configured(self):
+        milestones = settings.BTD_CONFIRMATION_MILESTONES
+        settings.BTD_CONFIRMATION_MILESTONES = ()
+        try:
+            self.listener.eventlog.close()
+            self.listener = BtdListener(self.conf, self.rpc, self.storage)
+            self.listener.broadcast_diff = self.diffs.append
+            self.listener.restore()
+        finally:
+            settings.BTD_CONFIRMATION_MILESTONES = milestones
+
+        address = self.fake.new_address()
+        self.storage.store_address(address, b'ctx')
+        self.pay((address, Decimal('0.1')))
+        self.assertEqual(self.sync(), [('new', address, Decimal('0.1'), 0)])
+        for blockhash in self.fake.generate(3, publish=False):
+            self.listener.handle_blockid(blockhash)
+        self.assertEqual(self.sync(), [('modified', address, Decimal('0.1'), 3)])
+        self.listener.tracker.load()
+        self.assertEqual(self.listener.tracker.tracked, {})
+
+    def test_cursor_reorged_out_is_listed_from_its_fork_point(self):
+        address = self.fake.new_address()
+        self.storage.store_address(address, b'ctx')
+        self.fake.generate(settings.BTD_SYNC_CONFIRMATIONS + 2, publish=False)
+        self.sync()
+        cursor = self.storage.get_state(self.listener.SYNC_CURSOR)
+
+        # A longer chain from below the cursor mines the payment deeper than the cursor's own height
+        self.pay((address, Decimal('0.2')))
+        del self.fake.chain[-(settings.BTD_SYNC_CONFIRMATIONS + 1):]
+        self.fake.generate(settings.BTD_SYNC_CONFIRMATIONS + 2, publish=False)
+        self.assertNotIn(cursor, self.fake.chain)
+        self.assertEqual(self.sync(), [('new', address, Decimal('0.2'), settings.BTD_SYNC_CONFIRMATIONS + 2)])
+
+    def test_unknown_cursor_lists_every_transaction(self):
+        address = self.fake.new_address()
+        self.storage.store_address(address, b'ctx')
+        self.pay((address, Decimal('0.2')))
+        self.fake.generate(settings.BTD_SYNC_CONFIRMATIONS + 2, publish=False)
+        rpc_listsinceblock = self.fake.rpc_listsinceblock
+
+        def rejecting_unknown(blockhash='', *args):
+            # As bitcoind 0.17 and newer do
+            if blockhash and blockhash not in self.fake.blocks:
+                raise RPCError(-5, 'Block not found')
+            return rpc_listsinceblock(blockhash, *args)
+        self.fake.rpc_listsinceblock = rejecting_unknown
+        self.storage.set_state(self.listener.SYNC_CURSOR, '00' * 32)
+        self.assertEqual(self.sync(), [('new', address, Decimal('0.2'), settings.BTD_SYNC_CONFIRMATIONS + 2)])
+
+    def test_balances_of_a_tx_paying_two_addresses(self):
+        addr1, addr2 = self.fake.new_address(), self.fake.new_address()
+        self.storage.store_address(addr1, b'shared')
+        self.storage.store_address(addr2, b'shared')
+        self.pay((addr1, Decimal('0.1')), (addr2, Decimal('0.2')))
+
+        self.sync()
+        self.assertEqual(self.storage.get_address_balance(addr1), BtdStorage.Balance(0, Decimal('0.1')))
+        self.assertEqual(self.storage.get_address_balance(addr2), BtdStorage.Balance(0, Decimal('0.2')))
+        self.assertEqual(self.storage.get_context_balance(b'shared'), BtdStorage.Balance(0, Decimal('0.3')))
+
+        self.listener.handle_blockid(self.fake.generate(1, publish=False)[0])
+        self.sync()
+        self.assertEqual(self.storage.get_address_balance(addr1), BtdStorage.Balance(Decimal('0.1'), 0))
+        self.assertEqual(self.storage.get_context_balance(b'shared'), BtdStorage.Balance(Decimal('0.3'), 0))
+        self.assertEqual(self.storage.check_balances(), [])
+
+
+class TestBtdRPC(StorageTestCase):
+    def test_background_work_waits_for_start(self):
+        pool_high, payout_window = settings.BTD_ADDRESS_POOL_HIGH, settings.BTD_PAYOUT_WINDOW
+        settings.BTD_ADDRESS_POOL_HIGH, settings.BTD_PAYOUT_WINDOW = 0, 0.01
+        try:
+            btd_rpc = BtdRPC(self.conf, self.rpc, self.storage)
+        finally:
+            settings.BTD_ADDRESS_POOL_HIGH, settings.BTD_PAYOUT_WINDOW = pool_high, payout_window
+        self.assertIsNone(btd_rpc.balance_reconciler.greenlet)
+        self.assertIsNone(btd_rpc.payout_queue.greenlet)
+        self.assertEqual(self.fake.calls, 0)
+
+        btd_rpc.start()
+        greenlets = [btd_rpc.balance_reconciler.greenlet, btd_rpc.payout_queue.greenlet, btd_rpc.payout_queue.settler]
+        self.assertNotIn(None, greenlets)
+        btd_rpc.start()
+        self.assertEqual([btd_rpc.balance_reconciler.greenlet, btd_rpc.payout_queue.greenlet,
+                          btd_rpc.payout_queue.settler], greenlets)
+        for greenlet in greenlets:
+            greenlet.kill()
+
+
+class TestContexts(StorageTestCase):
+    def ctx_rows(self):
+        return self.storage.executor.run(
+            lambda: self.storage.db.execute('SELECT hash, data, compressed FROM ctx').fetchall(), write=False)
+
+    def test_shared_context_is_stored_once(self):
+        context = b'{"user": 42, "note": "' + b'x' * settings.BTD_CONTEXT_COMPRESS_BYTES + b'"}'
+        addresses = [self.fake.new_address() for _ in range(3)]
+        for address in addresses:
+            self.storage.store_address(address, context)
+        self.storage.store_address(self.fake.new_address(), b'short')
+
+        rows = dict((contexthash, (data, compressed)) for contexthash, data, compressed in self.ctx_rows())
+        self.assertEqual(len(rows), 2)
+        data, compressed = rows[self.storage.hash_context(context)]
+        self.assertTrue(compressed)
+        self.assertLess(len(data), len(context))
+        self.assertEqual(rows[self.storage.hash_context(b'short')], (b'short', 0))
+
+        # Read back through empty caches, then served from them
+        self.storage.close()
+        self.storage = BtdStorage(self.conf)
+        self.assertEqual([self.storage.lookup_context(address) for address in addresses], [context] * 3)
+        self.assertEqual(self.storage.contexts.misses, 1)
+        self.assertEqual(self.storage.lookup_context(addresses[0]), context)
+        self.assertEqual(self.storage.address_contexts.hits, 1)
+        self.assertIsNone(self.storage.lookup_context(self.fake.new_address()))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual((cache.get('b'), cache.get('a'), cache.get('c')), (None, 1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        cache.invalidate('a')
+        self.assertNotIn('a', cache)
+
+        disabled = LRUCache(0)
+        disabled.put('a', 1)
+        self.assertEqual(len(disabled), 0)
+
+
+class TestCheckpoint(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listeners = []
+        self.broadcast = []
+
+    def tearDown(self):
+        for listener in self.listeners:
+            listener.close()
+        super().tearDown()
+
+    def restart(self, crash_after=None):
+        """
+        A listener on the same storage and event log, broadcasting crash_after diffs before crashing
+        """
+        for listener in self.listeners:
+            listener.close()
+        listener = BtdListener(self.conf, self.rpc, self.storage)
+        self.listeners.append(listener)
+        broadcast_diff = listener.broadcast_diff
+
+        def crashing(diff):
+            if crash_after is not None and len(self.broadcast) >= crash_after:
+                raise RuntimeError('crashed')
+            broadcast_diff(diff)
+            self.broadcast.append(diff.addr)
+        listener.broadcast_diff = crashing
+        return listener
+
+    def test_diffs_in_flight_at_a_crash_are_broadcast_on_resume(self):
+        addr1, addr2 = self.fake.new_address(), self.fake.new_address()
+        self.pay((addr1, Decimal('0.1')), (addr2, Decimal('0.2')))
+        listener = self.restart(crash_after=1)
+        with self.assertRaises(RuntimeError):
+            listener.rebuild_tx()
+        first = self.broadcast[0]
+        self.assertIn(first, (addr1, addr2))
+
+        # The diff that reached the event log is not broadcast again
+        self.restart().resume()
+        self.assertEqual(sorted(self.broadcast), sorted([addr1, addr2]))
+        self.assertEqual([event.addr for event in self.listeners[-1].eventlog.replay('consumer')],
+                         [first, ({addr1, addr2} - {first}).pop()])
+
+        # Nothing is in flight once broadcasting finished
+        self.restart().resume()
+        self.assertEqual(len(self.broadcast), 2)
+        self.restart().rebuild_tx()
+        self.assertEqual(len(self.broadcast), 2)
+
+    def test_sequence_numbers_survive_a_restart(self):
+        listener = self.restart()
+        listener.restore()
+        blocks = [binascii.a2b_hex(blockhash) for blockhash in self.fake.generate(2, publish=False)]
+        listener.process([(b'hashblock', blocks[0], b'\x01\x00\x00\x00'), (b'hashblock', blocks[1], b'\x02\x00\x00\x00')])
+
+        listener = self.restart()
+        listener.restore()
+        self.assertEqual(listener.seq, {'hashblock': 2})
+        self.assertFalse(listener.sequence_gap((b'hashblock', bytes(32), b'\x03\x00\x00\x00'), 'hashblock'))
+        self.assertTrue(listener.sequence_gap((b'hashblock', bytes(32), b'\x05\x00\x00\x00'), 'hashblock'))
+
+
+def segwit(raw):
+    """
+    A non-witness raw transaction with an empty witness per input added in the BIP144 serialization
+    """
+    inputs = raw[4]
+    return raw[:4] + b'\x00\x01' + raw[4:-4] + b'\x01\x00' * inputs + raw[-4:]
+
+
+class TestRawTx(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listener = BtdListener(self.fake.conf(raw=True), self.rpc, self.storage)
+        self.listener.rebuild_tx = lambda: self.syncs.append(True)
+        self.syncs = []
+
+    def tearDown(self):
+        if self.listener.eventlog is not None:
+            self.listener.eventlog.close()
+        super().tearDown()
+
+    def test_rawtx_matches_watched_addresses(self):
+        watched = self.fake.new_address()
+        self.storage.store_address(watched)
+        self.listener.restore(raw=True)
+
+        self.assertTrue(self.listener.handle_rawtx(self.fake.make_tx([(watched, Decimal('1'))]).raw))
+        self.assertFalse(self.listener.handle_rawtx(self.fake.make_tx([(self.fake.new_address(), Decimal('1'))]).raw))
+
+    def test_segwit_rawtx_in_a_batch_syncs(self):
+        watched = self.fake.new_address()
+        self.storage.store_address(watched)
+        self.listener.restore(raw=True)
+        noise = self.fake.make_tx([(self.fake.new_address(), Decimal('1'))]).raw
+        deposit = self.fake.make_tx([(watched, Decimal('1'))]).raw
+
+        self.listener.process([(b'rawtx', noise, b'\x01\x00\x00\x00')])
+        self.assertEqual(self.syncs, [])
+        # Matched where python-bitcoinlib decodes segwit, synced in case it matches where it does not
+        self.listener.process([(b'rawtx', segwit(noise), b'\x02\x00\x00\x00'),
+                               (b'rawtx', segwit(deposit), b'\x03\x00\x00\x00')])
+        self.assertEqual(self.syncs, [True])
+        self.assertFalse(self.listener.missed)
+        self.assertEqual(self.listener.seq, {'rawtx': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from btd import settings
+from btd.bitcoind import BitcoindConf
+from btd.engine import BtdListener
+from btd.eventlog import EventLog, index_entry
+
+from decimal import Decimal
+from uuid import uuid4
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='btd-test-')
+        self.conf = BitcoindConf('test.conf', {})
+        self.settings = dict((name, getattr(settings, name)) for name in (
+            'BTD_EVENTLOG_SEGMENT_BYTES', 'BTD_EVENTLOG_RETENTION_SECONDS'))
+        self.eventlog = self.open()
+
+    def tearDown(self):
+        self.eventlog.close()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        eventlog = EventLog(self.conf, self.directory)
+        # Timers run when the test says so
+        eventlog.scheduled = []
+
+        def later(seconds, f):
+            eventlog.scheduled.append(f)
+            return f
+        eventlog.later = later
+        return eventlog
+
+    def reopen(self):
+        self.eventlog.close()
+        self.eventlog = self.open()
+
+    def append(self, count, topic=b''):
+        return [self.eventlog.append(topic, BtdListener.TxInfo(
+            uuid4(), 'new', 'receive', '00' * 32, 'addr', None, Decimal('0.1'), 0, None))[0] for _ in range(count)]
+
+    def seqs(self, from_seq=1):
+        return [seq for seq, _, _ in self.eventlog.read(from_seq)]
+
+    def segment_path(self, ext):
+        return self.eventlog.segment_path(self.eventlog.segments[-1], ext)
+
+    def test_torn_record_is_dropped_on_recover(self):
+        self.assertEqual(self.append(3), [1, 2, 3])
+        self.eventlog.close()
+        with open(self.segment_path('log'), 'r+b') as f:
+            f.truncate(f.seek(0, os.SEEK_END) - 5)
+
+        self.eventlog = self.open()
+        self.assertEqual(self.eventlog.next_seq, 3)
+        self.assertEqual(self.seqs(), [1, 2])
+        self.assertEqual(self.append(1), [3])
+        self.reopen()
+        self.assertEqual(self.seqs(2), [2, 3])
+
+    def test_index_entry_past_the_log_is_dropped_on_recover(self):
+        self.append(2)
+        self.eventlog.close()
+        with open(self.segment_path('idx'), 'ab') as f:
+            f.write(index_entry.pack(1 << 20))
+
+        self.eventlog = self.open()
+        self.assertEqual(self.eventlog.next_seq, 3)
+        self.assertEqual(os.path.getsize(self.segment_path('idx')), 2 * index_entry.size)
+
+    def test_compact_keeps_segments_a_consumer_still_needs(self):
+        # Every record starts a new segment
+        settings.BTD_EVENTLOG_SEGMENT_BYTES = 1
+        self.append(3)
+        self.eventlog.ack('fast', 3)
+        self.eventlog.ack('slow', 1)
+        self.append(1)
+        self.assertEqual(self.eventlog.segments, [2, 3, 4])
+        self.assertEqual(self.seqs(), [2, 3, 4])
+
+        self.eventlog.ack('slow', 3)
+        self.append(1)
+        self.assertEqual(self.eventlog.segments, [4, 5])
+        self.assertEqual([event.seq for event in self.eventlog.replay('slow')], [4, 5])
+
+        # Retention removes segments nobody acknowledged, never the active one
+        settings.BTD_EVENTLOG_RETENTION_SECONDS = -1
+        self.append(1)
+        self.assertEqual(self.eventlog.segments, [6])
+
+    def test_acks_are_written_together(self):
+        self.append(3)
+        self.eventlog.scheduled.pop()()
+        for seq in (1, 2, 3):
+            self.eventlog.ack('consumer', seq)
+        self.assertEqual(self.eventlog.scheduled, [self.eventlog.save_consumers_later])
+        consumers_path = os.path.join(self.directory, 'consumers.json')
+        self.assertFalse(os.path.exists(consumers_path))
+
+        self.eventlog.scheduled.pop()()
+        with open(consumers_path) as f:
+            self.assertEqual(json.load(f), {'consumer': 3})
+
+        # Acks not written yet are written on close
+        self.eventlog.ack('consumer', 2)
+        self.eventlog.ack('other', 1)
+        self.reopen()
+        self.assertEqual(self.eventlog.consumers, {'consumer': 3, 'other': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import tempfile
+import shutil
+import sqlite3
+from os import path
+from gevent import spawn, joinall
+
+from btd.executor import StorageExecutor, GroupedConnection, storage_op
+
+
+class Rows:
+    def __init__(self, directory):
+        db = sqlite3.connect(path.join(directory, 'rows.sqlite'), isolation_level=None, check_same_thread=False)
+        db.execute('CREATE TABLE row (name VARCHAR(16) UNIQUE)')
+        self.db = GroupedConnection(db)
+        self.executor = StorageExecutor(db, 'test')
+        self.groups = []
+        run_group = self.executor.run_group
+
+        def recorded(ops):
+            self.groups.append(len(ops))
+            return run_group(ops)
+        self.executor.run_group = recorded
+
+    @storage_op()
+    def insert(self, *names):
+        for name in names:
+            self.db.execute('INSERT INTO row (name) VALUES (?)', (name,))
+        return names
+
+    @storage_op()
+    def insert_committed_then_fail(self, name):
+        with self.db:
+            self.db.execute('INSERT INTO row (name) VALUES (?)', (name,))
+        self.db.commit()
+        in_transaction = self.db.in_transaction
+        raise RuntimeError(in_transaction)
+
+    @storage_op(write=False)
+    def names(self):
+        return (name for name, in self.db.execute('SELECT name FROM row ORDER BY name'))
+
+
+class TestStorageExecutor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='btd-test-')
+        self.rows = Rows(self.directory)
+
+    def tearDown(self):
+        self.rows.executor.run(self.rows.db.close, write=False)
+        self.rows.executor.close()
+        shutil.rmtree(self.directory)
+
+    def test_failing_op_only_rolls_back_its_own_savepoint(self):
+        greenlets = [spawn(self.rows.insert, 'a'),
+                     spawn(self.rows.insert, 'b', 'a'),
+                     spawn(self.rows.insert_committed_then_fail, 'c'),
+                     spawn(self.rows.insert, 'd')]
+        joinall(greenlets)
+
+        self.assertEqual(self.rows.groups, [4])
+        self.assertEqual(greenlets[0].value, ('a',))
+        self.assertIsInstance(greenlets[1].exception, sqlite3.IntegrityError)
+        # commit() and the connection's context manager left the group's transaction open
+        self.assertEqual(greenlets[2].exception.args, (True,))
+        self.assertEqual(greenlets[3].value, ('d',))
+        # 'b' went with the failing op that inserted it, 'c' was not committed early
+        self.assertEqual(self.rows.names(), ['a', 'd'])
+
+    def test_reads_alone_open_no_transaction(self):
+        self.rows.insert('a')
+        joinall([spawn(self.rows.names) for _ in range(3)])
+        self.assertEqual(self.rows.groups, [1, 3])
+        self.assertFalse(self.rows.executor.run(lambda: self.rows.db.in_transaction, write=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
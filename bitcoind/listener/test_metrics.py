@@ -0,0 +1,122 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import socket
+from urllib.request import urlopen
+from gevent import spawn, sleep
+
+from btd import settings
+from btd import metrics
+from test_engine import StorageTestCase
+
+
+class Timed:
+    def __init__(self, conf):
+        self.conf = conf
+
+    @metrics.timed(metrics.Histogram('test_seconds', 'Test latency', ('conf', 'method'), buckets=(0.1, 1)),
+                   'work', metrics.Counter('test_errors_total', 'Test errors', ('conf', 'method')))
+    def work(self, fail=False):
+        if fail:
+            raise ValueError()
+        return True
+
+
+class MetricsTestCase(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.port = settings.BTD_METRICS_PORT
+        settings.BTD_METRICS_PORT = 0
+        self.registry = metrics.registry.copy()
+
+    def tearDown(self):
+        settings.BTD_METRICS_PORT = self.port
+        metrics.registry.clear()
+        metrics.registry.update(self.registry)
+        for metric in metrics.registry.values():
+            metric.values.clear()
+        super().tearDown()
+
+
+class TestExposition(MetricsTestCase):
+    def test_render(self):
+        requests = metrics.Counter('test_requests_total', 'Test "requests"', ('conf',))
+        requests.inc(('a"b.conf',))
+        requests.inc(('a"b.conf',), 2)
+        latency = metrics.Histogram('test_latency_seconds', 'Test latency', ('conf',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value, ('x.conf',))
+
+        text = metrics.render([requests.snapshot(), latency.snapshot()])
+        self.assertEqual(text.splitlines(), [
+            '# HELP test_requests_total Test "requests"',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{conf="a\\"b.conf"} 3',
+            '# HELP test_latency_seconds Test latency',
+            '# TYPE test_latency_seconds histogram',
+            # Buckets are cumulative and include their upper bound
+            'test_latency_seconds_bucket{conf="x.conf",le="0.1"} 2',
+            'test_latency_seconds_bucket{conf="x.conf",le="1"} 3',
+            'test_latency_seconds_bucket{conf="x.conf",le="+Inf"} 4',
+            'test_latency_seconds_sum{conf="x.conf"} 3.65',
+            'test_latency_seconds_count{conf="x.conf"} 4',
+        ])
+
+    def test_nothing_is_recorded_while_disabled(self):
+        settings.BTD_METRICS_PORT = None
+        requests = metrics.Counter('test_requests_total', 'Test requests')
+        requests.inc()
+        metrics.Histogram('test_latency_seconds', 'Test latency').observe(1)
+        self.assertIsNone(metrics.snapshot())
+        self.assertEqual(requests.values, {})
+
+    def test_timed_counts_errors(self):
+        timed = Timed(self.conf)
+        timed.work()
+        with self.assertRaises(ValueError):
+            timed.work(fail=True)
+        entries = dict((entry[0], entry[5]) for entry in metrics.snapshot())
+        labels = (self.conf.filename, 'work')
+        self.assertEqual(entries['test_seconds'][labels][2], 2)
+        self.assertEqual(entries['test_errors_total'], {labels: 1})
+
+    def test_merge_sums_worker_snapshots(self):
+        requests = metrics.Counter('test_requests_total', 'Test requests', ('conf',))
+        latency = metrics.Histogram('test_latency_seconds', 'Test latency', ('conf',), buckets=(1,))
+        requests.inc(('a.conf',))
+        latency.observe(0.5, ('a.conf',))
+        first = [requests.snapshot(), latency.snapshot()]
+        requests.inc(('b.conf',), 2)
+        latency.observe(2, ('a.conf',))
+        second = [requests.snapshot(), latency.snapshot()]
+
+        merged = dict((entry[0], entry[5]) for entry in metrics.merge([first, None, second]))
+        self.assertEqual(merged['test_requests_total'], {('a.conf',): 2, ('b.conf',): 2})
+        self.assertEqual(merged['test_latency_seconds'], {('a.conf',): ([2, 1], 3.0, 3)})
+        # The snapshots merged are left as they were
+        self.assertEqual(first[1][5], {('a.conf',): ([1, 0], 0.5, 1)})
+
+
+class TestServeMetrics(MetricsTestCase):
+    def test_scrape(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            settings.BTD_METRICS_PORT = s.getsockname()[1]
+        self.rpc.get_info()
+        server = spawn(metrics.serve_metrics)
+        try:
+            for _ in range(100):
+                try:
+                    text = urlopen('http://127.0.0.1:{}/metrics'.format(settings.BTD_METRICS_PORT)).read().decode()
+                    break
+                except OSError:
+                    sleep(0.01)
+        finally:
+            server.kill()
+        self.assertIn('# TYPE btd_rpc_seconds histogram', text)
+        self.assertIn('btd_rpc_seconds_count{{conf="{}",method="get_info"}} 1'.format(self.conf.filename), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import sqlite3
+import json
+import os
+
+from btd import settings
+from btd.engine import BtdStorage, BtdListener
+from btd.migrations import migrations, schema_version
+from btd import migrate
+from test_engine import StorageTestCase
+
+from datetime import datetime
+from decimal import Decimal
+from hashlib import md5
+from uuid import uuid4
+import time
+
+BASELINE_TIME = '2017-06-01T12:00:00'
+
+
+class TestBaselineUpgrade(StorageTestCase):
+    """
+    A database written by the baseline storage: no schema_version, DECIMAL amounts, ISO DATETIMEs and one row per txid
+    """
+    def setUp(self):
+        super().setUp()
+        self.listener = None
+
+    def tearDown(self):
+        if self.listener is not None and self.listener.eventlog is not None:
+            self.listener.eventlog.close()
+        super().tearDown()
+
+    def write_baseline(self, addresses, entries):
+        self.storage.close()
+        db_path = os.path.join(settings.BTD_SQLITE_DIR, self.conf.filename + '.sqlite')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+        db = sqlite3.connect(db_path)
+        migrations[0](db)
+        for address, context in addresses:
+            db.execute('INSERT INTO addr (address, context, contexthash, created, modified) VALUES (?, ?, ?, ?, ?)',
+                       (address, context, None if context is None else md5(context).hexdigest(),
+                        BASELINE_TIME, BASELINE_TIME))
+        for entry in entries:
+            addr_id = db.execute('SELECT rowid FROM addr WHERE address=?', (entry['address'],)).fetchone()[0]
+            db.execute('UPDATE tx SET addr_id=?, amount=?, confirmations=?, orig=?, modified=? WHERE txid=?',
+                       (addr_id, str(entry['amount']), entry['confirmations'], json.dumps(entry, default=float),
+                        BASELINE_TIME, entry['txid']))
+            db.execute('INSERT INTO tx (uuid, txid, addr_id, amount, confirmations, orig, silenced, created, modified)'
+                       ' SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE (SELECT changes() = 0)',
+                       (str(uuid4()), entry['txid'], addr_id, str(entry['amount']), entry['confirmations'],
+                        json.dumps(entry, default=float), False, BASELINE_TIME, BASELINE_TIME))
+        db.commit()
+        db.close()
+
+        self.storage = BtdStorage(self.conf)
+
+    def test_baseline_database_is_upgraded_and_compacted(self):
+        paid1, paid2, pending = self.fake.new_address(), self.fake.new_address(), self.fake.new_address()
+        shared = self.pay((paid1, Decimal('0.1')), (paid2, Decimal('0.2')))
+        self.fake.generate(1, publish=False)
+        unconfirmed = self.pay((pending, Decimal('0.3')))
+        entries = self.rpc.list_since_block(None, settings.BTD_SYNC_CONFIRMATIONS)['transactions']
+        self.write_baseline([(paid1, b'shared'), (paid2, b'shared'), (pending, None)], entries)
+
+        self.assertEqual(schema_version(self.storage.db), len(migrations))
+        # The baseline kept whichever output of a tx it saw last
+        rows = self.storage.load_txs([shared, unconfirmed])
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(vout is not None for _, vout, _ in rows))
+        self.assertEqual(self.storage.get_address_balance(pending), BtdStorage.Balance(0, Decimal('0.3')))
+        self.assertEqual(self.storage.check_balances(), [])
+
+        self.assertEqual(migrate.compact(self.storage, chunk=1, pause=0), {'addr': 3, 'tx': 2, 'payout': 0})
+        self.assertEqual(self.storage.db.execute(
+            'SELECT COUNT(*) FROM tx WHERE amount IS NOT NULL OR created IS NOT NULL').fetchone()[0], 0)
+        epoch = int(time.mktime(datetime.strptime(BASELINE_TIME, '%Y-%m-%dT%H:%M:%S').timetuple()))
+        self.assertEqual(sorted(self.storage.db.execute('SELECT amount_sat, created_ts FROM tx')),
+                         sorted([(row.amount, epoch) for row in rows.values()]))
+        self.assertEqual(migrate.compact(self.storage, pause=0), {'addr': 0, 'tx': 0, 'payout': 0})
+
+        # The cursor was dropped so the next sync restores the outputs the baseline overwrote
+        self.listener = BtdListener(self.conf, self.rpc, self.storage)
+        self.listener.broadcast_diff = lambda diff: None
+        self.listener.rebuild_tx()
+        self.assertEqual(len(self.storage.load_txs([shared])), 2)
+        self.assertEqual(self.storage.get_address_balance(paid1), BtdStorage.Balance(Decimal('0.1'), 0))
+        self.assertEqual(self.storage.get_address_balance(paid2), BtdStorage.Balance(Decimal('0.2'), 0))
+        self.assertEqual(self.storage.get_context_balance(b'shared'), BtdStorage.Balance(Decimal('0.3'), 0))
+        self.assertEqual(self.storage.check_balances(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import socket
+
+from btd import settings
+from btd.payout import PayoutQueue
+from bitcoin.rpc import JSONRPCError
+from test_engine import StorageTestCase
+
+from decimal import Decimal
+
+
+class TestPayoutQueue(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings = dict((name, getattr(settings, name)) for name in (
+            'BTD_STARTUP_POLL_MAX', 'BTD_PAYOUT_SETTLE_SECONDS', 'BTD_PAYOUT_SETTLE_INTERVAL'))
+        settings.BTD_STARTUP_POLL_MAX = 0.01
+        settings.BTD_PAYOUT_SETTLE_INTERVAL = 3600
+        self.sendmany = self.rpc.send_many
+        self.sent = []
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue is not None:
+            self.queue.greenlet.kill()
+            self.queue.settler.kill()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        super().tearDown()
+
+    def start(self, send_many):
+        self.rpc.send_many = send_many
+        self.queue = PayoutQueue(self.rpc, self.storage, window=0.01)
+        self.queue.start()
+
+    def send_many(self, amounts, comment=''):
+        self.sent.append(comment)
+        return self.sendmany(amounts, comment)
+
+    def sendmany_txs(self):
+        return [tx for tx in self.fake.txs.values() if tx.category == 'send']
+
+    def states(self):
+        return [state for state in ('queued', 'sending', 'sent', 'failed') for _ in self.storage.iter_payouts(state)]
+
+    def test_batch_interrupted_after_sending_is_not_sent_again(self):
+        def interrupted(amounts, comment=''):
+            self.send_many(amounts, comment)
+            raise socket.timeout('timed out')
+        self.start(interrupted)
+
+        result = self.queue.send(self.fake.new_address(), Decimal('0.5'), b'payee')
+        self.queue.send(self.fake.new_address(), Decimal('0.25'), b'payee')
+        self.assertIsNone(result.wait(0.5))
+        self.assertEqual(self.states(), ['sending', 'sending'])
+
+        self.queue.settle()
+        self.assertEqual(result.get(timeout=1), self.sendmany_txs()[0].txid)
+        self.assertEqual(self.states(), ['sent', 'sent'])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.sendmany_txs()), 1)
+
+    def test_batch_missing_from_the_wallet_is_only_requeued_after_settle_seconds(self):
+        # Dropped before it reached bitcoind
+        interrupts = iter([socket.timeout('timed out')])
+
+        def interrupted(amounts, comment=''):
+            for e in interrupts:
+                raise e
+            return self.send_many(amounts, comment)
+        self.start(interrupted)
+
+        result = self.queue.send(self.fake.new_address(), Decimal('0.5'), b'payee')
+        self.assertIsNone(result.wait(0.5))
+        # bitcoind may still be working on it
+        self.queue.settle()
+        self.assertEqual(self.states(), ['sending'])
+
+        settings.BTD_PAYOUT_SETTLE_SECONDS = 0
+        self.queue.settle()
+        self.assertEqual(result.get(timeout=1), self.sendmany_txs()[0].txid)
+        self.assertEqual(len(self.sendmany_txs()), 1)
+
+    def test_recover_settles_batches_interrupted_by_a_crash(self):
+        self.storage.queue_payout('sent-uuid', self.fake.new_address(), Decimal('0.1'), None)
+        self.storage.start_payout_batch('sent-batch', ['sent-uuid'])
+        self.sendmany({self.fake.new_address(): Decimal('0.1')}, 'sent-batch')
+        self.storage.queue_payout('queued-uuid', self.fake.new_address(), Decimal('0.2'), None)
+
+        self.start(self.send_many)
+        self.queue.greenlet.join(0.5)
+        self.assertEqual(self.states(), ['sent', 'sent'])
+        self.assertEqual(len(self.sendmany_txs()), 2)
+
+    def test_warmup_is_retried(self):
+        warming = iter([JSONRPCError({'code': -28, 'message': 'Loading wallet...'})])
+
+        def warmup(amounts, comment=''):
+            for e in warming:
+                raise e
+            return self.send_many(amounts, comment)
+        self.start(warmup)
+
+        result = self.queue.send(self.fake.new_address(), Decimal('0.5'), None)
+        self.assertEqual(result.get(timeout=1), self.sendmany_txs()[0].txid)
+        self.assertEqual(self.states(), ['sent'])
+        self.assertEqual(len(self.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+from gevent import sleep, Timeout
+
+from btd.bitcoind import BitcoindRPC
+from btd.pool import ConnectionPool
+from bench.fakebitcoind import FakeBitcoind
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_connection_is_reused_after_a_normal_exit_only(self):
+        closed = []
+        pool = ConnectionPool(object, 2, close=closed.append)
+        with pool.connection() as conn:
+            pass
+        with pool.connection() as again:
+            self.assertIs(again, conn)
+
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError()
+        self.assertEqual(closed, [conn])
+        self.assertEqual(len(pool.idle), 0)
+
+
+class TestPooledRPC(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeBitcoind()
+        self.rpc = BitcoindRPC(self.fake.conf())
+
+    def tearDown(self):
+        self.rpc.pool.clear()
+        self.fake.stop()
+
+    def test_call_interrupted_by_a_timeout_does_not_poison_the_pool(self):
+        rpc_getinfo = self.fake.rpc_getinfo
+
+        def slow_getinfo():
+            sleep(0.2)
+            return dict(rpc_getinfo(), slow=True)
+        self.fake.rpc_getinfo = slow_getinfo
+        self.assertEqual(self.rpc.get_info()['slow'], True)
+        self.assertEqual(len(self.rpc.pool.idle), 1)
+
+        with self.assertRaises(Timeout):
+            with Timeout(0.05):
+                self.rpc.get_info()
+        self.assertEqual(len(self.rpc.pool.idle), 0)
+
+        self.fake.rpc_getinfo = rpc_getinfo
+        self.assertNotIn('slow', self.rpc.get_info())
+        self.assertEqual(self.rpc.get_blockchain_info()['blocks'], self.fake.tip_height)
+        # The slow answer to the interrupted call is never read by anyone
+        sleep(0.3)
+        self.assertNotIn('slow', self.rpc.get_info())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import zmq.green as zmq
+from gevent import sleep
+
+from btd import settings
+from btd.engine import BtdStorage, BtdListener
+from btd.publisher import BtdPublisher, decode_message
+from test_engine import StorageTestCase
+
+from decimal import Decimal
+from uuid import uuid4
+
+
+class TestSharedPublisher(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.publisher = BtdPublisher('inproc://btd-test-{}'.format(id(self)), window=0)
+        self.socket = self.publisher.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.socket.connect(self.publisher.endpoint)
+        sleep(0.05)
+
+        self.other_conf = self.fake.conf('other.conf')
+        self.other_storage = BtdStorage(self.other_conf)
+        self.listeners = [BtdListener(self.conf, self.rpc, self.storage, self.publisher),
+                          BtdListener(self.other_conf, self.rpc, self.other_storage, self.publisher)]
+
+    def tearDown(self):
+        for listener in self.listeners:
+            if listener.eventlog is not None:
+                listener.eventlog.close()
+        self.socket.close()
+        self.publisher.close()
+        self.other_storage.close()
+        super().tearDown()
+
+    def diff(self):
+        return BtdListener.TxInfo(uuid4(), 'new', 'receive', '00' * 32, self.fake.new_address(), None,
+                                  Decimal('0.1'), 0, None)
+
+    def received(self, count):
+        seqs = {}
+        for _ in range(count):
+            conf, events = decode_message(self.socket.recv_multipart())
+            seqs.setdefault(conf, []).extend(event.seq for event in events)
+        return seqs
+
+    def test_every_conf_numbers_its_own_records(self):
+        for listener in self.listeners + self.listeners[:1]:
+            listener.broadcast_diff(self.diff())
+        self.assertEqual(self.received(3), {'bench.conf': [1, 2], 'other.conf': [1]})
+
+    def test_confs_without_an_event_log(self):
+        eventlog = settings.BTD_EVENTLOG
+        settings.BTD_EVENTLOG = False
+        try:
+            listeners = [BtdListener(listener.conf, self.rpc, listener.storage, self.publisher)
+                         for listener in self.listeners]
+        finally:
+            settings.BTD_EVENTLOG = eventlog
+        for listener in listeners[1:] + listeners:
+            listener.broadcast_diff(self.diff())
+        self.assertEqual(self.received(3), {'bench.conf': [1], 'other.conf': [1, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+
+from btd.server import BtdRPCServer, RPCError, ERROR_INVALID
+
+from collections import namedtuple
+from decimal import Decimal
+from time import monotonic
+
+Balance = namedtuple('Balance', 'confirmed unconfirmed')
+
+
+class RecordingRPC:
+    def __init__(self):
+        self.sends = []
+
+    def send(self, address, amount, context):
+        self.sends.append((address, amount, context))
+        return 'uuid'
+
+    def get_address(self, context):
+        raise TypeError('broken handler')
+
+    def get_balance(self, context=None, address=None):
+        return Balance(Decimal(0), Decimal('0.1'))
+
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.rpc = RecordingRPC()
+        self.server = BtdRPCServer({'bitcoin.conf': self.rpc}, endpoint='inproc://test')
+
+    def dispatch(self, payload):
+        return self.server.dispatch(self.server.parse(payload), monotonic())
+
+    def test_json_number_amounts_are_exact(self):
+        self.dispatch(b'{"method": "send", "params": {"address": "a", "amount": 0.29, "context": "c"}}')
+        self.dispatch(b'{"method": "send", "params": {"address": "a", "amount": "0.29", "context": "c"}}')
+        self.assertEqual(self.rpc.sends, [('a', Decimal('0.29'), b'c')] * 2)
+        self.assertEqual([int(amount * 100000000) for _, amount, _ in self.rpc.sends], [29000000] * 2)
+
+    def test_invalid_amounts_are_rejected(self):
+        for amount in (b'0.000000001', b'-1', b'"NaN"', b'"one"', b'true'):
+            with self.assertRaises(RPCError) as cm:
+                self.dispatch(b'{"method": "send", "params": {"address": "a", "amount": ' + amount + b', "context": "c"}}')
+            self.assertEqual(cm.exception.code, ERROR_INVALID)
+        self.assertEqual(self.rpc.sends, [])
+
+    def test_params_are_checked_before_calling(self):
+        with self.assertRaises(RPCError) as cm:
+            self.dispatch(b'{"method": "send", "params": {"address": "a"}}')
+        self.assertEqual(cm.exception.code, ERROR_INVALID)
+
+        # A TypeError raised while handling is an internal error, not a bad request
+        with self.assertRaises(TypeError):
+            self.dispatch(b'{"method": "get_address", "params": {"context": "c"}}')
+
+
+    def test_invalid_deadlines_are_rejected(self):
+        for deadline in (b'"soon"', b'true', b'0', b'-1', b'"NaN"', b'"inf"', b'[1]'):
+            with self.assertRaises(RPCError) as cm:
+                self.dispatch(b'{"method": "get_balance", "params": {}, "deadline": ' + deadline + b'}')
+            self.assertEqual(cm.exception.code, ERROR_INVALID)
+        for deadline in (b'2.5', b'"5"', b'null'):
+            self.assertEqual(self.dispatch(b'{"method": "get_balance", "params": {}, "deadline": ' + deadline + b'}'),
+                             {'confirmed': '0', 'unconfirmed': '0.1'})
+
+    def test_contexts_and_addresses_must_be_strings(self):
+        for payload in (b'{"method": "get_address", "params": {"context": 5}}',
+                        b'{"method": "get_address", "params": {"context": null}}',
+                        b'{"method": "send", "params": {"address": ["a"], "amount": "1", "context": "c"}}',
+                        b'{"method": "send", "params": {"address": "a", "amount": "1", "context": {}}}',
+                        b'{"method": "get_balance", "params": {"context": 1}}',
+                        b'{"method": "get_balance", "params": {"address": false}}'):
+            with self.assertRaises(RPCError) as cm:
+                self.dispatch(payload)
+            self.assertEqual(cm.exception.code, ERROR_INVALID)
+        self.assertEqual(self.rpc.sends, [])
+        # Optional ones may still be null
+        self.dispatch(b'{"method": "get_balance", "params": {"context": null, "address": "a"}}')
+
+
+if __name__ == '__main__':
+    unittest.main()
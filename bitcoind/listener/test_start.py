@@ -0,0 +1,55 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+from gevent import spawn, sleep
+
+from btd import settings
+from btd import start
+from btd.engine import BtdListener
+from test_engine import StorageTestCase
+
+
+class CrashingListener(BtdListener):
+    started = []
+
+    def listen_forever(self):
+        self.started.append(self)
+        raise RuntimeError('crashed')
+
+
+class TestSupervisor(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings = dict((name, getattr(settings, name)) for name in (
+            'BTD_RESTART_BACKOFF_MIN', 'BTD_RESTART_BACKOFF_MAX'))
+        settings.BTD_RESTART_BACKOFF_MIN = settings.BTD_RESTART_BACKOFF_MAX = 0.001
+        self.supervisor = start.Supervisor({self.conf.filename: self.conf}, processes=0)
+        CrashingListener.started = []
+
+    def tearDown(self):
+        for storage in self.supervisor.storages().values():
+            storage.close()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        super().tearDown()
+
+    def test_restarted_listener_reuses_the_storage_and_releases_the_rest(self):
+        listener_class, start.BtdListener = start.BtdListener, CrashingListener
+        try:
+            g = spawn(self.supervisor.supervise_listener, self.conf)
+            while len(CrashingListener.started) < 5:
+                sleep(0.01)
+            g.kill()
+        finally:
+            start.BtdListener = listener_class
+
+        storage = self.supervisor.storages()[self.conf.filename]
+        self.assertTrue(all(listener.storage is storage for listener in CrashingListener.started))
+        self.assertTrue(all(listener.eventlog.log_file.closed for listener in CrashingListener.started))
+        # Still open for the next listener and the RPC server
+        self.assertIsNone(storage.get_state('missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+from gevent import monkey
+monkey.patch_all()
+
+import unittest
+import tempfile
+import shutil
+import json
+from gevent import sleep
+from gevent.pywsgi import WSGIServer
+
+from btd import settings
+from btd.bitcoind import BitcoindConf
+from btd.engine import BtdListener
+from btd.eventlog import EventLog
+from btd.webhook import WebhookDispatcher, DeliveryError
+
+from decimal import Decimal
+from uuid import uuid4
+
+
+class Receiver:
+    """
+    HTTP endpoint answering POSTs with the statuses queued in answers, 200 once they run out
+    """
+    def __init__(self):
+        self.answers = []
+        self.posts = []
+        self.server = WSGIServer(('127.0.0.1', 0), self.handle, log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{}/hook'.format(self.server.server_port)
+
+    def handle(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        status = self.answers.pop(0) if self.answers else '200 OK'
+        if status.startswith('2'):
+            self.posts.append(json.loads(body.decode()))
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+        return [b'']
+
+    def seqs(self):
+        return [event['seq'] for post in self.posts for event in post['events']]
+
+
+class TestWebhookDelivery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='btd-test-')
+        self.settings = dict((name, getattr(settings, name)) for name in (
+            'BTD_WEBHOOK_BATCH_MAX', 'BTD_WEBHOOK_BATCH_WINDOW', 'BTD_WEBHOOK_RETRY_MIN'))
+        settings.BTD_WEBHOOK_BATCH_WINDOW = 0
+        settings.BTD_WEBHOOK_RETRY_MIN = 0.01
+        self.conf = BitcoindConf('test.conf', {})
+        self.eventlog = EventLog(self.conf, self.directory)
+        self.receiver = Receiver()
+        self.dispatcher = None
+
+    def tearDown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        self.receiver.server.stop()
+        self.eventlog.close()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        shutil.rmtree(self.directory)
+
+    def dispatch(self, topics=None, backfill=None):
+        self.dispatcher = WebhookDispatcher(self.conf, self.eventlog, {self.receiver.url: topics}, backfill)
+        return self.dispatcher.endpoints[0]
+
+    def append(self, *topics):
+        for topic in topics:
+            self.eventlog.append(topic, BtdListener.TxInfo(
+                uuid4(), 'new', 'receive', '00' * 32, 'addr', None, Decimal('0.1'), 0, None))
+
+    def test_batch_is_acked_only_once_delivered(self):
+        endpoint = self.dispatch()
+        self.append(b'', b'', b'')
+        self.receiver.answers.append('500 Internal Server Error')
+
+        with self.assertRaises(DeliveryError):
+            self.dispatcher.deliver(endpoint)
+        self.assertEqual(self.eventlog.consumers.get(endpoint.consumer), None)
+
+        self.assertTrue(self.dispatcher.deliver(endpoint))
+        self.assertEqual(self.receiver.posts[0]['conf'], 'test.conf')
+        self.assertEqual(self.receiver.seqs(), [1, 2, 3])
+        self.assertEqual(self.eventlog.consumers[endpoint.consumer], 3)
+        self.assertFalse(self.dispatcher.deliver(endpoint))
+
+    def test_batches_and_topics(self):
+        settings.BTD_WEBHOOK_BATCH_MAX = 2
+        endpoint = self.dispatch(['wanted'])
+        self.append(b'wanted', b'other', b'wanted', b'wanted')
+
+        self.assertTrue(self.dispatcher.deliver(endpoint))
+        self.assertEqual(self.receiver.seqs(), [1, 3])
+        # Diffs of other contexts are acknowledged with the batch they were skipped in
+        self.assertEqual(self.eventlog.consumers[endpoint.consumer], 3)
+        self.assertTrue(self.dispatcher.deliver(endpoint))
+        self.assertEqual(self.receiver.seqs(), [1, 3, 4])
+
+    def test_failing_endpoint_is_retried_in_order(self):
+        endpoint = self.dispatch(backfill=True)
+        self.append(b'', b'')
+        self.receiver.answers.extend(['503 Service Unavailable'] * 2)
+        self.dispatcher.start()
+
+        for _ in range(100):
+            if self.eventlog.consumers.get(endpoint.consumer) == 2:
+                break
+            sleep(0.01)
+        self.assertEqual(endpoint.failures, 0)
+
+        self.append(b'')
+        self.dispatcher.notify()
+        for _ in range(100):
+            if self.eventlog.consumers.get(endpoint.consumer) == 3:
+                break
+            sleep(0.01)
+        # Each diff is delivered once, after the failed attempts
+        self.assertEqual(self.receiver.seqs(), [1, 2, 3])
+        self.assertEqual(self.receiver.answers, [])
+
+
+    def test_consumers_are_reconciled_with_the_endpoints(self):
+        self.append(b'', b'', b'')
+        self.eventlog.ack('webhook:http://127.0.0.1:1/removed', 1)
+        self.eventlog.ack('replay', 2)
+        endpoint = self.dispatch()
+        self.dispatcher.register()
+
+        # Starts at the head rather than with the whole retained log
+        self.assertEqual(self.eventlog.consumers, {endpoint.consumer: 3, 'replay': 2})
+        self.assertFalse(self.dispatcher.deliver(endpoint))
+        self.append(b'')
+        self.assertTrue(self.dispatcher.deliver(endpoint))
+        self.assertEqual(self.receiver.seqs(), [4])
+
+        # Known consumers resume where they were
+        self.eventlog.save_consumers()
+        self.assertEqual(self.eventlog.load_consumers(), {endpoint.consumer: 4, 'replay': 2})
+        self.dispatcher.register()
+        self.assertEqual(self.eventlog.consumers[endpoint.consumer], 4)
+
+    def test_backfill_delivers_the_retained_log(self):
+        self.append(b'', b'')
+        endpoint = self.dispatch(backfill=True)
+        self.dispatcher.register()
+        self.assertNotIn(endpoint.consumer, self.eventlog.consumers)
+        self.assertTrue(self.dispatcher.deliver(endpoint))
+        self.assertEqual(self.receiver.seqs(), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()